@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+#
+# PROFIBUS - Bus statistics
+#
+# Licensed under the terms of the GNU General Public License version 2,
+# or (at your option) any later version.
+#
+
+from __future__ import division, absolute_import, print_function, unicode_literals
+from pyprofibus.compat import *
+
+from pyprofibus.capture import CaptureRecord
+from pyprofibus.fdl import *
+from pyprofibus.util import *
+
+from collections import deque
+
+__all__ = [
+	"StatsDistribution",
+	"StationStats",
+	"BusStats",
+]
+
+class StatsDistribution(object):
+	"""Distribution of time values.
+	count, min, max and mean cover all samples.
+	The percentiles cover the most recent samples only.
+	"""
+
+	# Number of recent samples kept for the percentiles.
+	WINDOW = 1024
+
+	__slots__ = (
+		"count",
+		"min",
+		"max",
+		"total",
+		"__recent",
+	)
+
+	def __init__(self):
+		self.count = 0
+		self.min = None
+		self.max = None
+		self.total = 0.0
+		self.__recent = deque(maxlen=self.WINDOW)
+
+	def add(self, value):
+		self.count += 1
+		self.total += value
+		if self.min is None or value < self.min:
+			self.min = value
+		if self.max is None or value > self.max:
+			self.max = value
+		self.__recent.append(value)
+
+	def mean(self):
+		if not self.count:
+			return None
+		return self.total / self.count
+
+	def percentile(self, p):
+		"""Get the p-th percentile (0-100) of the recent samples.
+		Returns None, if there are no samples.
+		"""
+		if not self.__recent:
+			return None
+		values = sorted(self.__recent)
+		i = int(round((len(values) - 1) * p / 100.0))
+		return values[max(0, min(i, len(values) - 1))]
+
+	def toDict(self, scale=1.0):
+		"""Get a dict of the distribution.
+		All values are multiplied by scale.
+		"""
+		def s(value):
+			return None if value is None else value * scale
+		return {
+			"count"	: self.count,
+			"min"	: s(self.min),
+			"max"	: s(self.max),
+			"mean"	: s(self.mean()),
+			"p50"	: s(self.percentile(50)),
+			"p95"	: s(self.percentile(95)),
+			"p99"	: s(self.percentile(99)),
+		}
+
+class StationStats(object):
+	"""Statistics of one bus station.
+	"""
+
+	__slots__ = (
+		"addr",
+		"requestsSent",
+		"requests",
+		"replies",
+		"timeouts",
+		"retries",
+		"repeats",
+		"tsdr",
+		"tokens",
+		"tokenRotation",
+		"lastFcb",
+		"lastTokenTime",
+	)
+
+	def __init__(self, addr):
+		self.addr = addr
+		self.requestsSent = 0		# Requests sent by this station
+		self.requests = 0		# Requests sent to this station
+		self.replies = 0		# Replies and ACKs from this station
+		self.timeouts = 0		# Requests without reply
+		self.retries = 0		# Requests repeated after a timeout
+		self.repeats = 0		# Requests repeated with unchanged FCB
+		self.tsdr = StatsDistribution()	# Reply latency, in seconds
+		self.tokens = 0			# Tokens passed by this station
+		self.tokenRotation = StatsDistribution() # In seconds
+		self.lastFcb = None
+		self.lastTokenTime = None
+
+	def toDict(self):
+		return {
+			"addr"		: self.addr,
+			"requestsSent"	: self.requestsSent,
+			"requests"	: self.requests,
+			"replies"	: self.replies,
+			"timeouts"	: self.timeouts,
+			"retries"	: self.retries,
+			"repeats"	: self.repeats,
+			"tsdr_us"	: self.tsdr.toDict(1e6),
+			"tokens"	: self.tokens,
+			"tokenRotation_ms" : self.tokenRotation.toDict(1e3),
+		}
+
+class BusStats(object):
+	"""Rolling statistics of the frames on a bus.
+	Frames are decoded with FdlTelegram.fromRawData(),
+	like the FdlTransceiver receive path does.
+	"""
+
+	__slots__ = (
+		"baudrate",
+		"stations",
+		"frames",
+		"octets",
+		"phyErrors",
+		"crcErrors",
+		"framingErrors",
+		"__secPerOctet",
+		"__pending",
+		"__firstTime",
+		"__lastTime",
+		"__busyTotal",
+		"__intervalStart",
+		"__intervalBusy",
+		"__busLoad",
+	)
+
+	def __init__(self, baudrate):
+		self.baudrate = baudrate
+		self.stations = {}
+		self.frames = 0
+		self.octets = 0
+		self.phyErrors = 0
+		self.crcErrors = 0
+		self.framingErrors = 0
+		# One UART character has 11 bits.
+		self.__secPerOctet = 11.0 / baudrate
+		# The request waiting for a reply:
+		# (raw data, DA, SA, end time, answered)
+		self.__pending = None
+		self.__firstTime = None
+		self.__lastTime = None
+		self.__busyTotal = 0.0
+		self.__intervalStart = None
+		self.__intervalBusy = 0.0
+		self.__busLoad = None
+
+	def getStation(self, addr):
+		station = self.stations.get(addr)
+		if station is None:
+			station = self.stations[addr] = StationStats(addr)
+		return station
+
+	def handleRecord(self, record):
+		"""Process a CaptureRecord.
+		"""
+		self.handleFrame(record.data, record.timestamp / 1e9,
+				 bool(record.flags & CaptureRecord.FLAG_ERR_PHY))
+
+	def handleFrame(self, data, timestamp, phyError=False):
+		"""Process one received frame.
+		data: The raw frame data.
+		timestamp: The time of the end of the frame, in seconds.
+		phyError: True, if the PHY reported a receive error.
+		"""
+		if self.__firstTime is None:
+			self.__firstTime = self.__intervalStart = timestamp
+		self.__lastTime = timestamp
+		self.frames += 1
+		self.octets += len(data)
+		busy = len(data) * self.__secPerOctet
+		self.__busyTotal += busy
+		self.__intervalBusy += busy
+
+		if phyError:
+			self.phyErrors += 1
+			return
+		try:
+			telegram = FdlTelegram.fromRawData(data)
+		except FdlChecksumError:
+			self.crcErrors += 1
+			return
+		except FdlError:
+			self.framingErrors += 1
+			return
+
+		pending = self.__pending
+		if telegram.sd == FdlTelegram.SD4:
+			# Token frame
+			self.__checkTimeout()
+			self.__pending = None
+			station = self.getStation(telegram.sa)
+			station.tokens += 1
+			if station.lastTokenTime is not None:
+				station.tokenRotation.add(timestamp - station.lastTokenTime)
+			station.lastTokenTime = timestamp
+		elif telegram.sd == FdlTelegram.SC or\
+		     not (telegram.fc & FdlTelegram.FC_REQ):
+			# Reply or short ACK
+			if pending is None or pending[4]:
+				return
+			if telegram.sd != FdlTelegram.SC and\
+			   (telegram.sa != pending[1] or telegram.da != pending[2]):
+				return
+			station = self.getStation(pending[1])
+			station.replies += 1
+			# The reply latency is measured from the end of the
+			# request to the start of the reply.
+			start = timestamp - busy
+			station.tsdr.add(max(0.0, start - pending[3]))
+			self.__pending = (pending[0], pending[1], pending[2],
+					  pending[3], True)
+		else:
+			# Request
+			station = self.getStation(telegram.da)
+			station.requests += 1
+			self.getStation(telegram.sa).requestsSent += 1
+			sameRequest = pending is not None and\
+				      pending[1] == telegram.da and\
+				      pending[0] == data
+			if self.__checkTimeout() and sameRequest:
+				station.retries += 1
+			elif telegram.fc & FdlTelegram.FC_FCV:
+				fcb = telegram.fc & FdlTelegram.FC_FCB
+				if fcb == station.lastFcb and sameRequest:
+					station.repeats += 1
+				station.lastFcb = fcb
+			self.__pending = None
+			if FdlTelegram.fcExpectsReply(telegram.fc):
+				self.__pending = (bytes(data), telegram.da,
+						  telegram.sa, timestamp, False)
+
+	def __checkTimeout(self):
+		"""Count a timeout, if the pending request has not been answered.
+		Returns True, if a timeout was counted.
+		"""
+		pending = self.__pending
+		if pending is None or pending[4]:
+			return False
+		self.getStation(pending[1]).timeouts += 1
+		return True
+
+	def getBusLoad(self):
+		"""Get the bus load, in percent, of the total observed time.
+		"""
+		if self.__firstTime is None or self.__lastTime <= self.__firstTime:
+			return None
+		return 100.0 * self.__busyTotal / (self.__lastTime - self.__firstTime)
+
+	def getIntervalBusLoad(self):
+		"""Get the bus load, in percent,
+		of the last interval completed by endInterval().
+		"""
+		return self.__busLoad
+
+	def endInterval(self, timestamp):
+		"""End the current bus load interval at timestamp (seconds).
+		"""
+		if self.__intervalStart is not None and\
+		   timestamp > self.__intervalStart:
+			self.__busLoad = min(100.0, 100.0 * self.__intervalBusy /
+					     (timestamp - self.__intervalStart))
+		self.__intervalStart = timestamp
+		self.__intervalBusy = 0.0
+
+	def toDict(self):
+		return {
+			"baudrate"	: self.baudrate,
+			"frames"	: self.frames,
+			"octets"	: self.octets,
+			"phyErrors"	: self.phyErrors,
+			"crcErrors"	: self.crcErrors,
+			"framingErrors"	: self.framingErrors,
+			"busLoad"	: self.getBusLoad(),
+			"intervalBusLoad" : self.getIntervalBusLoad(),
+			"stations"	: [ self.stations[a].toDict()
+					    for a in sorted(self.stations) ],
+		}
+
+	def __str__(self):
+		def fmt(value, scale=1.0, f="%.0f"):
+			return "-" if value is None else (f % (value * scale))
+		text = []
+		text.append("Frames: %d   PHY errors: %d   CRC errors: %d   "
+			    "Framing errors: %d\n" % (
+			    self.frames, self.phyErrors,
+			    self.crcErrors, self.framingErrors))
+		text.append("Bus load: %s %% (total %s %%)\n\n" % (
+			    fmt(self.getIntervalBusLoad(), f="%.1f"),
+			    fmt(self.getBusLoad(), f="%.1f")))
+		text.append("Addr   ReqTx   ReqRx  Replies Timeout Retry Repeat"
+			    "   TSDR p50/p95/max (us)   Token rot. p50/max (ms)\n")
+		for addr in sorted(self.stations):
+			s = self.stations[addr]
+			tsdr, rot = s.tsdr, s.tokenRotation
+			text.append("%4d %7d %7d %8d %7d %5d %6d   %7s/%7s/%7s"
+				    "   %11s/%11s\n" % (
+				    addr, s.requestsSent, s.requests, s.replies,
+				    s.timeouts, s.retries, s.repeats,
+				    fmt(tsdr.percentile(50), 1e6),
+				    fmt(tsdr.percentile(95), 1e6),
+				    fmt(tsdr.max, 1e6),
+				    fmt(rot.percentile(50), 1e3, "%.2f"),
+				    fmt(rot.max, 1e3, "%.2f")))
+		return "".join(text)
@@ -0,0 +1,650 @@
+# -*- coding: utf-8 -*-
+#
+# PROFIBUS - Telegram capture files
+#
+# Licensed under the terms of the GNU General Public License version 2,
+# or (at your option) any later version.
+#
+
+from __future__ import division, absolute_import, print_function, unicode_literals
+from pyprofibus.compat import *
+
+from pyprofibus.fdl import *
+from pyprofibus.dp import *
+from pyprofibus.util import *
+
+import os
+import struct
+import time
+
+try:
+	import mmap
+except ImportError:
+	mmap = None
+
+try:
+	import ctypes
+	import multiprocessing
+except ImportError:
+	ctypes = None
+	multiprocessing = None
+
+__all__ = [
+	"CaptureError",
+	"CaptureRecord",
+	"CaptureWriter",
+	"PcapWriter",
+	"CaptureReader",
+	"CaptureIndexEntry",
+	"CaptureFile",
+	"CaptureRing",
+	"CaptureReceiver",
+	"openCaptureWriter",
+]
+
+class CaptureError(ProfibusError):
+	pass
+
+class CaptureRecord(object):
+	"""One captured frame.
+	"""
+
+	# Record flags
+	FLAG_TX		= 0x01	# Frame was sent by this station.
+	FLAG_ERR_PHY	= 0x02	# PHY receive error. Data may be incomplete.
+	FLAG_TRUNCATED	= 0x04	# Data was truncated.
+	FLAG_ERR_FRAME	= 0x08	# Invalid frame format or checksum.
+				# Only set in the index.
+
+	__slots__ = (
+		"timestamp",
+		"flags",
+		"data",
+	)
+
+	def __init__(self, timestamp, flags, data):
+		self.timestamp = timestamp	# Monotonic time stamp in ns
+		self.flags = flags		# FLAG_...
+		self.data = data		# Raw frame data
+
+	def __repr__(self):
+		return "CaptureRecord(timestamp=%d, flags=0x%02X, data=%s)" % (
+			self.timestamp, self.flags, bytesToHex(self.data))
+
+class CaptureWriter(object):
+	"""Append-only writer for pyprofibus capture files.
+
+	File format (all values little endian):
+	  Header: 8 bytes magic, u32 baud rate, u32 reserved.
+	  Records: u64 time stamp (ns), u8 flags, u8 reserved,
+	           u16 data length, data.
+	"""
+
+	MAGIC		= b"PBCAP\x00\x01\x00"
+	HEADER		= struct.Struct(str("<8sII"))
+	RECORD		= struct.Struct(str("<QBBH"))
+
+	# Flush the write buffer at least this often, in seconds.
+	FLUSH_INTERVAL	= 1.0
+
+	BUFFER_SIZE	= 1 << 16
+
+	def __init__(self, filename, baudrate=0, clock=None):
+		"""Open the capture file for appending.
+		A new header is written, if the file is empty.
+		baudrate: The bus baud rate, stored in the header.
+		clock: The clock for the periodic flush. None = real time.
+		"""
+		self.clock = clock if clock is not None else defaultClock
+		self.baudrate = baudrate
+		try:
+			self._fd = open(filename, "ab", self.BUFFER_SIZE)
+			if self._fd.tell() == 0:
+				self._writeHeader()
+		except (IOError, OSError) as e:
+			raise CaptureError("Failed to open capture file "
+				"'%s': %s" % (filename, str(e)))
+		self.__nextFlush = self.clock.now() + self.FLUSH_INTERVAL
+
+	def _writeHeader(self):
+		self._fd.write(self.HEADER.pack(self.MAGIC, self.baudrate, 0))
+
+	def _writeRecord(self, timestamp, flags, data):
+		self._fd.write(self.RECORD.pack(timestamp, flags, 0, len(data)))
+		self._fd.write(data)
+
+	def write(self, data, timestamp, flags=0):
+		"""Append one frame.
+		data: The raw frame data.
+		timestamp: Monotonic time stamp in nanoseconds.
+		flags: CaptureRecord.FLAG_...
+		"""
+		if len(data) > 0xFFFF:
+			data = data[:0xFFFF]
+			flags |= CaptureRecord.FLAG_TRUNCATED
+		try:
+			self._writeRecord(timestamp, flags, data)
+			if self.clock.now() >= self.__nextFlush:
+				self.flush()
+		except (IOError, OSError) as e:
+			raise CaptureError("Failed to write capture file: %s" % str(e))
+
+	def flush(self):
+		try:
+			self._fd.flush()
+		except (IOError, OSError) as e:
+			raise CaptureError("Failed to write capture file: %s" % str(e))
+		self.__nextFlush = self.clock.now() + self.FLUSH_INTERVAL
+
+	def close(self):
+		if self._fd:
+			self.flush()
+			self._fd.close()
+			self._fd = None
+
+class PcapWriter(CaptureWriter):
+	"""Writer for pcap files with nanosecond time stamps.
+	The frames are stored with the PROFIBUS data link layer type.
+	"""
+
+	MAGIC		= 0xA1B23C4D	# Nanosecond resolution pcap
+	HEADER		= struct.Struct(str("<IHHiIII"))
+	RECORD		= struct.Struct(str("<IIII"))
+
+	LINKTYPE_PROFIBUS_DL = 257
+
+	def _writeHeader(self):
+		self._fd.write(self.HEADER.pack(self.MAGIC, 2, 4, 0, 0, 0xFFFF,
+						self.LINKTYPE_PROFIBUS_DL))
+
+	def _writeRecord(self, timestamp, flags, data):
+		# pcap has no flags. Frames with PHY errors are written as-is.
+		sec, nsec = divmod(timestamp, 1000000000)
+		self._fd.write(self.RECORD.pack(sec & 0xFFFFFFFF, nsec,
+						len(data), len(data)))
+		self._fd.write(data)
+
+def openCaptureWriter(filename, baudrate=0, clock=None):
+	"""Open a CaptureWriter or, for *.pcap files, a PcapWriter.
+	"""
+	if filename.lower().endswith(".pcap"):
+		return PcapWriter(filename, baudrate, clock)
+	return CaptureWriter(filename, baudrate, clock)
+
+class CaptureReader(object):
+	"""Sequential reader for pyprofibus capture files.
+	"""
+
+	def __init__(self, filename):
+		try:
+			self.__fd = open(filename, "rb")
+			header = self.__fd.read(CaptureWriter.HEADER.size)
+		except (IOError, OSError) as e:
+			raise CaptureError("Failed to read capture file "
+				"'%s': %s" % (filename, str(e)))
+		if len(header) != CaptureWriter.HEADER.size:
+			raise CaptureError("Capture file '%s' is truncated." % filename)
+		magic, self.baudrate, _ = CaptureWriter.HEADER.unpack(header)
+		if magic != CaptureWriter.MAGIC:
+			raise CaptureError("'%s' is not a capture file." % filename)
+
+	def __iter__(self):
+		"""Iterate over all CaptureRecord()s.
+		A truncated record at the end of the file is ignored.
+		"""
+		fd = self.__fd
+		recordStruct = CaptureWriter.RECORD
+		try:
+			while True:
+				header = fd.read(recordStruct.size)
+				if len(header) != recordStruct.size:
+					break
+				timestamp, flags, _, length = recordStruct.unpack(header)
+				data = fd.read(length)
+				if len(data) != length:
+					break
+				yield CaptureRecord(timestamp, flags, data)
+		except (IOError, OSError) as e:
+			raise CaptureError("Failed to read capture file: %s" % str(e))
+
+	def close(self):
+		if self.__fd:
+			self.__fd.close()
+			self.__fd = None
+
+class CaptureIndexEntry(object):
+	"""Index entry of one frame in a CaptureFile.
+	"""
+
+	NO_ADDR		= 0xFF	# Value of da/sa/dsap/ssap, if not present.
+
+	STRUCT		= struct.Struct(str("<QQBBBBBBBB"))
+
+	__slots__ = (
+		"offset",
+		"timestamp",
+		"flags",
+		"sd",
+		"da",
+		"sa",
+		"fc",
+		"dsap",
+		"ssap",
+	)
+
+	def __init__(self, offset, timestamp, flags,
+		     sd=0, da=NO_ADDR, sa=NO_ADDR, fc=0,
+		     dsap=NO_ADDR, ssap=NO_ADDR):
+		self.offset = offset		# File offset of the record
+		self.timestamp = timestamp	# Time stamp in ns
+		self.flags = flags		# CaptureRecord.FLAG_...
+		self.sd = sd			# Start delimiter
+		self.da = da			# Destination address
+		self.sa = sa			# Source address
+		self.fc = fc			# Frame control
+		self.dsap = dsap		# Destination SAP
+		self.ssap = ssap		# Source SAP
+
+	@classmethod
+	def fromRecord(cls, offset, record):
+		"""Create the index entry for a CaptureRecord.
+		"""
+		entry = cls(offset, record.timestamp, record.flags)
+		if record.flags & CaptureRecord.FLAG_ERR_PHY:
+			return entry
+		try:
+			fdl = FdlTelegram.fromRawData(record.data)
+		except FdlError:
+			entry.flags |= CaptureRecord.FLAG_ERR_FRAME
+			return entry
+		NO_ADDR = cls.NO_ADDR
+		entry.sd = fdl.sd
+		if fdl.da is not None:
+			entry.da = fdl.da & FdlTelegram.ADDRESS_MASK
+		if fdl.sa is not None:
+			entry.sa = fdl.sa & FdlTelegram.ADDRESS_MASK
+		if fdl.fc is not None:
+			entry.fc = fdl.fc
+		dsap = DpTelegram.extractSAP(fdl.dae)
+		entry.dsap = NO_ADDR if dsap is None else dsap
+		ssap = DpTelegram.extractSAP(fdl.sae)
+		entry.ssap = NO_ADDR if ssap is None else ssap
+		return entry
+
+	def pack(self):
+		return self.STRUCT.pack(self.offset, self.timestamp, self.flags,
+					self.sd, self.da, self.sa, self.fc,
+					self.dsap, self.ssap, 0)
+
+	@classmethod
+	def unpackFrom(cls, buf, offset):
+		values = cls.STRUCT.unpack_from(buf, offset)
+		return cls(*values[:-1])
+
+	def isError(self):
+		return bool(self.flags & (CaptureRecord.FLAG_ERR_PHY |
+					  CaptureRecord.FLAG_ERR_FRAME))
+
+class CaptureFile(object):
+	"""Random access to a capture file.
+
+	The capture file is memory mapped. A sidecar index file
+	(capture file name + ".idx") holds a CaptureIndexEntry per frame.
+	The index is built on first use and extended incrementally,
+	if the capture file has grown since.
+	Time based lookups assume non-decreasing time stamps,
+	i.e. a capture of one profisniff run.
+	"""
+
+	INDEX_MAGIC	= b"PBCIDX\x00\x01"
+	INDEX_HEADER	= struct.Struct(str("<8sQII"))
+
+	def __init__(self, filename, indexFilename=None):
+		if mmap is None:
+			raise CaptureError("CaptureFile: mmap is not supported.")
+		self.filename = filename
+		self.indexFilename = indexFilename or (filename + ".idx")
+		self.__map = None
+		self.__indexMap = None
+		self.__fd = None
+		self.__indexFd = None
+		try:
+			self.__fd = open(filename, "rb")
+			size = os.fstat(self.__fd.fileno()).st_size
+			headerSize = CaptureWriter.HEADER.size
+			if size < headerSize:
+				raise CaptureError("Capture file '%s' is "
+					"truncated." % filename)
+			self.__map = mmap.mmap(self.__fd.fileno(), size,
+					       access=mmap.ACCESS_READ)
+			magic, self.baudrate, _ = CaptureWriter.HEADER.unpack_from(
+				self.__map, 0)
+			if magic != CaptureWriter.MAGIC:
+				raise CaptureError("'%s' is not a capture file." % filename)
+			self.__openIndex(size)
+		except (IOError, OSError, ValueError) as e:
+			self.close()
+			raise CaptureError("Failed to open capture file "
+				"'%s': %s" % (filename, str(e)))
+		except CaptureError:
+			self.close()
+			raise
+
+	def __openIndex(self, captureSize):
+		headerStruct = self.INDEX_HEADER
+		entrySize = CaptureIndexEntry.STRUCT.size
+		try:
+			fd = open(self.indexFilename, "r+b")
+		except (IOError, OSError):
+			fd = open(self.indexFilename, "w+b")
+		self.__indexFd = fd
+		header = fd.read(headerStruct.size)
+		indexedSize = 0
+		if len(header) == headerStruct.size:
+			magic, indexedSize, size, _ = headerStruct.unpack(header)
+			if magic != self.INDEX_MAGIC or size != entrySize or\
+			   indexedSize > captureSize:
+				indexedSize = 0
+		if indexedSize == 0:
+			fd.seek(0)
+			fd.truncate()
+			indexedSize = CaptureWriter.HEADER.size
+			fd.write(headerStruct.pack(self.INDEX_MAGIC, 0, entrySize, 0))
+		else:
+			nrEntries = (os.fstat(fd.fileno()).st_size -
+				     headerStruct.size) // entrySize
+			fd.truncate(headerStruct.size + nrEntries * entrySize)
+
+		# Index the new records.
+		fd.seek(0, os.SEEK_END)
+		buf = bytearray()
+		for offset, record in self.__scan(indexedSize):
+			buf += CaptureIndexEntry.fromRecord(offset, record).pack()
+			if len(buf) >= (1 << 16):
+				fd.write(buf)
+				buf = bytearray()
+		fd.write(buf)
+		indexedSize = self.__scanEnd
+		fd.seek(0)
+		fd.write(headerStruct.pack(self.INDEX_MAGIC, indexedSize,
+					   entrySize, 0))
+		fd.flush()
+
+		size = os.fstat(fd.fileno()).st_size
+		self.__nrFrames = (size - headerStruct.size) // entrySize
+		if self.__nrFrames:
+			self.__indexMap = mmap.mmap(fd.fileno(), size,
+						    access=mmap.ACCESS_READ)
+
+	def __scan(self, offset):
+		"""Iterate (offset, CaptureRecord) starting at offset.
+		"""
+		m = self.__map
+		size = len(m)
+		recordStruct = CaptureWriter.RECORD
+		self.__scanEnd = offset
+		while offset + recordStruct.size <= size:
+			timestamp, flags, _, length = recordStruct.unpack_from(m, offset)
+			end = offset + recordStruct.size + length
+			if end > size:
+				break # Truncated record
+			yield offset, CaptureRecord(timestamp, flags,
+						    m[offset + recordStruct.size : end])
+			offset = self.__scanEnd = end
+
+	def close(self):
+		for obj in (self.__indexMap, self.__map,
+			    self.__indexFd, self.__fd):
+			if obj is not None:
+				obj.close()
+		self.__indexMap = self.__map = None
+		self.__indexFd = self.__fd = None
+
+	def __len__(self):
+		"""Get the number of frames.
+		"""
+		return self.__nrFrames
+
+	def getIndexEntry(self, i):
+		"""Get the CaptureIndexEntry of frame number i.
+		"""
+		if i < 0 or i >= self.__nrFrames:
+			raise IndexError("Frame number out of range")
+		return CaptureIndexEntry.unpackFrom(self.__indexMap,
+			self.INDEX_HEADER.size + i * CaptureIndexEntry.STRUCT.size)
+
+	def getRecord(self, i):
+		"""Get the CaptureRecord of frame number i.
+		"""
+		return self.__getRecord(self.getIndexEntry(i))
+
+	def __getRecord(self, entry):
+		recordStruct = CaptureWriter.RECORD
+		timestamp, flags, _, length = recordStruct.unpack_from(
+			self.__map, entry.offset)
+		begin = entry.offset + recordStruct.size
+		return CaptureRecord(timestamp, flags,
+				     self.__map[begin : begin + length])
+
+	def findTime(self, timestamp):
+		"""Get the number of the first frame with a
+		time stamp >= timestamp (in ns).
+		"""
+		lo, hi = 0, self.__nrFrames
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if self.getIndexEntry(mid).timestamp < timestamp:
+				lo = mid + 1
+			else:
+				hi = mid
+		return lo
+
+	def iterEntries(self, startTime=None, endTime=None,
+			addrs=None, saps=None, fcFunctions=None, errors=None):
+		"""Iterate over the CaptureIndexEntry()s that match the filter.
+		startTime/endTime: Time range in ns. endTime is exclusive.
+		addrs: Set of addresses. Matches SA or DA.
+		saps: Set of SAPs. Matches DSAP or SSAP.
+		fcFunctions: Set of FC function codes.
+		             Matches (fc & (FC_REQ | FC_REQFUNC_MASK)).
+		errors: True = only errors, False = no errors, None = all.
+		"""
+		start = 0 if startTime is None else self.findTime(startTime)
+		stop = self.__nrFrames if endTime is None else self.findTime(endTime)
+		funcMask = FdlTelegram.FC_REQ | FdlTelegram.FC_REQFUNC_MASK
+		for i in range(start, stop):
+			entry = self.getIndexEntry(i)
+			if errors is not None and entry.isError() != errors:
+				continue
+			if addrs is not None and\
+			   entry.da not in addrs and entry.sa not in addrs:
+				continue
+			if saps is not None and\
+			   entry.dsap not in saps and entry.ssap not in saps:
+				continue
+			if fcFunctions is not None and\
+			   (entry.fc & funcMask) not in fcFunctions:
+				continue
+			yield entry
+
+	def iterRecords(self, **filters):
+		"""Iterate over the (CaptureIndexEntry, CaptureRecord)s
+		that match the filter. See iterEntries() for the filters.
+		"""
+		for entry in self.iterEntries(**filters):
+			yield entry, self.__getRecord(entry)
+
+	def iterTelegrams(self, decodeDp=True, **filters):
+		"""Iterate over the (CaptureIndexEntry, telegram)s
+		that match the filter. See iterEntries() for the filters.
+		Frames with errors are skipped.
+		If decodeDp is True, DpTelegram()s are yielded where possible.
+		Otherwise FdlTelegram()s are yielded.
+		"""
+		for entry, record in self.iterRecords(**filters):
+			if entry.isError():
+				continue
+			telegram = FdlTelegram.fromRawData(record.data)
+			if decodeDp and entry.sd in (FdlTelegram.SD2,
+						     FdlTelegram.SD3):
+				# Requests are decoded from the slave's view
+				# and replies from the master's view.
+				isReply = not (entry.fc & FdlTelegram.FC_REQ)
+				try:
+					telegram = DpTelegram.fromFdlTelegram(
+						telegram, isReply)
+				except ProfibusError:
+					pass
+			yield entry, telegram
+
+class CaptureRing(object):
+	"""Shared memory ring buffer of CaptureRecord()s
+	for one producer process and one consumer process.
+
+	The producer never waits for the consumer.
+	If the ring is full, the frame is dropped and counted.
+	"""
+
+	# Record flags value of the wrap-around marker.
+	FLAG_WRAP	= 0xFF
+
+	DEFAULT_SIZE	= 1 << 22
+
+	def __init__(self, size=DEFAULT_SIZE):
+		if multiprocessing is None:
+			raise CaptureError("CaptureRing: multiprocessing "
+				"is not supported.")
+		self.size = size
+		self.__buf = multiprocessing.RawArray(ctypes.c_ubyte, size)
+		# Monotonic byte positions of the producer and the consumer.
+		self.__head = multiprocessing.RawValue(ctypes.c_uint64, 0)
+		self.__tail = multiprocessing.RawValue(ctypes.c_uint64, 0)
+		self.__dropped = multiprocessing.RawValue(ctypes.c_uint64, 0)
+
+	def getDropped(self):
+		"""Get the number of frames that were dropped, because
+		the ring was full.
+		"""
+		return self.__dropped.value
+
+	def push(self, timestamp, flags, data):
+		"""Put a frame into the ring. This is called by the producer.
+		Returns False, if the frame was dropped.
+		"""
+		recordStruct = CaptureWriter.RECORD
+		size = self.size
+		need = recordStruct.size + len(data)
+		head = self.__head.value
+		index = head % size
+		pad = (size - index) if (index + need > size) else 0
+		if head + pad + need - self.__tail.value > size:
+			self.__dropped.value += 1
+			return False
+		buf = self.__buf
+		if pad:
+			if pad >= recordStruct.size:
+				recordStruct.pack_into(buf, index, 0, self.FLAG_WRAP, 0, 0)
+			index = 0
+		recordStruct.pack_into(buf, index, timestamp, flags, 0, len(data))
+		begin = index + recordStruct.size
+		buf[begin : begin + len(data)] = data
+		# Publish the record.
+		self.__head.value = head + pad + need
+		return True
+
+	def pop(self):
+		"""Get the next CaptureRecord from the ring.
+		This is called by the consumer.
+		Returns None, if the ring is empty.
+		"""
+		recordStruct = CaptureWriter.RECORD
+		size = self.size
+		buf = self.__buf
+		tail = self.__tail.value
+		while tail != self.__head.value:
+			index = tail % size
+			if size - index < recordStruct.size:
+				tail += size - index
+				continue
+			timestamp, flags, _, length = recordStruct.unpack_from(buf, index)
+			if flags == self.FLAG_WRAP:
+				tail += size - index
+				continue
+			begin = index + recordStruct.size
+			data = bytes(bytearray(buf[begin : begin + length]))
+			self.__tail.value = tail + recordStruct.size + length
+			return CaptureRecord(timestamp, flags, data)
+		self.__tail.value = tail
+		return None
+
+def _receiverMain(phyConfText, ring, stopEvent):
+	"""Receive frames from the PHY and put them into the ring.
+	This is executed in the receiver process.
+	"""
+	from pyprofibus.conf import PbConf
+	from pyprofibus.phy import PhyError
+	from io import StringIO
+	phy = PbConf(StringIO(phyConfText)).makePhy()
+	now = phy.clock.now
+	try:
+		while not stopEvent.is_set() and not phy.isExhausted():
+			try:
+				data = phy.poll(0.1)
+				if data is None:
+					continue
+				flags = 0
+			except PhyError:
+				data, flags = b"", CaptureRecord.FLAG_ERR_PHY
+			# The time stamp is taken at the end of the frame.
+			ring.push(int(now() * 1e9), flags, data)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		phy.close()
+
+class CaptureReceiver(object):
+	"""Receive frames in a dedicated process.
+	The receiver process creates the PHY from the [PHY] section
+	of a PbConf configuration text and feeds a CaptureRing.
+	"""
+
+	# Sleep time of the consumer, if the ring is empty.
+	IDLE_SLEEP = 0.001
+
+	def __init__(self, phyConfText, ringSize=CaptureRing.DEFAULT_SIZE):
+		self.ring = CaptureRing(ringSize)
+		self.__stopEvent = multiprocessing.Event()
+		self.__proc = multiprocessing.Process(
+			target=_receiverMain,
+			args=(phyConfText, self.ring, self.__stopEvent))
+		self.__proc.daemon = True
+
+	def start(self):
+		self.__proc.start()
+
+	def stop(self):
+		self.__stopEvent.set()
+		self.__proc.join(1.0)
+		if self.__proc.is_alive():
+			self.__proc.terminate()
+			self.__proc.join()
+
+	def isAlive(self):
+		return self.__proc.is_alive()
+
+	def __iter__(self):
+		"""Iterate over the received CaptureRecord()s.
+		Ends, if the receiver process exited.
+		"""
+		ring = self.ring
+		while True:
+			record = ring.pop()
+			if record is not None:
+				yield record
+			elif self.__proc.is_alive():
+				time.sleep(self.IDLE_SLEEP)
+			else:
+				record = ring.pop()
+				if record is None:
+					break
+				yield record
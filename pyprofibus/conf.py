@@ -11,14 +11,29 @@
 from __future__ import division, absolute_import, print_function, unicode_literals
 from pyprofibus.compat import *
 
+from pyprofibus.dp import DpCfgDataElement
+from pyprofibus.gsd.cache import GsdCache
 from pyprofibus.gsd.interp import GsdInterp
 from pyprofibus.gsd.parser import GsdError
 from pyprofibus.util import *
+from pyprofibus.version import VERSION_STRING
 
+import os
 import re
 import sys
 from io import StringIO
 
+try:
+	import marshal
+	import hashlib
+except ImportError:
+	marshal = hashlib = None
+
+try:
+	from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+	ProcessPoolExecutor = None
+
 if isPy2Compat:
 	from ConfigParser import SafeConfigParser as _ConfigParser
 	from ConfigParser import Error as _ConfigParserError
@@ -34,8 +49,25 @@ __all__ = [
 class PbConfError(ProfibusError):
 	pass
 
+def _parseGsdFields(gsdName):
+	"""Parse a GSD file and return the encoded field tree.
+	Returns None, if parsing failed.
+	This is executed in a worker process.
+	"""
+	try:
+		return GsdCache.encode(GsdInterp.fromFile(gsdName).getFields())
+	except GsdError:
+		return None
+
 class PbConf(object):
 	"""Pyprofibus configuration file parser.
+
+	A configuration file may describe several PROFIBUS lines.
+	The sections of a line have the line name as suffix,
+	for example [PHY@line1], [DP@line1] and [SLAVE_0@line1].
+	If a line is selected, its sections replace the sections
+	of the same name without suffix. The sections without suffix
+	are common to all lines.
 	"""
 
 	class _SlaveConf(object):
@@ -51,22 +83,38 @@ class PbConf(object):
 		watchdogMs	= None
 		inputSize	= None
 		outputSize	= None
+		gsdName		= None
+		moduleNames	= None
+		# Precompiled Chk_Cfg and User_Prm_Data from a snapshot.
+		cfgDataElements	= None
+		userPrmData	= None
+
+		def _getDpGsd(self):
+			"""Get the GsdInterp for the DpSlaveDesc.
+			"""
+			return self.gsd
 
 		def makeDpSlaveDesc(self):
 			"""Create a DpSlaveDesc instance based on the configuration.
 			"""
 			from pyprofibus.dp_master import DpSlaveDesc
-			slaveDesc = DpSlaveDesc(gsd=self.gsd,
+			slaveDesc = DpSlaveDesc(gsd=self._getDpGsd(),
 						slaveAddr=self.addr,
 						slaveConf=self)
 			slaveDesc.index = self.index
 			slaveDesc.name = self.name
 
 			# Create Chk_Cfg telegram
-			slaveDesc.setCfgDataElements(self.gsd.getCfgDataElements())
+			cfgDataElements = self.cfgDataElements
+			if cfgDataElements is None:
+				cfgDataElements = self.gsd.getCfgDataElements()
+			slaveDesc.setCfgDataElements(cfgDataElements)
 
 			# Set User_Prm_Data
-			slaveDesc.setUserPrmData(self.gsd.getUserPrmData())
+			userPrmData = self.userPrmData
+			if userPrmData is None:
+				userPrmData = self.gsd.getUserPrmData()
+			slaveDesc.setUserPrmData(userPrmData)
 
 			# Set various standard parameters
 			slaveDesc.setSyncMode(self.syncMode)
@@ -76,6 +124,31 @@ class PbConf(object):
 
 			return slaveDesc
 
+	class _SnapshotSlaveConf(_SlaveConf):
+		"""Slave configuration loaded from a snapshot.
+		The GSD field tree is only decoded and the modules are only
+		configured on the first access of gsd. The DpSlaveDesc gets
+		a GsdInterp that only contains the fields in SNAPSHOT_GSD_FIELDS.
+		"""
+		gsdCore		= None
+		_gsdLoader	= None
+		__gsd		= None
+
+		@property
+		def gsd(self):
+			gsd = self.__gsd
+			if gsd is None:
+				gsd = self._gsdLoader(self.gsdName).newView()
+				for moduleName in self.moduleNames:
+					gsd.setConfiguredModule(moduleName)
+				self.__gsd = gsd
+			return gsd
+
+		def _getDpGsd(self):
+			return self.gsdCore
+
+	# The selected line name. None = no line selected.
+	line		= None
 	# [PROFIBUS] section
 	debug		= None
 	# [PHY] section
@@ -87,25 +160,113 @@ class PbConf(object):
 	phySpiBus	= None
 	phySpiCS	= None
 	phySpiSpeedHz	= None
+	phyReplayTimeScale = None
+	phyReplayMode	= None
 	# [DP] section
 	dpMasterClass	= None
 	dpMasterAddr	= None
+	dpMultiMaster	= None
+	dpTtr		= None
+	dpHsa		= None
+	dpGapFactor	= None
 	# [SLAVE_xxx] sections
 	slaveConfs	= None
 
+	# The names of the configuration file and the GSD files
+	# that have been read.
+	sourceFiles	= None
+
+	SNAPSHOT_MAGIC	= b"PBCONF\x00\x02"
+
+	# The GSD fields used by the DP master.
+	# These are available without decoding the full GSD of a snapshot.
+	SNAPSHOT_GSD_FIELDS = re.compile(r'^(?:Ident_Number|MaxTsdr_.+)$')
+
+	# The attributes stored in a snapshot.
+	__snapshotAttrs = (
+		"line",
+		"debug",
+		"phyType", "phyDev", "phyBaud", "phyRtsCts", "phyDsrDtr",
+		"phySpiBus", "phySpiCS", "phySpiSpeedHz", "phyReplayTimeScale",
+		"phyReplayMode",
+		"dpMasterClass", "dpMasterAddr",
+		"dpMultiMaster", "dpTtr", "dpHsa", "dpGapFactor",
+	)
+	__snapshotSlaveAttrs = (
+		"index", "name", "addr",
+		"syncMode", "freezeMode", "groupMask", "watchdogMs",
+		"inputSize", "outputSize",
+		"gsdName", "moduleNames",
+	)
+
 	@classmethod
-	def fromFile(cls, filename):
+	def fromFile(cls, filename, parallel=False, line=None):
 		if isPy2Compat:
 			with open(filename, "r") as fd:
-				return cls(fd, filename)
+				return cls(fd, filename, parallel, line)
 		else:
 			with open(filename, "r", encoding="UTF-8") as fd:
-				return cls(fd, filename)
+				return cls(fd, filename, parallel, line)
+
+	@classmethod
+	def getLineNames(cls, filename):
+		"""Get the names of the lines that are defined
+		in the configuration file, in the order of appearance.
+		"""
+		try:
+			p = _ConfigParser()
+			if isPy2Compat:
+				with open(filename, "r") as fd:
+					p.readfp(fd, filename)
+			else:
+				with open(filename, "r", encoding="UTF-8") as fd:
+					p.read_file(fd, filename)
+		except (IOError, UnicodeError) as e:
+			raise PbConfError("Failed to read '%s': %s" %\
+				(filename, str(e)))
+		except _ConfigParserError as e:
+			raise PbConfError("Profibus config file parse "
+				"error:\n%s" % str(e))
+		lines = []
+		for section in p.sections():
+			m = cls.__reLine.match(section)
+			if m and m.group(2) not in lines:
+				lines.append(m.group(2))
+		return lines
 
 	__reSlave = re.compile(r'^SLAVE_(\d+)$')
 	__reMod = re.compile(r'^module_(\d+)$')
+	__reLine = re.compile(r'^(.+)@(.+)$')
 
-	def __init__(self, fd, filename=None):
+	@classmethod
+	def __selectLine(cls, p, line):
+		"""Replace the sections without suffix by the sections
+		of the line. Remove the sections of all other lines.
+		"""
+		found = False
+		for section in p.sections():
+			m = cls.__reLine.match(section)
+			if not m:
+				continue
+			name, sectionLine = m.group(1), m.group(2)
+			if sectionLine == line:
+				found = True
+				items = p.items(section, raw=True)
+				if p.has_section(name):
+					p.remove_section(name)
+				p.add_section(name)
+				for option, value in items:
+					p.set(name, option, value)
+			p.remove_section(section)
+		if not found:
+			raise ValueError("Line '%s' is not defined." % line)
+
+	def __init__(self, fd, filename=None, parallel=False, line=None):
+		"""Parse the configuration from the file object fd.
+		If parallel is True, distinct GSD files are parsed
+		in parallel worker processes.
+		line: The name of the line to select. None = no line.
+		"""
 		def get(section, option, fallback = None):
 			if p.has_option(section, option):
 				return p.get(section, option)
@@ -127,6 +288,13 @@ class PbConf(object):
 				raise ValueError("Option [%s] '%s' does not exist." % (
 					section, option))
 			return fallback
+		def getfloat(section, option, fallback = None):
+			if p.has_option(section, option):
+				return p.getfloat(section, option)
+			if fallback is None:
+				raise ValueError("Option [%s] '%s' does not exist." % (
+					section, option))
+			return fallback
 		try:
 			p = _ConfigParser()
 			if hasattr(p, "read_file"):
@@ -134,6 +302,10 @@ class PbConf(object):
 			else:
 				p.readfp(fd, filename)
 
+			self.line = line
+			if line is not None:
+				self.__selectLine(p, line)
+
 			# [PROFIBUS]
 			self.debug = getint("PROFIBUS", "debug",
 					    fallback=0)
@@ -155,6 +327,10 @@ class PbConf(object):
 					       fallback=0)
 			self.phySpiSpeedHz = getint("PHY", "spiSpeedHz",
 						    fallback=1000000)
+			self.phyReplayTimeScale = getfloat("PHY", "replayTimeScale",
+							   fallback=1.0)
+			self.phyReplayMode = get("PHY", "replayMode",
+						 fallback="receive")
 
 			# [DP]
 			self.dpMasterClass = getint("DP", "master_class",
@@ -165,8 +341,29 @@ class PbConf(object):
 						   fallback=0x02)
 			if self.dpMasterAddr < 0 or self.dpMasterAddr > 127:
 				raise ValueError("Invalid master_addr")
+			self.dpMultiMaster = getboolean("DP", "multi_master",
+							fallback=False)
+			self.dpTtr = getint("DP", "ttr",
+					    fallback=50000)
+			if self.dpTtr <= 0:
+				raise ValueError("Invalid ttr")
+			self.dpHsa = getint("DP", "hsa",
+					    fallback=126)
+			if self.dpHsa < self.dpMasterAddr or self.dpHsa > 126:
+				raise ValueError("Invalid hsa")
+			self.dpGapFactor = getint("DP", "gap_factor",
+						  fallback=10)
+			if self.dpGapFactor < 1 or self.dpGapFactor > 100:
+				raise ValueError("Invalid gap_factor")
 
+			self.sourceFiles = [ filename ] if filename else []
 			self.slaveConfs = []
+			gsds = {}
+			if parallel:
+				self.__loadGsdsParallel(
+					[ get(section, "gsd") for section in p.sections()
+					  if self.__reSlave.match(section) ],
+					gsds)
 			for section in p.sections():
 				m = self.__reSlave.match(section)
 				if not m:
@@ -176,17 +373,8 @@ class PbConf(object):
 				s.index = index
 				s.name = get(section, "name", section)
 				s.addr = getint(section, "addr")
-				try:
-					s.gsd = GsdInterp.fromFile(
-						get(section, "gsd"),
-						debug=(self.debug > 0))
-				except GsdError as origExc:
-					try:
-						s.gsd = GsdInterp.fromPy(
-							get(section, "gsd").replace(".", "_"),
-							debug=(self.debug > 0))
-					except GsdError as e:
-						raise GsdError("%s\n%s" % (str(origExc), str(e)))
+				s.gsdName = get(section, "gsd")
+				s.gsd = self.__loadGsd(s.gsdName, gsds).newView()
 				s.syncMode = getboolean(section, "sync_mode",
 							fallback=False)
 				s.freezeMode = getboolean(section, "freeze_mode",
@@ -209,9 +397,11 @@ class PbConf(object):
 				mods = [ o for o in p.options(section)
 					 if self.__reMod.match(o) ]
 				mods.sort(key = lambda o: self.__reMod.match(o).group(1))
+				s.moduleNames = []
 				if s.gsd.isModular():
 					for option in mods:
-						s.gsd.setConfiguredModule(get(section, option))
+						s.moduleNames.append(get(section, option))
+						s.gsd.setConfiguredModule(s.moduleNames[-1])
 				elif mods:
 					print("Warning: Some modules are specified in the config file, "
 					      "but the station is 'Compact': Modular_Station=0.",
@@ -228,6 +418,193 @@ class PbConf(object):
 		except GsdError as e:
 			raise PbConfError("Failed to parse GSD file:\n%s" % str(e))
 
+	def __loadGsd(self, gsdName, gsds):
+		"""Load a GSD file.
+		Each file is only parsed once. gsds is the dict of loaded GSDs.
+		The returned GsdInterp must not be modified. Use newView().
+		"""
+		gsd = gsds.get(gsdName)
+		if gsd is None:
+			try:
+				gsd = GsdInterp.fromFile(gsdName,
+							 debug=(self.debug > 0))
+				self.sourceFiles.append(gsdName)
+			except GsdError as origExc:
+				try:
+					gsd = GsdInterp.fromPy(gsdName.replace(".", "_"),
+							       debug=(self.debug > 0))
+				except GsdError as e:
+					raise GsdError("%s\n%s" % (str(origExc), str(e)))
+			gsds[gsdName] = gsd
+		return gsd
+
+	def __loadGsdsParallel(self, gsdNames, gsds):
+		"""Parse the GSD files gsdNames in parallel and add them to gsds.
+		Files that fail to parse are skipped here.
+		They are loaded and reported sequentially later.
+		"""
+		if ProcessPoolExecutor is None:
+			return
+		names = []
+		for gsdName in gsdNames:
+			if gsdName not in gsds and gsdName not in names:
+				names.append(gsdName)
+		if len(names) < 2:
+			return
+		try:
+			with ProcessPoolExecutor() as executor:
+				results = list(executor.map(_parseGsdFields, names))
+		except (OSError, RuntimeError):
+			return
+		for gsdName, fields in zip(names, results):
+			if fields is None:
+				continue
+			gsds[gsdName] = GsdInterp(GsdCache.decode(fields),
+						  gsdName, (self.debug > 0))
+			self.sourceFiles.append(gsdName)
+
+	@staticmethod
+	def __fileInfo(filename, withHash=True):
+		st = os.stat(filename)
+		mtime = getattr(st, "st_mtime_ns", st[8])
+		size = st[6]
+		digest = None
+		if withHash:
+			with open(filename, "rb") as fd:
+				digest = hashlib.sha256(fd.read()).hexdigest()
+		return (filename, mtime, size, digest)
+
+	def toSnapshot(self, snapshotFile):
+		"""Write a binary snapshot of this configuration to snapshotFile.
+		The snapshot contains the resolved slave configurations,
+		including the Chk_Cfg and User_Prm_Data. Load it with fromSnapshot().
+		"""
+		if marshal is None:
+			raise PbConfError("Configuration snapshots are not "
+					  "supported on this platform.")
+		try:
+			gsds = {}
+			gsdCores = {}
+			slaves = []
+			for s in self.slaveConfs:
+				fields = s.gsd.getFields()
+				# Nested marshal data. It is only decoded on demand.
+				gsds[s.gsdName] = marshal.dumps(GsdCache.encode(fields))
+				gsdCores[s.gsdName] = {
+					name : value
+					for name, value in fields.items()
+					if self.SNAPSHOT_GSD_FIELDS.match(name)
+				}
+				slave = { name : getattr(s, name)
+					  for name in self.__snapshotSlaveAttrs }
+				slave["cfgDataElements"] = [
+					(e.identifier, bytes(e.lengthBytes))
+					for e in s.gsd.getCfgDataElements()
+				]
+				slave["userPrmData"] = bytes(s.gsd.getUserPrmData())
+				slaves.append(slave)
+			snapshot = {
+				"version"	: VERSION_STRING,
+				"sources"	: [ self.__fileInfo(os.path.abspath(f))
+						    for f in self.sourceFiles ],
+				"conf"		: { name : getattr(self, name)
+						    for name in self.__snapshotAttrs },
+				"gsds"		: gsds,
+				"gsdCores"	: gsdCores,
+				"slaves"	: slaves,
+			}
+			with open(snapshotFile, "wb") as fd:
+				fd.write(self.SNAPSHOT_MAGIC)
+				fd.write(marshal.dumps(snapshot))
+		except (IOError, OSError, ValueError) as e:
+			raise PbConfError("Failed to write snapshot '%s': %s" % (
+				snapshotFile, str(e)))
+
+	@classmethod
+	def __checkSources(cls, snapshotFile, sources):
+		"""Raise PbConfError, if a source file of the snapshot
+		is missing or has been modified.
+		"""
+		for filename, mtime, size, digest in sources:
+			try:
+				info = cls.__fileInfo(filename, withHash=False)
+				if info[1:3] == (mtime, size) or\
+				   cls.__fileInfo(filename)[3] == digest:
+					continue
+				reason = "'%s' has been modified" % filename
+			except (IOError, OSError) as e:
+				reason = "'%s' is not readable: %s" % (
+					filename, str(e))
+			raise PbConfError("Snapshot '%s' is outdated: %s" % (
+				snapshotFile, reason))
+
+	@classmethod
+	def fromSnapshot(cls, snapshotFile, validate=True):
+		"""Load a configuration snapshot created by toSnapshot().
+		If validate is True, the source files of the snapshot are
+		checked for modifications. A file with changed mtime or size
+		is compared by its SHA-256 hash.
+		Raises PbConfError, if the snapshot is invalid or outdated.
+		"""
+		if marshal is None:
+			raise PbConfError("Configuration snapshots are not "
+					  "supported on this platform.")
+		try:
+			with open(snapshotFile, "rb") as fd:
+				data = fd.read()
+			if not data.startswith(cls.SNAPSHOT_MAGIC):
+				raise ValueError("Invalid file format")
+			snapshot = marshal.loads(data[len(cls.SNAPSHOT_MAGIC):])
+			if snapshot["version"] != VERSION_STRING:
+				raise ValueError("Snapshot was created by pyprofibus %s" % (
+					snapshot["version"]))
+			if validate:
+				cls.__checkSources(snapshotFile, snapshot["sources"])
+
+			self = cls.__new__(cls)
+			for name, value in snapshot["conf"].items():
+				setattr(self, name, value)
+			self.sourceFiles = [ src[0] for src in snapshot["sources"] ]
+			debug = (self.debug > 0)
+			encodedGsds = snapshot["gsds"]
+			gsds = {}
+
+			def loadGsd(gsdName):
+				gsd = gsds.get(gsdName)
+				if gsd is None:
+					fields = GsdCache.decode(marshal.loads(
+						encodedGsds[gsdName]))
+					gsd = gsds[gsdName] = GsdInterp(fields,
+									gsdName, debug)
+				return gsd
+
+			gsdCores = {
+				gsdName : GsdInterp(fields, gsdName, debug)
+				for gsdName, fields in snapshot["gsdCores"].items()
+			}
+			self.slaveConfs = []
+			for slave in snapshot["slaves"]:
+				s = self._SnapshotSlaveConf()
+				for name in cls.__snapshotSlaveAttrs:
+					setattr(s, name, slave[name])
+				s.gsdCore = gsdCores[s.gsdName]
+				s._gsdLoader = loadGsd
+				s.cfgDataElements = [ DpCfgDataElement(identifier, lengthBytes)
+						      for identifier, lengthBytes
+						      in slave["cfgDataElements"] ]
+				s.userPrmData = slave["userPrmData"]
+				self.slaveConfs.append(s)
+		except (IOError, OSError) as e:
+			raise PbConfError("Failed to read snapshot '%s': %s" % (
+				snapshotFile, str(e)))
+		except (EOFError, ValueError, TypeError, KeyError) as e:
+			raise PbConfError("Invalid snapshot '%s': %s" % (
+				snapshotFile, str(e)))
+		except GsdError as e:
+			raise PbConfError("Invalid GSD in snapshot '%s': %s" % (
+				snapshotFile, str(e)))
+		return self
+
 	def makePhy(self):
 		"""Create a CP-PHY instance based on the configuration.
 		"""
@@ -241,6 +618,9 @@ class PbConf(object):
 		elif phyType == "fpga":
 			import pyprofibus.phy_fpga
 			phyClass = pyprofibus.phy_fpga.CpPhyFPGA
+		elif phyType == "replay":
+			import pyprofibus.phy_replay
+			phyClass = pyprofibus.phy_replay.CpPhyReplay
 		else:
 			raise PbConfError("Invalid phyType parameter value: "
 					  "%s" % self.phyType)
@@ -248,7 +628,9 @@ class PbConf(object):
 			       port=self.phyDev,
 			       spiBus=self.phySpiBus,
 			       spiCS=self.phySpiCS,
-			       spiSpeedHz=self.phySpiSpeedHz)
+			       spiSpeedHz=self.phySpiSpeedHz,
+			       timeScale=self.phyReplayTimeScale,
+			       replayMode=self.phyReplayMode.lower().strip())
 		phy.setConfig(baudrate=self.phyBaud,
 			      rtscts=self.phyRtsCts,
 			      dsrdtr=self.phyDsrDtr)
@@ -274,4 +656,8 @@ class PbConf(object):
 		master = DpMasterClass(phy=phy,
 				       masterAddr=self.dpMasterAddr,
 				       debug=(self.debug >= 1))
+		if self.dpMultiMaster:
+			master.enableTokenRing(ttrBits=self.dpTtr,
+					       hsa=self.dpHsa,
+					       gapFactor=self.dpGapFactor)
 		return master
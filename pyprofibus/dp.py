@@ -22,6 +22,8 @@ __all__ = [
 	"DpTelegram_DataExchange_Con",
 	"DpTelegram_SlaveDiag_Req",
 	"DpTelegram_SlaveDiag_Con",
+	"DpChannelDiag",
+	"DpSlaveDiag",
 	"DpTelegram_SetPrm_Req",
 	"DpCfgDataElement",
 	"DpTelegram_ChkCfg_Req",
@@ -37,32 +39,52 @@ class DpError(ProfibusError):
 class DpTransceiver(object):
 	__slots__ = (
 		"fdlTrans",
+		"lazyDecode",
 		"thisIsMaster",
 	)
 
-	def __init__(self, fdlTrans, thisIsMaster):
+	def __init__(self, fdlTrans, thisIsMaster, lazyDecode=False):
+		"""lazyDecode => If True, poll() does not decode the DP layer.
+		                 It returns the plain FdlTelegram instead.
+		                 The DP telegram can be decoded later
+		                 on demand with decode().
+		"""
 		self.fdlTrans = fdlTrans
 		self.thisIsMaster = thisIsMaster
+		self.lazyDecode = lazyDecode
+
+	def decode(self, fdlTelegram):
+		"""Decode the DP telegram from an FdlTelegram.
+		Telegrams without DP layer (token, short ACK) are returned as-is.
+		Returns None, if the telegram type is unknown.
+		"""
+		if fdlTelegram.sd in (FdlTelegram.SD1,
+				      FdlTelegram.SD2,
+				      FdlTelegram.SD3,):
+			return DpTelegram.fromFdlTelegram(
+					fdlTelegram, self.thisIsMaster)
+		elif fdlTelegram.sd in (FdlTelegram.SC,
+					FdlTelegram.SD4,):
+			return fdlTelegram
+		return None
 
 	def poll(self, timeout=0.0):
 		retTelegram = None
 		ok, fdlTelegram = self.fdlTrans.poll(timeout)
 		if ok and fdlTelegram:
-			if fdlTelegram.sd in (FdlTelegram.SD1,
-					      FdlTelegram.SD2,
-					      FdlTelegram.SD3,):
-				retTelegram = DpTelegram.fromFdlTelegram(
-						fdlTelegram, self.thisIsMaster)
-			elif fdlTelegram.sd in (FdlTelegram.SC,
-						FdlTelegram.SD4,):
+			if self.lazyDecode:
 				retTelegram = fdlTelegram
 			else:
-				ok = False
+				retTelegram = self.decode(fdlTelegram)
+				if retTelegram is None:
+					ok = False
 		return (ok, retTelegram)
 
 	# Send a DpTelegram.
-	def send(self, fcb, telegram):
-		self.fdlTrans.send(fcb, telegram.toFdlTelegram())
+	# Returns the size of the encoded telegram, in octets.
+	def send(self, fcb, telegram, replyTimeout=None):
+		return self.fdlTrans.send(fcb, telegram.toFdlTelegram(),
+					  replyTimeout=replyTimeout)
 
 class DpTelegram(object):
 	# Source Service Access Point number
@@ -248,6 +270,17 @@ class DpTelegram_DataExchange_Con(_DataExchange_Common):
 		_DataExchange_Common.__init__(self,
 			da=da, sa=sa, fc=fc, du=du)
 
+	@staticmethod
+	def checkFdlType(fdl):
+		"""Returns True, if the FdlTelegram is a Data_Exchange reply.
+		This is a cheap check that does not decode the DP telegram.
+		"""
+		fc = fdl.fc
+		return (fc is not None and
+			not (fc & FdlTelegram.FC_REQ) and
+			not fdl.dae and
+			not fdl.sae)
+
 class DpTelegram_SlaveDiag_Req(DpTelegram):
 	__slots__ = (
 	)
@@ -299,6 +332,7 @@ class DpTelegram_SlaveDiag_Con(DpTelegram):
 		"b2",
 		"masterAddr",
 		"identNumber",
+		"extDiag",
 	)
 
 	def __init__(self, da, sa, fc=FdlTelegram.FC_DL,
@@ -311,11 +345,13 @@ class DpTelegram_SlaveDiag_Con(DpTelegram):
 		self.b2 = 0
 		self.masterAddr = 255
 		self.identNumber = 0
+		self.extDiag = b""
 
 	def __repr__(self):
 		return ("DpTelegram_SlaveDiag_Con(da=%s, sa=%s, fc=%s, "
 			"dsap=%s, ssap=%s, "
-			"b0=%s, b1=%s, b2=%s, masterAddr=%s, identNumber=%s)" % (
+			"b0=%s, b1=%s, b2=%s, masterAddr=%s, identNumber=%s, "
+			"extDiag=%s)" % (
 			intToHex(self.da),
 			intToHex(self.sa),
 			intToHex(self.fc),
@@ -325,7 +361,8 @@ class DpTelegram_SlaveDiag_Con(DpTelegram):
 			intToHex(self.b1),
 			intToHex(self.b2),
 			intToHex(self.masterAddr),
-			intToHex(self.identNumber)))
+			intToHex(self.identNumber),
+			bytesToHex(self.extDiag)))
 
 	@classmethod
 	def fromFdlTelegram(cls, fdl):
@@ -335,22 +372,36 @@ class DpTelegram_SlaveDiag_Con(DpTelegram):
 			 dsap=cls.extractSAP(fdl.dae),
 			 ssap=cls.extractSAP(fdl.sae))
 		try:
-			dp.b0 = fdl.du[0]
-			dp.b1 = fdl.du[1]
-			dp.b2 = fdl.du[2]
-			dp.masterAddr = fdl.du[3]
-			dp.identNumber = (fdl.du[4] << 8) | fdl.du[5]
-		except IndexError:
+			du = fdl.du
+			dp.b0 = du[0]
+			dp.b1 = du[1]
+			dp.b2 = du[2]
+			dp.masterAddr = du[3]
+			dp.identNumber = (du[4] << 8) | du[5]
+			dp.extDiag = du[6:]
+		except (IndexError, TypeError):
 			raise DpError("Invalid Slave_Diag telegram format")
 		return dp
 
 	def getDU(self):
-		return bytearray((self.b0,
-				  self.b1,
-				  self.b2,
-				  self.masterAddr,
-				  (self.identNumber >> 8) & 0xFF,
-				  self.identNumber & 0xFF))
+		du = bytearray((self.b0,
+				self.b1,
+				self.b2,
+				self.masterAddr,
+				(self.identNumber >> 8) & 0xFF,
+				self.identNumber & 0xFF))
+		du.extend(self.extDiag)
+		return du
+
+	def getDiag(self):
+		"""Get the decoded diagnosis as DpSlaveDiag instance.
+		"""
+		return DpSlaveDiag(b0=self.b0,
+				   b1=self.b1,
+				   b2=self.b2,
+				   masterAddr=self.masterAddr,
+				   identNumber=self.identNumber,
+				   extDiag=self.extDiag)
 
 	def notExist(self):
 		return (self.b0 & self.B0_STANOEX) != 0
@@ -391,6 +442,233 @@ class DpTelegram_SlaveDiag_Con(DpTelegram):
 				    self.B0_PRMFLT)) == 0 and
 			(self.b1 & (self.B1_PRMREQ)) == 0)
 
+class DpChannelDiag(object):
+	"""Channel related extended diagnosis.
+	"""
+
+	# I/O type
+	IO_RESERVED		= 0x00
+	IO_INPUT		= 0x01
+	IO_OUTPUT		= 0x02
+	IO_INOUT		= 0x03
+
+	# Error type
+	ERR_SHORT		= 1	# Short circuit
+	ERR_UNDERVOLT		= 2	# Undervoltage
+	ERR_OVERVOLT		= 3	# Overvoltage
+	ERR_OVERLOAD		= 4	# Overload
+	ERR_OVERTEMP		= 5	# Overtemperature
+	ERR_LINEBREAK		= 6	# Line break
+	ERR_UPPERLIM		= 7	# Upper limit value exceeded
+	ERR_LOWERLIM		= 8	# Lower limit value exceeded
+	ERR_ERROR		= 9	# Error
+
+	err2name = {
+		ERR_SHORT	: "short circuit",
+		ERR_UNDERVOLT	: "undervoltage",
+		ERR_OVERVOLT	: "overvoltage",
+		ERR_OVERLOAD	: "overload",
+		ERR_OVERTEMP	: "overtemperature",
+		ERR_LINEBREAK	: "line break",
+		ERR_UPPERLIM	: "upper limit value exceeded",
+		ERR_LOWERLIM	: "lower limit value exceeded",
+		ERR_ERROR	: "error",
+	}
+
+	__slots__ = (
+		"identIndex",
+		"channel",
+		"ioType",
+		"dataType",
+		"errorType",
+	)
+
+	def __init__(self, identIndex, channel, ioType, dataType, errorType):
+		self.identIndex = identIndex	# Index of the Cfg identifier (module)
+		self.channel = channel		# Channel number
+		self.ioType = ioType		# IO_...
+		self.dataType = dataType	# Channel data type
+		self.errorType = errorType	# ERR_...
+
+	def __eq__(self, other):
+		return (isinstance(other, DpChannelDiag) and
+			self.identIndex == other.identIndex and
+			self.channel == other.channel and
+			self.ioType == other.ioType and
+			self.dataType == other.dataType and
+			self.errorType == other.errorType)
+
+	def __ne__(self, other):
+		return not self.__eq__(other)
+
+	__hash__ = None
+
+	def __repr__(self):
+		return ("DpChannelDiag(identIndex=%d, channel=%d, "
+			"ioType=%d, dataType=%d, errorType=%d)" % (
+			self.identIndex, self.channel,
+			self.ioType, self.dataType, self.errorType))
+
+	def __str__(self):
+		return "module %d, channel %d: %s" % (
+			self.identIndex, self.channel,
+			self.err2name.get(self.errorType,
+					  "error type %d" % self.errorType))
+
+class DpSlaveDiag(object):
+	"""Decoded Slave_Diag diagnosis data.
+	The station status bytes 1-3 are combined into one status word.
+	The extended diagnosis blocks are decoded in one pass.
+	"""
+
+	# Status word bits
+	STA_STANOEX	= DpTelegram_SlaveDiag_Con.B0_STANOEX
+	STA_STANORDY	= DpTelegram_SlaveDiag_Con.B0_STANORDY
+	STA_CFGFLT	= DpTelegram_SlaveDiag_Con.B0_CFGFLT
+	STA_EXTDIAG	= DpTelegram_SlaveDiag_Con.B0_EXTDIAG
+	STA_NOSUPP	= DpTelegram_SlaveDiag_Con.B0_NOSUPP
+	STA_INVALSR	= DpTelegram_SlaveDiag_Con.B0_INVALSR
+	STA_PRMFLT	= DpTelegram_SlaveDiag_Con.B0_PRMFLT
+	STA_MLOCK	= DpTelegram_SlaveDiag_Con.B0_MLOCK
+	STA_PRMREQ	= DpTelegram_SlaveDiag_Con.B1_PRMREQ << 8
+	STA_SDIAG	= DpTelegram_SlaveDiag_Con.B1_SDIAG << 8
+	STA_ONE		= DpTelegram_SlaveDiag_Con.B1_ONE << 8
+	STA_WD		= DpTelegram_SlaveDiag_Con.B1_WD << 8
+	STA_FREEZE	= DpTelegram_SlaveDiag_Con.B1_FREEZE << 8
+	STA_SYNC	= DpTelegram_SlaveDiag_Con.B1_SYNC << 8
+	STA_DEAC	= DpTelegram_SlaveDiag_Con.B1_DEAC << 8
+	STA_EXTDIAGOVR	= DpTelegram_SlaveDiag_Con.B2_EXTDIAGOVR << 16
+
+	STA_MASK_NOTREADY = (STA_STANOEX | STA_STANORDY |
+			     STA_CFGFLT | STA_PRMFLT | STA_PRMREQ)
+	STA_MASK_NEWPRMCFG = STA_CFGFLT | STA_PRMFLT | STA_PRMREQ
+
+	# Extended diagnosis block header
+	EXT_TYPE_MASK	= 0xC0
+	EXT_DEVICE	= 0x00	# Device related diagnosis
+	EXT_IDENT	= 0x40	# Identifier related diagnosis
+	EXT_CHANNEL	= 0x80	# Channel related diagnosis
+	EXT_REVISION	= 0xC0	# DPv1 revision number
+	EXT_LEN_MASK	= 0x3F
+
+	__slots__ = (
+		"status",
+		"masterAddr",
+		"identNumber",
+		"extDiag",
+		"deviceDiag",
+		"identDiag",
+		"channelDiag",
+		"revision",
+	)
+
+	def __init__(self, b0=0, b1=0, b2=0, masterAddr=255, identNumber=0,
+		     extDiag=b""):
+		self.status = b0 | (b1 << 8) | (b2 << 16)
+		self.masterAddr = masterAddr
+		self.identNumber = identNumber
+		self.extDiag = bytes(extDiag)
+		self.deviceDiag = ()	# Tuple of device related diag bytes
+		self.identDiag = ()	# Tuple of identifier indexes with diag
+		self.channelDiag = ()	# Tuple of DpChannelDiag
+		self.revision = None	# DPv1 revision number
+		if extDiag:
+			self.__parseExtDiag(bytearray(extDiag))
+
+	def __parseExtDiag(self, ext):
+		deviceDiag, identDiag, channelDiag = [], [], []
+		extLen = len(ext)
+		i = 0
+		while i < extLen:
+			header = ext[i]
+			blockType = header & self.EXT_TYPE_MASK
+			if blockType == self.EXT_CHANNEL:
+				if i + 3 > extLen:
+					break # Truncated
+				chan, err = ext[i + 1], ext[i + 2]
+				channelDiag.append(DpChannelDiag(
+					identIndex=header & self.EXT_LEN_MASK,
+					channel=chan & 0x3F,
+					ioType=(chan >> 6) & 3,
+					dataType=(err >> 5) & 7,
+					errorType=err & 0x1F))
+				i += 3
+			elif blockType == self.EXT_REVISION:
+				self.revision = header & self.EXT_LEN_MASK
+				i += 1
+			else:
+				blockLen = header & self.EXT_LEN_MASK
+				if blockLen < 1 or i + blockLen > extLen:
+					break # Invalid or truncated
+				block = ext[i + 1 : i + blockLen]
+				if blockType == self.EXT_IDENT:
+					identDiag.extend(
+						bitNr
+						for bitNr in range(len(block) * 8)
+						if block[bitNr // 8] & (1 << (bitNr % 8)))
+				else:
+					deviceDiag.append(bytes(block))
+				i += blockLen
+		self.deviceDiag = tuple(deviceDiag)
+		self.identDiag = tuple(identDiag)
+		self.channelDiag = tuple(channelDiag)
+
+	def __eq__(self, other):
+		return (isinstance(other, DpSlaveDiag) and
+			self.status == other.status and
+			self.masterAddr == other.masterAddr and
+			self.identNumber == other.identNumber and
+			self.extDiag == other.extDiag)
+
+	def __ne__(self, other):
+		return not self.__eq__(other)
+
+	__hash__ = None
+
+	def __repr__(self):
+		return ("DpSlaveDiag(status=%s, masterAddr=%s, identNumber=%s, "
+			"extDiag=%s)" % (
+			intToHex(self.status),
+			intToHex(self.masterAddr),
+			intToHex(self.identNumber),
+			bytesToHex(self.extDiag)))
+
+	def notExist(self):
+		return (self.status & self.STA_STANOEX) != 0
+
+	def notReady(self):
+		return (self.status & self.STA_STANORDY) != 0
+
+	def cfgFault(self):
+		return (self.status & self.STA_CFGFLT) != 0
+
+	def hasExtDiag(self):
+		return (self.status & self.STA_EXTDIAG) != 0
+
+	def isNotSupp(self):
+		return (self.status & self.STA_NOSUPP) != 0
+
+	def prmFault(self):
+		return (self.status & self.STA_PRMFLT) != 0
+
+	def masterLock(self):
+		return (self.status & self.STA_MLOCK) != 0
+
+	def hasOnebit(self):
+		return (self.status & self.STA_ONE) != 0
+
+	def prmReq(self):
+		return (self.status & self.STA_PRMREQ) != 0
+
+	def extDiagOverflow(self):
+		return (self.status & self.STA_EXTDIAGOVR) != 0
+
+	def needsNewPrmCfg(self):
+		return (self.status & self.STA_MASK_NEWPRMCFG) != 0
+
+	def isReadyDataEx(self):
+		return (self.status & self.STA_MASK_NOTREADY) == 0
+
 class DpTelegram_SetPrm_Req(DpTelegram):
 	# Station status
 	STA_WD			= 0x08	# WD_On
@@ -19,11 +19,127 @@ import gc
 import math
 
 __all__ = [
+	"DpReplyTimeout",
+	"DpDiagEvent",
 	"DpSlaveDesc",
+	"DpStationInfo",
 	"DPM1",
 	"DPM2",
 ]
 
+class DpReplyTimeout(object):
+	"""Adaptive reply timeout of one slave.
+
+	Until enough replies have been observed, the reply wait time is
+	the GSD max-tSDR of the baud rate, but at least the slot time.
+	Then it is the LATENCY_PERCENTILE of the observed reply latencies
+	times SAFETY_FACTOR. The latency is the time from the end of the
+	request to the end of the reply, minus the on-wire time of the reply.
+	The reply time is the wait time plus the on-wire time of the longest
+	observed reply. The timeout is the reply time plus the on-wire time
+	of the request.
+	Each missing reply doubles the reply time, until a reply is received.
+	"""
+
+	SAMPLES			= 64	# Number of latency samples kept.
+	MIN_SAMPLES		= 8	# Samples needed before adapting.
+	LATENCY_PERCENTILE	= 99
+	SAFETY_FACTOR		= 2.0
+	MAX_BACKOFF		= 8
+
+	__slots__ = (
+		"phy",
+		"gsd",
+		"backoff",
+		"__staticWait",
+		"__latencies",
+		"__latencyIndex",
+		"__learnedWait",
+		"__newSamples",
+		"__replyOctets",
+	)
+
+	def __init__(self, phy, gsd):
+		self.phy = phy
+		self.gsd = gsd
+		self.backoff = 0
+		self.__staticWait = None
+		# Ring buffer of the last SAMPLES latencies.
+		self.__latencies = []
+		self.__latencyIndex = 0
+		self.__learnedWait = None
+		self.__newSamples = 0
+		# Longest observed reply. Start with the longest possible one.
+		self.__replyOctets = 255
+
+	def __getStaticWait(self):
+		wait = self.__staticWait
+		if wait is None:
+			phy = self.phy
+			wait = phy.getSlotTime()
+			baudrate = phy.getBaudrate()
+			if self.gsd is not None and baudrate:
+				try:
+					maxTsdr = self.gsd.getMaxTSDR(baudrate)
+				except ProfibusError:
+					maxTsdr = None
+				if maxTsdr:
+					wait = max(wait, maxTsdr / baudrate)
+			self.__staticWait = wait
+		return wait
+
+	def getReplyTime(self, maxTimeout):
+		"""Get the time to wait for the reply after the
+		end of the request, in seconds. It is limited to maxTimeout.
+		"""
+		wait = self.__learnedWait
+		if wait is None:
+			wait = self.__getStaticWait()
+		replyTime = self.phy.getTransferTime(self.__replyOctets) + wait
+		return min(maxTimeout, replyTime * (1 << self.backoff))
+
+	def get(self, requestOctets, maxTimeout):
+		"""Get the reply timeout, in seconds, of a request
+		with requestOctets. The timeout is limited to maxTimeout.
+		"""
+		return min(maxTimeout,
+			   self.phy.getTransferTime(requestOctets) +
+			   self.getReplyTime(maxTimeout))
+
+	def replyReceived(self, duration, requestOctets, replyOctets):
+		"""A reply has been received.
+		duration: The time from the start of the request to the
+		          reception of the reply, in seconds.
+		"""
+		self.backoff = 0
+		if self.__learnedWait is None or replyOctets > self.__replyOctets:
+			self.__replyOctets = replyOctets
+		latency = duration - self.phy.getTransferTime(requestOctets +
+							      replyOctets)
+		latencies = self.__latencies
+		latency = max(0.0, latency)
+		if len(latencies) < self.SAMPLES:
+			latencies.append(latency)
+		else:
+			latencies[self.__latencyIndex] = latency
+			self.__latencyIndex = (self.__latencyIndex + 1) % self.SAMPLES
+		self.__newSamples += 1
+		if len(latencies) >= self.MIN_SAMPLES and\
+		   (self.__learnedWait is None or
+		    self.__newSamples >= self.MIN_SAMPLES):
+			self.__newSamples = 0
+			values = sorted(latencies)
+			i = int(round((len(values) - 1) *
+				      self.LATENCY_PERCENTILE / 100.0))
+			# Add one character time as minimum margin.
+			self.__learnedWait = values[i] * self.SAFETY_FACTOR +\
+					     self.phy.getTransferTime(1)
+
+	def replyMissing(self):
+		"""No reply has been received within the timeout.
+		"""
+		self.backoff = min(self.backoff + 1, self.MAX_BACKOFF)
+
 class DpSlaveState(object):
 	"""Run time state of a DP slave that is managed by a DPM instance.
 	"""
@@ -61,6 +177,9 @@ class DpSlaveState(object):
 		"__prevState",
 		"__state",
 		"__stateTimeout",
+		"diag",
+		"diagFetchTime",
+		"diagRequested",
 		"dxStartTime",
 		"faultDeb",
 		"fcb",
@@ -68,10 +187,16 @@ class DpSlaveState(object):
 		"master",
 		"outData",
 		"pendingReq",
+		"pendingReqTimeLimit",
 		"pendingReqTimeout",
+		"replyPending",
+		"replyTimeout",
+		"requestOctets",
 		"rxQueue",
+		"sendTime",
 		"shortAckReceived",
 		"slaveDesc",
+		"txTime",
 	)
 
 	def __init__(self, master, slaveDesc):
@@ -84,7 +209,7 @@ class DpSlaveState(object):
 		self.__state = self._STATE_INVALID
 		self.__nextState = self._STATE_INVALID
 		self.__prevState = self._STATE_INVALID
-		self.__stateTimeout = TimeLimit()
+		self.__stateTimeout = TimeLimit(clock=master.clock)
 		self.setState(self.STATE_INIT)
 		self.applyState()
 
@@ -93,12 +218,35 @@ class DpSlaveState(object):
 
 		# Currently running request telegram
 		self.pendingReq = None
-		self.pendingReqTimeout = TimeLimit()
+		self.pendingReqTimeout = TimeLimit(clock=master.clock)
+		# Reply timeout of the pending request, in seconds.
+		# pendingReqTimeout is started with it, as soon as
+		# the request has been transmitted.
+		self.pendingReqTimeLimit = 0.0
 		self.shortAckReceived = False
 
+		# Transmit time of the pending request and the estimated
+		# duration of a request/reply transaction, in seconds.
+		self.sendTime = 0.0
+		self.txTime = None
+
+		# Adaptive reply timeout.
+		self.replyTimeout = DpReplyTimeout(master.phy, slaveDesc.gsd)
+		# True, while the reply to the last request is outstanding.
+		# This stays True after a timeout, until the next request.
+		self.replyPending = False
+		self.requestOctets = 0
+
 		# Data_Exchange context
 		self.dxStartTime = 0.0
 
+		# The most recently received DpSlaveDiag
+		self.diag = None
+
+		# Out-of-band diagnosis fetch in Data_Exchange
+		self.diagRequested = False
+		self.diagFetchTime = 0.0
+
 		# Received telegrams
 		self.rxQueue = []
 
@@ -125,7 +273,6 @@ class DpSlaveState(object):
 			stateTimeLimit = self.stateTimeLimits[state]
 		self.__nextState = state
 		self.__stateTimeout.start(stateTimeLimit)
-		self.master.phy.clearTxQueueAddr(self.slaveDesc.slaveAddr)
 		self.master._releaseSlave(self)
 
 	def applyState(self):
@@ -150,6 +297,70 @@ class DpSlaveState(object):
 	def stateHasTimeout(self):
 		return self.__stateTimeout.exceed()
 
+class DpDiagEvent(object):
+	"""Change of the diagnosis of a DP slave.
+	"""
+
+	__slots__ = (
+		"slaveDesc",
+		"prevDiag",
+		"diag",
+		"timestamp",
+	)
+
+	def __init__(self, slaveDesc, prevDiag, diag, timestamp):
+		self.slaveDesc = slaveDesc	# The DpSlaveDesc
+		self.prevDiag = prevDiag	# Previous DpSlaveDiag or None
+		self.diag = diag		# New DpSlaveDiag
+		self.timestamp = timestamp	# Master clock time stamp
+
+	def __repr__(self):
+		return "DpDiagEvent(slaveAddr=%d, diag=%s)" % (
+			self.slaveDesc.slaveAddr, str(self.diag))
+
+class DpStationInfo(object):
+	"""A live station found by DpMaster.scan().
+	"""
+
+	stype2name = {
+		FdlTelegram.FC_SLAVE	: "Slave",
+		FdlTelegram.FC_MNRDY	: "Master (not ready)",
+		FdlTelegram.FC_MRDY	: "Master (ready for token ring)",
+		FdlTelegram.FC_MTR	: "Master (in token ring)",
+	}
+
+	__slots__ = (
+		"addr",
+		"stationType",
+		"diag",
+		"gsdEntries",
+	)
+
+	def __init__(self, addr, stationType):
+		self.addr = addr		# Station address
+		self.stationType = stationType	# FdlTelegram.FC_STYPE_MASK bits
+		self.diag = None		# DpSlaveDiag or None
+		self.gsdEntries = []		# Matching GsdIndexEntry()s
+
+	def isSlave(self):
+		return self.stationType == FdlTelegram.FC_SLAVE
+
+	def isMaster(self):
+		return not self.isSlave()
+
+	def getIdentNumber(self):
+		"""Get the ident number from the slave diagnosis.
+		Returns None, if unknown.
+		"""
+		return self.diag.identNumber if self.diag else None
+
+	def __repr__(self):
+		identNumber = self.getIdentNumber()
+		return "DpStationInfo(addr=%d, type='%s', ident=%s)" % (
+			self.addr,
+			self.stype2name.get(self.stationType, "?"),
+			("0x%04X" % identNumber) if identNumber is not None else "-")
+
 class DpSlaveDesc(object):
 	"""Static descriptor data of a DP slave that
 	is managed by a DPM instance.
@@ -263,15 +474,26 @@ class DpSlaveDesc(object):
 	def getInData(self):
 		return self.dpm.getSlaveInData(self)
 
+	def getDiag(self):
+		return self.dpm.getSlaveDiag(self)
+
 	def __repr__(self):
 		return "DpSlaveDesc(identNumber=%s, slaveAddr=%d)" %\
 			(intToHex(self.identNumber), self.slaveAddr)
 
 class DpMaster(object):
+	# Maximum number of queued DpDiagEvent()s.
+	DIAG_EVENTS_MAX = 64
+
+	# Minimum interval between two out-of-band Slave_Diag requests
+	# to a slave in Data_Exchange, in seconds.
+	DIAG_FETCH_INTERVAL = 0.1
+
 	__slots__ = (
+		"__diagEvents",
+		"__preparedSlave",
 		"__runTimer",
 		"__runCount",
-		"__haveToken",
 		"__runNextSlaveIndex",
 		"__slaveDescs",
 		"__slaveDescsList",
@@ -279,6 +501,12 @@ class DpMaster(object):
 		"__slowDown",
 		"__slowDownFact",
 		"__slowDownUntil",
+		"__tokenCount",
+		"__tokenRing",
+		"__tokenVisits",
+		"__txQueuedSlaves",
+		"__wireSlave",
+		"clock",
 		"debug",
 		"dpTrans",
 		"dpmClass",
@@ -287,18 +515,30 @@ class DpMaster(object):
 		"phy",
 	)
 
-	def __init__(self, dpmClass, phy, masterAddr, debug=False):
+	def __init__(self, dpmClass, phy, masterAddr, debug=False, clock=None):
 		self.dpmClass = dpmClass
 		self.phy = phy
 		self.masterAddr = masterAddr
 		self.debug = debug
 
-		self.__runTimer = monotonic_time()
+		# Use the time source of the PHY, if none is given.
+		self.clock = clock if clock is not None else phy.clock
+
+		self.__runTimer = self.clock.now()
 		self.__runCount = 0
 
 		# Create the transceivers
 		self.fdlTrans = FdlTransceiver(self.phy)
-		self.dpTrans = DpTransceiver(self.fdlTrans, thisIsMaster=True)
+		self.dpTrans = DpTransceiver(self.fdlTrans, thisIsMaster=True,
+					     lazyDecode=True)
+
+		# The slaves with a request in the TX queue of the PHY.
+		self.__txQueuedSlaves = []
+		# The slave with the request that has been transmitted last.
+		# That is the slave the bus is allocated for.
+		self.__wireSlave = None
+		# The slave with a queued pipelined request.
+		self.__preparedSlave = None
 
 		mcastSlaveDesc = DpSlaveDesc(gsd=None,
 					     slaveAddr=FdlTelegram.ADDRESS_MCAST)
@@ -313,13 +553,17 @@ class DpMaster(object):
 		self.__slaveDescsList = []
 		self.__runNextSlaveIndex = 0
 
-		# Do we have the token?
-		self.__haveToken = True
+		# The FdlTokenRing. None = single master.
+		self.__tokenRing = None
+		self.__tokenCount = 0
+		self.__tokenVisits = set()
 
 		self.__slowDown = False
-		self.__slowDownUntil = monotonic_time()
+		self.__slowDownUntil = self.clock.now()
 		self.__slowDownFact = 1
 
+		self.__diagEvents = []
+
 	def __debugMsg(self, msg):
 		if self.debug:
 			print("DPM%d: %s" % (self.dpmClass, msg))
@@ -332,7 +576,7 @@ class DpMaster(object):
 		Slow down the state machine a bit.
 		"""
 		self.__slowDown = True
-		self.__slowDownUntil = monotonic_time() + (0.01 * self.__slowDownFact)
+		self.__slowDownUntil = self.clock.now() + (0.01 * self.__slowDownFact)
 		self.__debugMsg("Slow down factor = %d" % self.__slowDownFact)
 		self.__slowDownFact = min(self.__slowDownFact + 1, 10)
 
@@ -362,34 +606,123 @@ class DpMaster(object):
 
 		self.__runNextSlaveIndex = 0
 
+	def enableTokenRing(self, ttrBits, hsa=126, gapFactor=10):
+		"""Share the bus with other master stations.
+		ttrBits: The target token rotation time, in bit times.
+		hsa: The highest station address.
+		gapFactor: The number of token rotations between two GAP probes.
+		"""
+		baudrate = self.phy.getBaudrate() or 9600
+		self.__tokenRing = FdlTokenRing(
+			phy=self.phy,
+			thisAddr=self.masterAddr,
+			ttr=ttrBits / baudrate,
+			slotTime=self.phy.getSlotTime(),
+			hsa=hsa,
+			gapFactor=gapFactor,
+			clock=self.clock,
+			debug=self.debug)
+		# All token telegrams on the bus are needed to build the LAS.
+		self.fdlTrans.setRXFilter(None)
+
+	def getTokenRing(self):
+		"""Get the FdlTokenRing, or None, if this is the only master.
+		"""
+		return self.__tokenRing
+
+	def __haveToken(self):
+		return self.__tokenRing is None or self.__tokenRing.haveToken()
+
 	def getSlaveList(self):
 		"""Get a list of registered DpSlaveDescs, sorted by address.
 		"""
 		return self.__slaveDescsList
 
-	def __send(self, slave, telegram, timeout):
+	def __send(self, slave, telegram, maxTimeout):
 		"""Asynchronously send a telegram to a slave.
+		maxTimeout: The upper limit of the adaptive reply timeout.
 		"""
+		if slave.replyPending:
+			# The previous request has not been answered.
+			slave.replyTimeout.replyMissing()
 		slave.pendingReq = telegram
 		slave.shortAckReceived = False
+		slave.sendTime = self.clock.now()
 		try:
 			if FdlTelegram.checkType(telegram):
 				transceiver = self.fdlTrans
 			else:
 				transceiver = self.dpTrans
-			transceiver.send(fcb=slave.fcb,
-					 telegram=telegram)
+			# The PHY allocates the bus for the adaptive
+			# reply time, instead of the longest possible reply.
+			slave.requestOctets = transceiver.send(fcb=slave.fcb,
+				telegram=telegram,
+				replyTimeout=slave.replyTimeout.getReplyTime(maxTimeout))
 		except ProfibusError as e:
 			slave.pendingReq = None
+			slave.replyPending = False
 			self.__masterSlowDown()
 			self.__debugMsg(str(e))
 			return False
 		self.__slowDownFact = 1
-		slave.pendingReqTimeout.start(timeout)
+		slave.replyPending = True
+		slave.pendingReqTimeLimit = slave.replyTimeout.get(
+			slave.requestOctets, maxTimeout)
+		# The PHY might queue the request until the bus is free.
+		# The reply timeout starts when it is transmitted.
+		slave.pendingReqTimeout.start(TimeLimit.UNLIMITED)
+		if slave not in self.__txQueuedSlaves:
+			self.__txQueuedSlaves.append(slave)
+		self.__checkTransmitted()
 		return True
 
+	def __checkTransmitted(self):
+		"""Start the reply timeouts of the requests
+		that the PHY has transmitted from its TX queue.
+		"""
+		txQueuedSlaves = self.__txQueuedSlaves
+		if not txQueuedSlaves:
+			return
+		phy = self.phy
+		for slave in tuple(txQueuedSlaves):
+			if phy.isTxQueued(slave.slaveDesc.slaveAddr):
+				continue
+			txQueuedSlaves.remove(slave)
+			if self.__preparedSlave is slave:
+				self.__preparedSlave = None
+			if slave.pendingReq is not None:
+				slave.sendTime = self.clock.now()
+				slave.pendingReqTimeout.start(slave.pendingReqTimeLimit)
+				self.__wireSlave = slave
+
 	def _releaseSlave(self, slave):
-		self.phy.releaseBus()
+		"""Abort the transactions with the slave.
+		Queued requests to the slave are dropped and the bus is freed,
+		if it is allocated for the slave.
+		"""
+		addr = slave.slaveDesc.slaveAddr
+		self.phy.clearTxQueueAddr(addr)
+		if slave in self.__txQueuedSlaves:
+			self.__txQueuedSlaves.remove(slave)
+		if self.__preparedSlave is slave:
+			self.__preparedSlave = None
+		if self.__wireSlave is slave:
+			self.__wireSlave = None
+		self.phy.releaseBus(addr)
+		self.__checkTransmitted()
+
+	def __decode(self, slave, telegram):
+		"""Decode a received FdlTelegram into a DpTelegram.
+		Returns None on failure.
+		"""
+		try:
+			return self.dpTrans.decode(telegram)
+		except ProfibusError as e:
+			self.__debugMsg("Failed to decode telegram from "
+				"slave %d: %s\n%s" % (
+				slave.slaveDesc.slaveAddr,
+				str(e), str(telegram)))
+		return None
 
 	def __runSlave_init(self, slave):
 		if slave.stateJustEntered():
@@ -429,7 +762,7 @@ class DpMaster(object):
 					 telegram=FdlTelegram_FdlStat_Req(
 						da=slave.slaveDesc.slaveAddr,
 						sa=self.masterAddr),
-					 timeout=0.01)
+					 maxTimeout=0.01)
 			if not ok:
 				self.__debugMsg("FdlStat_Req failed")
 				return None
@@ -442,6 +775,7 @@ class DpMaster(object):
 			slave.flushRxQueue()
 		else:
 			for telegram in slave.getRxQueue():
+				telegram = self.__decode(slave, telegram)
 				if DpTelegram_SlaveDiag_Con.checkType(telegram):
 					slave.setState(slave.STATE_WPRM)
 					return None
@@ -459,7 +793,7 @@ class DpMaster(object):
 					 telegram=DpTelegram_SlaveDiag_Req(
 						da=slave.slaveDesc.slaveAddr,
 						sa=self.masterAddr),
-					 timeout=0.05)
+					 maxTimeout=0.05)
 			if not ok:
 				self.__debugMsg("SlaveDiag_Req failed")
 				return None
@@ -482,7 +816,7 @@ class DpMaster(object):
 			slave.slaveDesc.setPrmTelegram.sa = self.masterAddr
 			ok = self.__send(slave,
 					 telegram=slave.slaveDesc.setPrmTelegram,
-					 timeout=0.05)
+					 maxTimeout=0.05)
 			if not ok:
 				self.__debugMsg("Set_Prm failed")
 				return None
@@ -503,7 +837,7 @@ class DpMaster(object):
 			slave.slaveDesc.chkCfgTelegram.sa = self.masterAddr
 			ok = self.__send(slave,
 					 telegram=slave.slaveDesc.chkCfgTelegram,
-					 timeout=0.05)
+					 maxTimeout=0.05)
 			if not ok:
 				self.__debugMsg("Chk_Cfg failed")
 				return None
@@ -516,44 +850,15 @@ class DpMaster(object):
 			slave.flushRxQueue()
 		else:
 			for telegram in slave.getRxQueue():
+				telegram = self.__decode(slave, telegram)
 				if DpTelegram_SlaveDiag_Con.checkType(telegram):
-					if telegram.notExist():
-						self.__errorMsg("Slave %d is not reachable "
-							"via this line." %\
-							slave.slaveDesc.slaveAddr)
-					if telegram.cfgFault():
-						self.__errorMsg("Slave %d reports a faulty "
-							"configuration (Chk_Cfg)." %\
-							slave.slaveDesc.slaveAddr)
-					if telegram.prmFault():
-						self.__errorMsg("Slave %d reports a faulty "
-							"parameterization (Set_Prm)." %\
-							slave.slaveDesc.slaveAddr)
-					if telegram.prmReq():
-						self.__debugMsg("Slave %d requests a new "
-							"parameterization (Set_Prm)." %\
-							slave.slaveDesc.slaveAddr)
-					if telegram.isNotSupp():
-						self.__errorMsg("Slave %d replied with "
-							"\"function not supported\". "
-							"The parameters should be checked "
-							"(Set_Prm)." %\
-							slave.slaveDesc.slaveAddr)
-					if telegram.masterLock():
-						self.__errorMsg("Slave %d is already controlled "
-							"(locked to) another DP-master." %\
-							slave.slaveDesc.slaveAddr)
-					if not telegram.hasOnebit():
-						self.__debugMsg("Slave %d diagnostic "
-							"always-one-bit is zero." %\
-							slave.slaveDesc.slaveAddr)
-					if telegram.hasExtDiag():
-						pass#TODO turn on red DIAG-LED
+					diag = telegram.getDiag()
+					self.__handleSlaveDiag(slave, diag)
 
-					if telegram.isReadyDataEx():
+					if diag.isReadyDataEx():
 						slave.setState(slave.STATE_DX)
 						return None
-					elif telegram.needsNewPrmCfg():
+					elif diag.needsNewPrmCfg():
 						slave.setState(slave.STATE_INIT)
 						return None
 					break
@@ -567,12 +872,70 @@ class DpMaster(object):
 					 telegram=DpTelegram_SlaveDiag_Req(
 						da=slave.slaveDesc.slaveAddr,
 						sa=self.masterAddr),
-					 timeout=0.05)
+					 maxTimeout=0.05)
 			if not ok:
 				self.__debugMsg("SlaveDiag_Req failed")
 				return None
 		return None
 
+	def __handleSlaveDiag(self, slave, diag):
+		"""Store a received DpSlaveDiag.
+		Changes are reported as DpDiagEvent and newly raised
+		faults are logged. Repeated identical diagnosis is not logged.
+		"""
+		prevDiag = slave.diag
+		slave.diag = diag
+		if diag == prevDiag:
+			return
+
+		diagEvents = self.__diagEvents
+		if len(diagEvents) >= self.DIAG_EVENTS_MAX:
+			diagEvents.pop(0)
+		diagEvents.append(DpDiagEvent(slave.slaveDesc, prevDiag,
+					      diag, self.clock.now()))
+
+		slaveAddr = slave.slaveDesc.slaveAddr
+		raised = diag.status
+		prevChannelDiag = ()
+		if prevDiag is not None:
+			raised &= ~prevDiag.status
+			prevChannelDiag = prevDiag.channelDiag
+		if raised & diag.STA_STANOEX:
+			self.__errorMsg("Slave %d is not reachable "
+				"via this line." % slaveAddr)
+		if raised & diag.STA_CFGFLT:
+			self.__errorMsg("Slave %d reports a faulty "
+				"configuration (Chk_Cfg)." % slaveAddr)
+		if raised & diag.STA_PRMFLT:
+			self.__errorMsg("Slave %d reports a faulty "
+				"parameterization (Set_Prm)." % slaveAddr)
+		if raised & diag.STA_PRMREQ:
+			self.__debugMsg("Slave %d requests a new "
+				"parameterization (Set_Prm)." % slaveAddr)
+		if raised & diag.STA_NOSUPP:
+			self.__errorMsg("Slave %d replied with "
+				"\"function not supported\". "
+				"The parameters should be checked "
+				"(Set_Prm)." % slaveAddr)
+		if raised & diag.STA_MLOCK:
+			self.__errorMsg("Slave %d is already controlled "
+				"(locked to) another DP-master." % slaveAddr)
+		if not diag.hasOnebit():
+			self.__debugMsg("Slave %d diagnostic "
+				"always-one-bit is zero." % slaveAddr)
+		for channelDiag in diag.channelDiag:
+			if channelDiag not in prevChannelDiag:
+				self.__debugMsg("Slave %d channel diagnosis: %s" % (
+					slaveAddr, str(channelDiag)))
+
+	def getDiagEvents(self):
+		"""Get a list of DpDiagEvent()s that occurred since the last call.
+		At most DIAG_EVENTS_MAX events are queued. Older events are dropped.
+		"""
+		diagEvents = self.__diagEvents
+		self.__diagEvents = []
+		return diagEvents
+
 	def __runSlave_dataExchange(self, slave):
 		#TODO: add support for in/out-only slaves
 		dataExInData = None
@@ -582,26 +945,39 @@ class DpMaster(object):
 				"Running Data_Exchange with slave %d..." %\
 				slave.slaveDesc.slaveAddr)
 			slave.flushRxQueue()
-			slave.dxStartTime = monotonic_time()
+			slave.dxStartTime = self.clock.now()
+			slave.diagRequested = False
 
-		if slave.pendingReq:
+		if slave.pendingReq and\
+		   DpTelegram_SlaveDiag_Req.checkType(slave.pendingReq):
+			self.__dataExchangeDiag(slave)
+		elif slave.pendingReq:
 			for telegram in slave.getRxQueue():
-				if not DpTelegram_DataExchange_Con.checkType(telegram):
+				# The received telegrams are plain FdlTelegrams.
+				# Data_Exchange replies are handled without
+				# decoding the DP telegram.
+				if not DpTelegram_DataExchange_Con.checkFdlType(telegram):
 					self.__debugMsg("Ignoring telegram in "
 						"DataExchange with slave %d:\n%s" %(
-						slave.slaveDesc.slaveAddr, str(telegram)))
+						slave.slaveDesc.slaveAddr,
+						str(self.__decode(slave, telegram) or telegram)))
 					slave.faultDeb.fault()
 					continue
 				resFunc = telegram.fc & FdlTelegram.FC_RESFUNC_MASK
 				if resFunc in (FdlTelegram.FC_DH,
 					       FdlTelegram.FC_RDH,):
-					self.__debugMsg("Slave %d requested diagnostics." %\
-						slave.slaveDesc.slaveAddr)
-					slave.setState(slave.STATE_WDXRDY, 0.2)
+					# Fetch the diagnosis out of band,
+					# but keep Data_Exchange running.
+					if not slave.diagRequested:
+						self.__debugMsg("Slave %d requested diagnostics." %\
+							slave.slaveDesc.slaveAddr)
+					slave.diagRequested = True
 				elif resFunc == FdlTelegram.FC_RS:
 					raise DpError("Service not active "
 						"on slave %d" % slave.slaveDesc.slaveAddr)
-				dataExInData = telegram.getDU()
+				dataExInData = telegram.du
+				if dataExInData is None:
+					dataExInData = bytearray()
 
 			if dataExInData is None:
 				if slave.pendingReqTimeout.exceed():
@@ -614,29 +990,34 @@ class DpMaster(object):
 				slave.pendingReq = None
 				slave.faultDeb.ok()
 				slave.restartStateTimeout()
-				self._releaseSlave(slave)
 		else:
-			# Send the out data telegram, if any.
-			outData = slave.outData
-			if outData is not None:
+			now = self.clock.now()
+			if slave.diagRequested and\
+			   now >= slave.diagFetchTime + self.DIAG_FETCH_INTERVAL:
+				# Low priority diagnosis request.
+				# This slot is only used after a completed
+				# Data_Exchange, so the cyclic data is not starved.
+				slave.diagFetchTime = now
 				ok = self.__send(slave,
-						 telegram=DpTelegram_DataExchange_Req(
+						 telegram=DpTelegram_SlaveDiag_Req(
 							da=slave.slaveDesc.slaveAddr,
-							sa=self.masterAddr,
-							du=outData),
-						 timeout=0.1)
+							sa=self.masterAddr),
+						 maxTimeout=0.05)
 				if not ok:
-					self.__debugMsg("DataExchange_Req failed")
+					self.__debugMsg("SlaveDiag_Req failed")
+				return None
+
+			# Send the out data telegram, if any.
+			if slave.outData is not None:
+				if not self.__sendDataExchange(slave):
 					return None
-				# We sent it. Reset the data.
-				slave.outData = None
 
 		faultCount = slave.faultDeb.get()
 		if faultCount >= 5:
 			# communication lost
 			self.__debugMsg("Communication lost in Data_Exchange.")
 			slave.setState(slave.STATE_INIT)
-		elif faultCount >= 3 and monotonic_time() >= slave.dxStartTime + 0.2:
+		elif faultCount >= 3 and self.clock.now() >= slave.dxStartTime + 0.2:
 			# Diagnose the slave
 			self.__debugMsg("Many errors in Data_Exchange. "
 				"Requesting diagnostic information...")
@@ -644,6 +1025,70 @@ class DpMaster(object):
 
 		return dataExInData
 
+	def __sendDataExchange(self, slave):
+		"""Send the Data_Exchange request with the out data of the slave.
+		Returns False, if sending failed.
+		"""
+		ok = self.__send(slave,
+				 telegram=DpTelegram_DataExchange_Req(
+					da=slave.slaveDesc.slaveAddr,
+					sa=self.masterAddr,
+					du=slave.outData),
+				 maxTimeout=0.1)
+		if not ok:
+			self.__debugMsg("DataExchange_Req failed")
+			return False
+		# We sent it. Reset the data.
+		slave.outData = None
+		return True
+
+	def __prepareNextSlave(self, slave):
+		"""Queue the Data_Exchange request of the next slave,
+		while the transaction of the current slave is on the wire.
+		The PHY transmits the queued frame as soon as the reply
+		of the current slave frees the bus.
+		"""
+		if slave.getState() != slave.STATE_DX or\
+		   slave.stateJustEntered() or\
+		   slave.stateIsChanging() or\
+		   slave.stateHasTimeout() or\
+		   slave.pendingReq is not None or\
+		   slave.outData is None or\
+		   slave.diagRequested:
+			return
+		if self.__sendDataExchange(slave) and\
+		   self.phy.isTxQueued(slave.slaveDesc.slaveAddr):
+			self.__preparedSlave = slave
+
+	def __dataExchangeDiag(self, slave):
+		"""Handle the reply to an out-of-band Slave_Diag request
+		in Data_Exchange.
+		"""
+		for telegram in slave.getRxQueue():
+			telegram = self.__decode(slave, telegram)
+			if not DpTelegram_SlaveDiag_Con.checkType(telegram):
+				self.__debugMsg("Ignoring telegram in "
+					"DataExchange diagnosis with slave %d:\n%s" %(
+					slave.slaveDesc.slaveAddr, str(telegram)))
+				slave.faultDeb.fault()
+				continue
+			diag = telegram.getDiag()
+			self.__handleSlaveDiag(slave, diag)
+			slave.diagRequested = False
+			slave.pendingReq = None
+			slave.faultDeb.ok()
+			slave.restartStateTimeout()
+			if diag.needsNewPrmCfg():
+				slave.setState(slave.STATE_INIT)
+			elif not diag.isReadyDataEx():
+				slave.setState(slave.STATE_WDXRDY, 0.2)
+			return
+		if slave.pendingReqTimeout.exceed():
+			self.__debugMsg("Slave_Diag timeout in Data_Exchange "
+					"with slave %d" % slave.slaveDesc.slaveAddr)
+			slave.faultDeb.fault()
+			slave.pendingReq = None
+
 	__slaveStateHandlers = {
 		DpSlaveState.STATE_INIT		: __runSlave_init,
 		DpSlaveState.STATE_WDIAG	: __runSlave_waitDiag,
@@ -655,7 +1100,7 @@ class DpMaster(object):
 
 	def __runSlave(self, slave):
 		self.__pollRx()
-		if not self.__haveToken:
+		if not self.__haveToken():
 			return None
 
 		if slave.stateHasTimeout():
@@ -681,32 +1126,114 @@ class DpMaster(object):
 			ok, telegram = self.dpTrans.poll()
 		except ProfibusError as e:
 			self.__debugMsg("RX error: %s" % str(e))
-			return
+			ok, telegram = False, None
 		if ok and telegram:
-			if FdlTelegram_token.checkType(telegram):
-				pass#TODO handle token
+			tokenRing = self.__tokenRing
+			if tokenRing is not None and\
+			   tokenRing.handleTelegram(telegram):
+				pass
+			elif FdlTelegram_token.checkType(telegram):
+				pass
 			elif FdlTelegram_ack.checkType(telegram):
-				for addr, slave in self.__slaveStates.items():
-					if addr != FdlTelegram.ADDRESS_MCAST:
-						slave.shortAckReceived = True
+				# Ignore acknowledges to other masters.
+				if self.__haveToken():
+					# The short ACK is the reply of the slave
+					# the bus has been allocated for.
+					self.__updateTxTime(self.__wireSlave, 1)
+					self.__wireSlave = None
+					for addr, slave in self.__slaveStates.items():
+						if addr != FdlTelegram.ADDRESS_MCAST:
+							slave.shortAckReceived = True
 			elif telegram.da == FdlTelegram.ADDRESS_MCAST:
 				self.__handleMcastTelegram(telegram)
 			elif telegram.da == self.masterAddr:
 				if telegram.sa in self.__slaveStates:
 					slave = self.__slaveStates[telegram.sa]
+					self.__updateTxTime(slave, telegram.getRawSize())
 					slave.rxQueue.append(telegram)
 					slave.fcb.handleReply()
+					if self.__wireSlave is slave:
+						self.__wireSlave = None
 				else:
 					self.__debugMsg("Received telegram from "
 						"unknown station %d:\n%s" %(
 						telegram.sa, str(telegram)))
-			else:
+			elif tokenRing is None:
 				self.__debugMsg("Received telegram for "
 					"foreign station:\n%s" % str(telegram))
 		else:
 			if telegram:
 				self.__debugMsg("Received corrupt "
 					"telegram:\n%s" % str(telegram))
+		wireSlave = self.__wireSlave
+		if wireSlave is not None and\
+		   wireSlave.pendingReqTimeout.exceed():
+			# The reply timed out. Free the bus.
+			self._releaseSlave(wireSlave)
+		# Receiving a reply frees the bus for the next queued request.
+		self.__checkTransmitted()
+
+	def __updateTxTime(self, slave, replyOctets):
+		"""Update the estimated transaction duration and the reply
+		timeout of the slave from the reply that has just been received.
+		A late reply after a timeout is taken into account, too.
+		"""
+		if slave is None or not slave.replyPending:
+			return
+		slave.replyPending = False
+		duration = self.clock.now() - slave.sendTime
+		slave.replyTimeout.replyReceived(duration, slave.requestOctets,
+						 replyOctets)
+		if slave.txTime is None or duration > slave.txTime:
+			slave.txTime = duration
+		else:
+			slave.txTime = (slave.txTime * 7.0 + duration) / 8.0
+
+	def __estimateTxTime(self, slave):
+		"""Get the estimated duration of the next transaction
+		with the slave, in seconds.
+		"""
+		if slave.txTime is not None:
+			return slave.txTime
+		# Request and longest reply plus the slot time.
+		return self.phy.getTransferTime(20 + 255) +\
+		       self.__tokenRing.slotTime
+
+	def __transactionPending(self):
+		for slave in self.__slaveStates.values():
+			if slave.pendingReq is not None and\
+			   not slave.pendingReqTimeout.exceed():
+				return True
+		return False
+
+	def __runTokenRing(self, slave):
+		"""Run the token ring.
+		slave: The slave that is run next. May be None.
+		Returns True, if the slave may be run now.
+		"""
+		tokenRing = self.__tokenRing
+		self.__pollRx()
+		tokenRing.run()
+		if not tokenRing.haveToken():
+			return False
+		if tokenRing.tokenCount != self.__tokenCount:
+			# New token reception. Start a new slave cycle.
+			self.__tokenCount = tokenRing.tokenCount
+			self.__tokenVisits = set()
+		if slave is not None and\
+		   (slave.pendingReq is None or slave.pendingReqTimeout.exceed()):
+			# The slave might start a new transaction.
+			addr = slave.slaveDesc.slaveAddr
+			if addr in self.__tokenVisits or\
+			   not tokenRing.mayStart(self.__estimateTxTime(slave)):
+				# The slave cycle is complete or
+				# the token hold time is used up.
+				if not self.__transactionPending():
+					tokenRing.passToken()
+				return False
+			self.__tokenVisits.add(addr)
+			tokenRing.useToken()
+		return True
 
 	def __handleMcastTelegram(self, telegram):
 		self.__debugMsg("Received multicast telegram:\n%s" % str(telegram))
@@ -717,7 +1244,7 @@ class DpMaster(object):
 		"""
 		if self.debug:
 			self.__runCount += 1
-			now = monotonic_time()
+			now = self.clock.now()
 			if now >= self.__runTimer + 10.0:
 				cps = self.__runCount / (now - self.__runTimer)
 				self.__debugMsg("State machine calls: "
@@ -729,7 +1256,7 @@ class DpMaster(object):
 		if self.__slowDown:
 			# Master slowdown is active.
 			# Do not run state machine until the end of the slowdown.
-			if monotonic_time() < self.__slowDownUntil:
+			if self.clock.now() < self.__slowDownUntil:
 				return None
 			self.__slowDown = False
 
@@ -737,14 +1264,31 @@ class DpMaster(object):
 		runNextSlaveIndex = self.__runNextSlaveIndex
 
 		if not slaveDescsList:
+			if self.__tokenRing is not None:
+				self.__runTokenRing(None)
+				if self.__tokenRing.haveToken():
+					self.__tokenRing.passToken()
 			return None
 
 		slaveDesc = slaveDescsList[runNextSlaveIndex]
-		self.__runNextSlaveIndex = (runNextSlaveIndex + 1) % len(slaveDescsList)
-
 		slave = self.__slaveStates[slaveDesc.slaveAddr]
+		if self.__tokenRing is not None and\
+		   not self.__runTokenRing(slave):
+			return None
+
+		runNextSlaveIndex = (runNextSlaveIndex + 1) % len(slaveDescsList)
+		self.__runNextSlaveIndex = runNextSlaveIndex
 		slave.inData = self.__runSlave(slave)
 
+		if self.__tokenRing is None and\
+		   slave.pendingReq is not None and\
+		   self.__preparedSlave is None:
+			# Pipeline the request of the next slave.
+			nextSlave = self.__slaveStates[
+				slaveDescsList[runNextSlaveIndex].slaveAddr]
+			if nextSlave is not slave:
+				self.__prepareNextSlave(nextSlave)
+
 		return slaveDesc
 
 	def setSlaveOutData(self, slaveDesc, outData):
@@ -754,6 +1298,13 @@ class DpMaster(object):
 		slave = self.__slaveStates[slaveDesc.slaveAddr]
 		slave.outData = outData
 
+	def getSlaveDiag(self, slaveDesc):
+		"""Get the most recently received diagnosis (DpSlaveDiag).
+		This does not cause any bus traffic.
+		Returns None, if no diagnosis was received, yet.
+		"""
+		return self.__slaveStates[slaveDesc.slaveAddr].diag
+
 	def getSlaveInData(self, slaveDesc):
 		"""Get the latest received in-data.
 		Returns None, if there was no received data.
@@ -763,12 +1314,103 @@ class DpMaster(object):
 		slave.inData = None
 		return inData
 
+	def __scanTransaction(self, request, maxReplyLen, slotTime, retries):
+		"""Send a request and wait for the reply from request.da.
+		The wait time is the on-wire time of the request and
+		the longest reply plus the slot time.
+		Returns the reply FdlTelegram or None.
+		"""
+		timeout = self.phy.getTransferTime(len(request.getRawData()) +
+						   maxReplyLen) + slotTime
+		for i in range(retries + 1):
+			self.phy.send(request, srd=True, maxReplyLen=maxReplyLen)
+			deadline = self.clock.now() + timeout
+			while True:
+				remaining = deadline - self.clock.now()
+				if remaining <= 0.0:
+					break
+				try:
+					ok, telegram = self.fdlTrans.poll(timeout=remaining)
+				except ProfibusError as e:
+					self.__debugMsg("Scan RX error: %s" % str(e))
+					continue
+				if ok and telegram and\
+				   telegram.da == self.masterAddr and\
+				   telegram.sa == request.da:
+					self.phy.releaseBus()
+					return telegram
+			self.phy.releaseBus()
+		return None
+
+	def scan(self, addrs=None, gsdIndex=None, retries=1, slotTime=None):
+		"""Scan the bus for live stations.
+		Each address is probed with an FDL_Status request.
+		Slaves are then asked for their Slave_Diag, which
+		contains the ident number.
+		addrs: The addresses to probe. None = all (0-126).
+		gsdIndex: Optional GsdIndex. The GSD files matching the
+		          ident number are stored in DpStationInfo.gsdEntries.
+		retries: The number of retries for a missing reply.
+		slotTime: The time, in seconds, to wait for the start of a reply.
+		          None = The default slot time for the baud rate.
+		The next request is sent as soon as a reply has been received.
+		This method blocks until the scan is complete and must not be
+		called while the slaves are run. It does not change
+		the state of the registered slaves.
+		Returns a list of DpStationInfo()s sorted by address.
+		"""
+		if addrs is None:
+			addrs = range(FdlTelegram.ADDRESS_MCAST)
+		if slotTime is None:
+			slotTime = self.phy.getSlotTime()
+
+		# Build all requests in advance.
+		requests = [ FdlTelegram_FdlStat_Req(da=addr, sa=self.masterAddr)
+			     for addr in sorted(set(addrs))
+			     if addr != self.masterAddr and
+				addr < FdlTelegram.ADDRESS_MCAST ]
+
+		stations = []
+		for request in requests:
+			reply = self.__scanTransaction(request, 6, slotTime, retries)
+			if reply is None or reply.fc is None or\
+			   (reply.fc & FdlTelegram.FC_REQ):
+				continue
+			station = DpStationInfo(request.da,
+				reply.fc & FdlTelegram.FC_STYPE_MASK)
+			stations.append(station)
+			self.__debugMsg("Scan: Found %s" % str(station))
+			if not station.isSlave():
+				continue
+
+			diagReq = DpTelegram_SlaveDiag_Req(da=request.da,
+							   sa=self.masterAddr)
+			reply = self.__scanTransaction(diagReq.toFdlTelegram(),
+						       255, slotTime, retries)
+			if reply is None:
+				continue
+			try:
+				dp = DpTelegram.fromFdlTelegram(reply, thisIsMaster=True)
+			except ProfibusError as e:
+				self.__debugMsg("Scan: Invalid Slave_Diag reply "
+					"from %d: %s" % (request.da, str(e)))
+				continue
+			if DpTelegram_SlaveDiag_Con.checkType(dp):
+				station.diag = dp.getDiag()
+				if gsdIndex is not None:
+					station.gsdEntries = gsdIndex.find(
+						identNumber=station.getIdentNumber())
+		return stations
+
 	def initialize(self):
 		"""Initialize the DPM."""
 
 		# Initialize the RX filter
-		self.fdlTrans.setRXFilter([self.masterAddr,
-					   FdlTelegram.ADDRESS_MCAST])
+		if self.__tokenRing is None:
+			self.fdlTrans.setRXFilter([self.masterAddr,
+						   FdlTelegram.ADDRESS_MCAST])
+		else:
+			self.fdlTrans.setRXFilter(None)
 		# Free memory
 		gc.collect()
 
@@ -806,13 +1448,15 @@ class DpMaster(object):
 		self.__syncFreezeHelper(groupMask, DpTelegram_GlobalControl.CCMD_UNFREEZE)
 
 class DPM1(DpMaster):
-	def __init__(self, phy, masterAddr, debug=False):
+	def __init__(self, phy, masterAddr, debug=False, clock=None):
 		DpMaster.__init__(self, dpmClass=1, phy=phy,
 			masterAddr=masterAddr,
-			debug=debug)
+			debug=debug,
+			clock=clock)
 
 class DPM2(DpMaster):
-	def __init__(self, phy, masterAddr, debug=False):
+	def __init__(self, phy, masterAddr, debug=False, clock=None):
 		DpMaster.__init__(self, dpmClass=2, phy=phy,
 			masterAddr=masterAddr,
-			debug=debug)
+			debug=debug,
+			clock=clock)
@@ -11,13 +11,14 @@
 from __future__ import division, absolute_import, print_function, unicode_literals
 from pyprofibus.compat import *
 
-from pyprofibus.phy import *
 from pyprofibus.util import *
 
 __all__ = [
 	"FdlError",
+	"FdlChecksumError",
 	"FdlFCB",
 	"FdlTransceiver",
+	"FdlTokenRing",
 	"FdlTelegram",
 	"FdlTelegram_var",
 	"FdlTelegram_stat8",
@@ -34,6 +35,10 @@ class FdlError(ProfibusError):
 	__slots__ = (
 	)
 
+class FdlChecksumError(FdlError):
+	__slots__ = (
+	)
+
 class FdlFCB():
 	"""FCB context, per slave.
 	"""
@@ -117,18 +122,10 @@ class FdlTransceiver(object):
 		return (ok, telegram)
 
 	# Send an FdlTelegram.
-	def send(self, fcb, telegram):
-		srd = False
+	# Returns the size of the encoded telegram, in octets.
+	def send(self, fcb, telegram, replyTimeout=None):
+		srd = FdlTelegram.fcExpectsReply(telegram.fc)
 		if telegram.fc & FdlTelegram.FC_REQ:
-			func = telegram.fc & FdlTelegram.FC_REQFUNC_MASK
-			srd = func in (FdlTelegram.FC_SRD_LO,
-				       FdlTelegram.FC_SRD_HI,
-				       FdlTelegram.FC_SDA_LO,
-				       FdlTelegram.FC_SDA_HI,
-				       FdlTelegram.FC_DDB,
-				       FdlTelegram.FC_FDL_STAT,
-				       FdlTelegram.FC_IDENT,
-				       FdlTelegram.FC_LSAP)
 			telegram.fc &= ~(FdlTelegram.FC_FCB | FdlTelegram.FC_FCV)
 			if fcb.enabled():
 				if fcb.bitIsOn():
@@ -139,7 +136,7 @@ class FdlTransceiver(object):
 					fcb.setWaitingReply()
 				else:
 					fcb.FCBnext()
-		self.phy.send(telegram, srd)
+		return self.phy.send(telegram, srd, replyTimeout=replyTimeout)
 
 class FdlTelegram(object):
 	# Start delimiter
@@ -205,6 +202,18 @@ class FdlTelegram(object):
 	FC_MRDY		= 0x20	# Master, ready to enter token ring
 	FC_MTR		= 0x30	# Master, in token ring
 
+	# Request function codes that expect a reply or acknowledge.
+	reqFuncsWithReply = frozenset((
+		FC_SRD_LO,
+		FC_SRD_HI,
+		FC_SDA_LO,
+		FC_SDA_HI,
+		FC_DDB,
+		FC_FDL_STAT,
+		FC_IDENT,
+		FC_LSAP,
+	))
+
 	# Delimiter to size converstion table.
 	delim2size = {
 		SD1	: 6,
@@ -290,6 +299,15 @@ class FdlTelegram(object):
 	def getRealDuLen(self):
 		return len(self.du) + len(self.dae) + len(self.sae)
 
+	def getRawSize(self):
+		"""Get the size of the encoded telegram, in octets.
+		"""
+		size = self.delim2size.get(self.sd)
+		if size is None:
+			# SD2: SD, LE, LEr, SD, DA, SA, FC, DU, FCS, ED
+			size = self.getRealDuLen() + 9
+		return size
+
 	@staticmethod
 	def calcFCS(data):
 		return sum(data) & 0xFF
@@ -327,6 +345,13 @@ class FdlTelegram(object):
 			data.append(self.ed)
 		return data
 
+	@classmethod
+	def fcExpectsReply(cls, fc):
+		"""Returns True, if fc is a request that expects a reply.
+		"""
+		return bool(fc & cls.FC_REQ) and\
+		       (fc & cls.FC_REQFUNC_MASK) in cls.reqFuncsWithReply
+
 	# Extract address extension bytes from DU
 	@staticmethod
 	def __duExtractAe(du):
@@ -353,7 +378,7 @@ class FdlTelegram(object):
 				if data[5] != FdlTelegram.ED:
 					raise FdlError("Invalid end delimiter")
 				if data[4] != FdlTelegram.calcFCS(data[1:4]):
-					raise FdlError("Checksum mismatch")
+					raise FdlChecksumError("Checksum mismatch")
 				return FdlTelegram_stat0(
 					da=data[1], sa=data[2], fc=data[3])
 			elif sd == FdlTelegram.SD2:
@@ -368,7 +393,7 @@ class FdlTelegram(object):
 				if data[5+le] != FdlTelegram.ED:
 					raise FdlError("Invalid end delimiter")
 				if data[4+le] != FdlTelegram.calcFCS(data[4:4+le]):
-					raise FdlError("Checksum mismatch")
+					raise FdlChecksumError("Checksum mismatch")
 				du = data[7:7+(le-3)]
 				if len(du) != le - 3:
 					raise FdlError("FDL packet shorter than FE")
@@ -386,7 +411,7 @@ class FdlTelegram(object):
 				if data[13] != FdlTelegram.ED:
 					raise FdlError("Invalid end delimiter")
 				if data[12] != FdlTelegram.calcFCS(data[1:12]):
-					raise FdlError("Checksum mismatch")
+					raise FdlChecksumError("Checksum mismatch")
 				du = data[4:12]
 				da, sa, dae, sae = data[1], data[2], b"", b""
 				if da & FdlTelegram.ADDRESS_EXT:
@@ -500,3 +525,315 @@ class FdlTelegram_Lsap_Req(FdlTelegram_stat0):
 		FdlTelegram_stat0.__init__(self, da=da, sa=sa,
 			fc=FdlTelegram.FC_REQ |\
 			   FdlTelegram.FC_LSAP)
+
+class FdlTokenRing(object):
+	"""FDL token passing of a master station.
+
+	The ring is built from the observed token telegrams (LAS).
+	The GAP between this station and the next station (NS)
+	is probed with one FDL_Status request every gapFactor rotations.
+	If the bus is silent for the token loss timeout,
+	this station claims the token.
+	"""
+
+	STATE_LISTEN		= 0	# Not in the ring. Listening.
+	STATE_IDLE		= 1	# In the ring. Not holding the token.
+	STATE_USE_TOKEN		= 2	# Holding the token.
+	STATE_AWAIT_STATUS	= 3	# Holding the token. Waiting for GAP reply.
+	STATE_PASS_TOKEN	= 4	# Token passed. Waiting for NS activity.
+
+	state2name = {
+		STATE_LISTEN		: "Listen",
+		STATE_IDLE		: "Idle",
+		STATE_USE_TOKEN		: "Use token",
+		STATE_AWAIT_STATUS	: "Await status",
+		STATE_PASS_TOKEN	: "Pass token",
+	}
+
+	# Number of token pass retries before NS is removed from the LAS.
+	PASS_RETRIES = 1
+
+	__slots__ = (
+		"phy",
+		"clock",
+		"debug",
+		"thisAddr",
+		"ttr",
+		"slotTime",
+		"hsa",
+		"gapFactor",
+		"las",
+		"ns",
+		"ps",
+		"rotationTime",
+		"tokenCount",
+		"__state",
+		"__lastActivity",
+		"__tokenTime",
+		"__holdUntil",
+		"__used",
+		"__gapCount",
+		"__gapAddr",
+		"__waitUntil",
+		"__passRetries",
+	)
+
+	def __init__(self, phy, thisAddr, ttr, slotTime, hsa=126, gapFactor=10,
+		     clock=None, debug=False):
+		"""phy: The CpPhy.
+		thisAddr: The address of this master station.
+		ttr: The target token rotation time, in seconds.
+		slotTime: The slot time, in seconds.
+		hsa: The highest station address.
+		gapFactor: GAP update factor. Number of rotations between
+		           two GAP probes.
+		"""
+		self.phy = phy
+		self.clock = clock if clock is not None else phy.clock
+		self.debug = debug
+		self.thisAddr = thisAddr
+		self.ttr = ttr
+		self.slotTime = slotTime
+		self.hsa = hsa
+		self.gapFactor = gapFactor
+		self.las = []		# Sorted list of active master stations
+		self.ns = thisAddr	# Next station
+		self.ps = thisAddr	# Previous station
+		self.rotationTime = None # Last real token rotation time (TRR)
+		self.tokenCount = 0	# Number of token receptions
+		self.__state = self.STATE_LISTEN
+		self.__lastActivity = self.clock.now()
+		self.__tokenTime = None
+		self.__holdUntil = 0.0
+		self.__used = False
+		self.__gapCount = 0
+		self.__gapAddr = thisAddr
+		self.__waitUntil = 0.0
+		self.__passRetries = 0
+
+	def __debugMsg(self, msg):
+		if self.debug:
+			print("FDL-ring %d: %s" % (self.thisAddr, msg))
+
+	def __setState(self, state):
+		if state != self.__state:
+			self.__debugMsg("state --> '%s'" % self.state2name[state])
+		self.__state = state
+
+	def getState(self):
+		return self.__state
+
+	def getTokenLossTimeout(self):
+		"""Get the token loss timeout (T_TO), in seconds.
+		"""
+		return (6 + 2 * self.thisAddr) * self.slotTime
+
+	def inRing(self):
+		return self.__state != self.STATE_LISTEN
+
+	def haveToken(self):
+		"""Returns True, if this station holds the token
+		and may start transactions.
+		"""
+		return self.__state == self.STATE_USE_TOKEN
+
+	def mayStart(self, duration):
+		"""Returns True, if a transaction of the estimated duration
+		(in seconds) may be started within the token hold time.
+		One transaction per token reception is always allowed.
+		"""
+		if not self.haveToken():
+			return False
+		if not self.__used:
+			return True
+		return self.clock.now() + duration <= self.__holdUntil
+
+	def useToken(self):
+		"""Mark the start of a transaction.
+		"""
+		self.__used = True
+
+	def getHoldTimeLeft(self):
+		"""Get the remaining token hold time, in seconds.
+		"""
+		if not self.haveToken():
+			return 0.0
+		return max(0.0, self.__holdUntil - self.clock.now())
+
+	def __addLas(self, addr):
+		if addr <= self.hsa and addr not in self.las:
+			self.las.append(addr)
+			self.las.sort()
+			self.__updateNs()
+
+	def __removeLas(self, addr):
+		if addr in self.las and addr != self.thisAddr:
+			self.las.remove(addr)
+			self.__updateNs()
+
+	def __updateNs(self):
+		"""Find the next station in the LAS.
+		"""
+		for addr in self.las:
+			if addr > self.thisAddr:
+				self.ns = addr
+				return
+		for addr in self.las:
+			if addr != self.thisAddr:
+				self.ns = addr
+				return
+		self.ns = self.thisAddr
+
+	def __tokenReceived(self, sa):
+		now = self.clock.now()
+		if self.__tokenTime is None:
+			# No hold time on the first reception.
+			trr = self.ttr
+		else:
+			trr = now - self.__tokenTime
+		self.rotationTime = trr
+		self.tokenCount += 1
+		self.ps = sa
+		self.__addLas(self.thisAddr)
+		self.__tokenTime = now
+		self.__holdUntil = now + max(0.0, self.ttr - trr)
+		self.__used = False
+		self.__setState(self.STATE_USE_TOKEN)
+
+	def __send(self, telegram, srd, maxReplyLen):
+		self.phy.send(telegram, srd, maxReplyLen)
+		# Wait for the reply or the activity for one slot time
+		# after the end of the telegram.
+		self.__waitUntil = self.clock.now() +\
+			self.phy.getTransferTime(len(telegram.getRawData())) +\
+			self.slotTime
+
+	def handleTelegram(self, telegram):
+		"""Process a received telegram.
+		Returns True, if the telegram was consumed by the token ring.
+		"""
+		self.__lastActivity = self.clock.now()
+		state = self.__state
+		if telegram.sd == FdlTelegram.SC:
+			return False
+		if state == self.STATE_PASS_TOKEN and telegram.sa == self.ns:
+			# The next station is active. The pass was successful.
+			self.__setState(self.STATE_IDLE)
+
+		if telegram.sd == FdlTelegram.SD4:
+			if telegram.sa != self.thisAddr:
+				self.__addLas(telegram.sa)
+			if telegram.da == self.thisAddr:
+				if telegram.sa != self.thisAddr:
+					self.__tokenReceived(telegram.sa)
+				return True
+			if telegram.da != telegram.sa:
+				self.__addLas(telegram.da)
+			return False
+
+		if telegram.da != self.thisAddr or telegram.fc is None:
+			return False
+		if telegram.fc & FdlTelegram.FC_REQ:
+			func = telegram.fc & FdlTelegram.FC_REQFUNC_MASK
+			if func == FdlTelegram.FC_FDL_STAT:
+				# GAP probe by another master.
+				stype = FdlTelegram.FC_MTR if self.inRing()\
+					else FdlTelegram.FC_MRDY
+				self.phy.send(FdlTelegram_FdlStat_Con(
+						da=telegram.sa, sa=self.thisAddr,
+						fc=FdlTelegram.FC_OK | stype),
+					      srd=False, maxReplyLen=0)
+				return True
+			return False
+		if state == self.STATE_AWAIT_STATUS and\
+		   telegram.sa == self.__gapAddr:
+			stype = telegram.fc & FdlTelegram.FC_STYPE_MASK
+			if stype in (FdlTelegram.FC_MRDY, FdlTelegram.FC_MTR):
+				self.__debugMsg("New master %d in GAP" % telegram.sa)
+				self.__addLas(telegram.sa)
+			self.phy.releaseBus()
+			self.__doPass()
+			return True
+		return False
+
+	def run(self):
+		"""Run the token ring timers.
+		"""
+		now = self.clock.now()
+		state = self.__state
+		if state in (self.STATE_LISTEN, self.STATE_IDLE):
+			if now >= self.__lastActivity + self.getTokenLossTimeout():
+				self.__debugMsg("Bus idle. Claiming the token.")
+				self.__tokenReceived(self.thisAddr)
+		elif state == self.STATE_AWAIT_STATUS:
+			if now >= self.__waitUntil:
+				# No reply from the GAP station.
+				self.phy.releaseBus()
+				self.__doPass()
+		elif state == self.STATE_PASS_TOKEN:
+			if now >= self.__waitUntil:
+				if self.__passRetries < self.PASS_RETRIES:
+					self.__passRetries += 1
+					self.__sendToken()
+				else:
+					self.__debugMsg("Station %d does not "
+						"accept the token." % self.ns)
+					self.__removeLas(self.ns)
+					self.__passRetries = 0
+					self.__sendToken()
+
+	def __nextGapAddr(self):
+		"""Get the next address in the GAP between this station
+		and NS. Returns None, if the GAP is empty.
+		"""
+		addr = self.__gapAddr
+		for i in range(self.hsa + 1):
+			addr = addr + 1 if addr < self.hsa else 0
+			if self.__inGap(addr):
+				return addr
+		return None
+
+	def __inGap(self, addr):
+		this, ns = self.thisAddr, self.ns
+		if addr == this:
+			return False
+		if ns == this:
+			return True
+		if ns > this:
+			return this < addr < ns
+		return addr > this or addr < ns
+
+	def passToken(self):
+		"""Pass the token to the next station.
+		Every gapFactor rotations, one GAP address is probed first,
+		if there is hold time left.
+		"""
+		if self.__state != self.STATE_USE_TOKEN:
+			return
+		self.__gapCount += 1
+		if self.__gapCount >= self.gapFactor and\
+		   self.clock.now() < self.__holdUntil:
+			self.__gapCount = 0
+			gapAddr = self.__nextGapAddr()
+			if gapAddr is not None:
+				self.__gapAddr = gapAddr
+				self.__send(FdlTelegram_FdlStat_Req(
+						da=gapAddr, sa=self.thisAddr),
+					    srd=True, maxReplyLen=6)
+				self.__setState(self.STATE_AWAIT_STATUS)
+				return
+		self.__doPass()
+
+	def __doPass(self):
+		self.__passRetries = 0
+		self.__sendToken()
+
+	def __sendToken(self):
+		if self.ns == self.thisAddr:
+			# This is the only master.
+			self.__tokenReceived(self.thisAddr)
+			return
+		self.__send(FdlTelegram_token(da=self.ns, sa=self.thisAddr),
+			    srd=False, maxReplyLen=0)
+		self.phy.releaseBus()
+		self.__setState(self.STATE_PASS_TOKEN)
@@ -1,4 +1,6 @@
 from __future__ import division, absolute_import, print_function, unicode_literals
 
+from pyprofibus.gsd.cache import *
+from pyprofibus.gsd.index import *
 from pyprofibus.gsd.interp import *
 from pyprofibus.gsd.parser import *
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+#
+# PROFIBUS - GSD file parser result cache
+#
+# Licensed under the terms of the GNU General Public License version 2,
+# or (at your option) any later version.
+#
+
+from __future__ import division, absolute_import, print_function, unicode_literals
+from pyprofibus.compat import *
+
+from pyprofibus.gsd.fields import *
+from pyprofibus.version import VERSION_STRING
+
+import os
+import sys
+
+try:
+	import marshal
+	import hashlib
+except ImportError:
+	marshal = hashlib = None
+
+__all__ = [
+	"GsdCache",
+]
+
+class GsdCache(object):
+	"""On-disk cache of parsed GSD field trees.
+	Entries are keyed by a hash of the GSD file contents,
+	the pyprofibus version and the Python version.
+	"""
+
+	# Cache file format version. Increment on incompatible changes
+	# of the file format or the parser output.
+	FORMAT_VERSION = 2
+
+	MAGIC = b"PBGSDC\x00\x01"
+
+	__itemClasses = {
+		cls.REPR_NAME : cls
+		for cls in (PrmText, PrmTextValue,
+			    ExtUserPrmData, ExtUserPrmDataConst,
+			    ExtUserPrmDataRef, Module)
+	}
+
+	__slots__ = (
+		"cacheDir",
+	)
+
+	@classmethod
+	def available(cls):
+		"""Returns True, if caching is supported on this platform.
+		"""
+		return marshal is not None
+
+	@classmethod
+	def getDefaultDir(cls):
+		"""Get the default cache directory.
+		Returns None, if caching is disabled via the environment.
+		"""
+		if os.getenv("PYPROFIBUS_GSD_CACHE", "1").strip() == "0":
+			return None
+		cacheDir = os.getenv("PYPROFIBUS_GSD_CACHE_DIR", "")
+		if cacheDir:
+			return cacheDir
+		cacheHome = os.getenv("XDG_CACHE_HOME", "")
+		if not cacheHome:
+			home = os.getenv("HOME", "")
+			if not home:
+				return None
+			cacheHome = os.path.join(home, ".cache")
+		return os.path.join(cacheHome, "pyprofibus", "gsd")
+
+	def __init__(self, cacheDir):
+		self.cacheDir = cacheDir
+
+	# Read size for hashing GSD files.
+	CHUNK_SIZE = 0x10000
+
+	@classmethod
+	def __newHash(cls):
+		if hasattr(sys, "implementation"):
+			implName = sys.implementation.name
+		else:
+			implName = "python"
+		h = hashlib.sha256()
+		h.update(("%s|%d|%s|%d.%d|" % (
+			VERSION_STRING,
+			cls.FORMAT_VERSION,
+			implName,
+			sys.version_info[0],
+			sys.version_info[1])).encode("UTF-8"))
+		return h
+
+	@classmethod
+	def makeKey(cls, data):
+		"""Calculate the cache key for the raw GSD file data.
+		"""
+		h = cls.__newHash()
+		h.update(data)
+		return h.hexdigest()
+
+	@classmethod
+	def makeFileKey(cls, filepath):
+		"""Calculate the cache key for a GSD file.
+		The file is hashed in chunks. It is never read as a whole.
+		Raises IOError, if the file cannot be read.
+		"""
+		h = cls.__newHash()
+		with open(filepath, "rb") as fd:
+			while True:
+				chunk = fd.read(cls.CHUNK_SIZE)
+				if not chunk:
+					break
+				h.update(chunk)
+		return h.hexdigest()
+
+	@classmethod
+	def encode(cls, x):
+		"""Convert a field tree into marshal compatible data.
+		Field items are converted to tuples.
+		"""
+		if isinstance(x, dict):
+			return { name : cls.encode(value)
+				 for name, value in x.items() }
+		if isinstance(x, list):
+			return [ cls.encode(value) for value in x ]
+		itemClass = cls.__itemClasses.get(getattr(x, "REPR_NAME", None))
+		if itemClass is not None and isinstance(x, itemClass):
+			return ((x.REPR_NAME, ) +
+				tuple(cls.encode(getattr(x, slot))
+				      for slot in type(x).__slots__) +
+				(cls.encode(x.fields), ))
+		return x
+
+	@classmethod
+	def decode(cls, x):
+		"""Convert data from encode() back into a field tree.
+		"""
+		if isinstance(x, dict):
+			return { name : cls.decode(value)
+				 for name, value in x.items() }
+		if isinstance(x, list):
+			return [ cls.decode(value) for value in x ]
+		if isinstance(x, tuple):
+			itemClass = cls.__itemClasses[x[0]]
+			args = [ cls.decode(value) for value in x[1:-1] ]
+			return itemClass(*args, fields=cls.decode(x[-1]))
+		return x
+
+	def __path(self, key):
+		return os.path.join(self.cacheDir, key + ".gsdc")
+
+	def load(self, key):
+		"""Load a field tree from the cache.
+		Returns None, if there is no valid entry.
+		"""
+		if not self.available():
+			return None
+		try:
+			with open(self.__path(key), "rb") as fd:
+				data = fd.read()
+			if not data.startswith(self.MAGIC):
+				return None
+			return self.decode(marshal.loads(data[len(self.MAGIC):]))
+		except (IOError, OSError, EOFError,
+			ValueError, TypeError, KeyError, IndexError):
+			return None
+
+	def store(self, key, fields):
+		"""Store a field tree in the cache.
+		Returns True on success.
+		"""
+		if not self.available():
+			return False
+		path = self.__path(key)
+		tmpPath = "%s.%d.tmp" % (path, os.getpid())
+		try:
+			data = marshal.dumps(self.encode(fields))
+			try:
+				os.makedirs(self.cacheDir)
+			except OSError:
+				pass
+			with open(tmpPath, "wb") as fd:
+				fd.write(self.MAGIC)
+				fd.write(data)
+			os.rename(tmpPath, path)
+		except (IOError, OSError, ValueError):
+			try:
+				os.unlink(tmpPath)
+			except OSError:
+				pass
+			return False
+		return True
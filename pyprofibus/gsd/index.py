@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+#
+# PROFIBUS - GSD library index
+#
+# Licensed under the terms of the GNU General Public License version 2,
+# or (at your option) any later version.
+#
+
+from __future__ import division, absolute_import, print_function, unicode_literals
+from pyprofibus.compat import *
+
+from pyprofibus.gsd.interp import GsdInterp
+from pyprofibus.gsd.parser import GsdError
+
+import json
+import os
+
+try:
+	from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+	ProcessPoolExecutor = None
+
+__all__ = [
+	"GsdIndexEntry",
+	"GsdIndex",
+]
+
+class GsdIndexEntry(object):
+	"""Summary of one GSD file in a GsdIndex.
+	"""
+
+	__slots__ = (
+		"filename",
+		"mtime",
+		"size",
+		"identNumber",
+		"vendor",
+		"model",
+		"revision",
+		"modules",
+		"baudrates",
+		"maxTSDR",
+	)
+
+	def __init__(self, filename, mtime, size,
+		     identNumber=None, vendor="", model="", revision="",
+		     modules=None, baudrates=None, maxTSDR=None):
+		self.filename = filename
+		self.mtime = mtime
+		self.size = size
+		self.identNumber = identNumber
+		self.vendor = vendor
+		self.model = model
+		self.revision = revision
+		self.modules = modules or []
+		self.baudrates = baudrates or []
+		self.maxTSDR = maxTSDR or {}
+
+	@classmethod
+	def fromGsd(cls, filename, mtime, size, gsd):
+		"""Create an entry from a parsed GsdInterp.
+		"""
+		maxTSDR = {}
+		for baudrate in gsd.getSupportedBaudrates():
+			tsdr = gsd.getMaxTSDR(baudrate)
+			if tsdr is not None:
+				maxTSDR[baudrate] = tsdr
+		return cls(filename=filename,
+			   mtime=mtime,
+			   size=size,
+			   identNumber=gsd.getField("Ident_Number"),
+			   vendor=gsd.getField("Vendor_Name", "").strip(),
+			   model=gsd.getField("Model_Name", "").strip(),
+			   revision=gsd.getField("Revision", "").strip(),
+			   modules=[ m.name.strip()
+				     for m in gsd.getField("Module", []) ],
+			   baudrates=gsd.getSupportedBaudrates(),
+			   maxTSDR=maxTSDR)
+
+	def toDict(self):
+		d = { name : getattr(self, name) for name in self.__slots__ }
+		# JSON keys must be strings.
+		d["maxTSDR"] = { str(b) : t for b, t in self.maxTSDR.items() }
+		return d
+
+	@classmethod
+	def fromDict(cls, d):
+		d = dict(d)
+		d["maxTSDR"] = { int(b) : t for b, t in d.get("maxTSDR", {}).items() }
+		return cls(**d)
+
+	def matchText(self, text):
+		"""Returns True, if text is contained in the vendor, model
+		or one of the module names (case insensitive).
+		"""
+		text = text.lower()
+		return any(text in s.lower()
+			   for s in [ self.vendor, self.model ] + self.modules)
+
+	def __str__(self):
+		return "%s: Ident %s; %s; %s; %s" % (
+			self.filename,
+			("0x%04X" % self.identNumber)
+				if self.identNumber is not None else "-",
+			self.vendor, self.model, self.revision)
+
+def _indexGsdFile(args):
+	"""Parse a GSD file and return the GsdIndexEntry dict.
+	Returns None, if parsing failed.
+	This is executed in a worker process.
+	"""
+	filename, mtime, size = args
+	try:
+		gsd = GsdInterp.fromFile(filename, useCache=False)
+		if gsd.getField("Ident_Number") is None:
+			return None
+		return GsdIndexEntry.fromGsd(filename, mtime, size, gsd).toDict()
+	except GsdError:
+		return None
+
+class GsdIndex(object):
+	"""Persistent index of a GSD file library.
+	"""
+
+	# Index file format version. Increment on incompatible changes.
+	FORMAT_VERSION = 1
+
+	# File name extensions of GSD files.
+	# The last character selects the language.
+	EXTENSIONS = (".gsd", ".gse", ".gsg", ".gsf", ".gsi", ".gsp", ".gss")
+
+	# Default index file name inside of the library directory.
+	DEFAULT_FILENAME = ".pyprofibus-gsdindex.json"
+
+	__slots__ = (
+		"indexFile",
+		"__entries",
+		"__byIdent",
+	)
+
+	def __init__(self, indexFile):
+		self.indexFile = indexFile
+		self.__entries = {}
+		self.__byIdent = None
+
+	@classmethod
+	def forDirectory(cls, directory):
+		"""Get the index for the GSD library directory.
+		The index is loaded, if it exists.
+		"""
+		index = cls(os.path.join(directory, cls.DEFAULT_FILENAME))
+		if os.path.exists(index.indexFile):
+			index.load()
+		return index
+
+	def getEntries(self):
+		"""Get a list of all GsdIndexEntry()s sorted by file name.
+		"""
+		return [ self.__entries[f] for f in sorted(self.__entries) ]
+
+	def load(self):
+		"""Load the index file.
+		"""
+		try:
+			with open(self.indexFile, "r") as fd:
+				data = json.load(fd)
+			if data.get("version") != self.FORMAT_VERSION:
+				raise GsdError("GSD index '%s': Unsupported "
+					"format version." % self.indexFile)
+			entries = {}
+			for d in data["entries"]:
+				entry = GsdIndexEntry.fromDict(d)
+				entries[entry.filename] = entry
+		except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+			raise GsdError("Failed to load GSD index '%s': %s" % (
+				self.indexFile, str(e)))
+		self.__entries = entries
+		self.__byIdent = None
+
+	def save(self):
+		"""Write the index file.
+		"""
+		tmpFile = self.indexFile + ".tmp"
+		try:
+			with open(tmpFile, "w") as fd:
+				json.dump({
+					"version"	: self.FORMAT_VERSION,
+					"entries"	: [ e.toDict() for e in self.getEntries() ],
+				}, fd, sort_keys=True)
+			os.rename(tmpFile, self.indexFile)
+		except (IOError, OSError) as e:
+			raise GsdError("Failed to write GSD index '%s': %s" % (
+				self.indexFile, str(e)))
+
+	@classmethod
+	def __scanDirectory(cls, directory):
+		for dirpath, dirnames, filenames in os.walk(directory):
+			dirnames.sort()
+			for name in sorted(filenames):
+				if name.lower().endswith(cls.EXTENSIONS):
+					yield os.path.join(dirpath, name)
+
+	def update(self, directory, parallel=True):
+		"""Scan the directory recursively for GSD files
+		and update the index.
+		Only new and modified files are parsed.
+		If parallel is True, the files are parsed in worker processes.
+		Returns a tuple (nrParsed, nrFailed).
+		"""
+		entries = {}
+		todo = []
+		try:
+			for filename in self.__scanDirectory(directory):
+				st = os.stat(filename)
+				mtime, size = st.st_mtime, st.st_size
+				entry = self.__entries.get(filename)
+				if entry and entry.mtime == mtime and entry.size == size:
+					entries[filename] = entry
+				else:
+					todo.append((filename, mtime, size))
+		except (IOError, OSError) as e:
+			raise GsdError("Failed to scan GSD directory '%s': %s" % (
+				directory, str(e)))
+
+		results = None
+		if parallel and ProcessPoolExecutor is not None and len(todo) > 1:
+			try:
+				with ProcessPoolExecutor() as executor:
+					results = list(executor.map(_indexGsdFile, todo,
+								    chunksize=16))
+			except (OSError, RuntimeError):
+				results = None
+		if results is None:
+			results = [ _indexGsdFile(args) for args in todo ]
+
+		nrFailed = 0
+		for d in results:
+			if d is None:
+				nrFailed += 1
+				continue
+			entry = GsdIndexEntry.fromDict(d)
+			entries[entry.filename] = entry
+		self.__entries = entries
+		self.__byIdent = None
+		return (len(todo) - nrFailed, nrFailed)
+
+	def find(self, identNumber=None, text=None):
+		"""Find GSD files.
+		identNumber: Match this Ident_Number. None matches all.
+		text: Match this text in vendor, model or module names.
+		Returns a list of GsdIndexEntry()s.
+		"""
+		if identNumber is None:
+			entries = self.getEntries()
+		else:
+			if self.__byIdent is None:
+				self.__byIdent = {}
+				for entry in self.getEntries():
+					self.__byIdent.setdefault(entry.identNumber,
+								  []).append(entry)
+			entries = self.__byIdent.get(identNumber, [])
+		if text:
+			entries = [ e for e in entries if e.matchText(text) ]
+		return list(entries)
@@ -24,13 +24,38 @@ class GsdInterp(GsdParser):
 	"""GSD file/data interpreter.
 	"""
 
+	class _Shared(object):
+		"""Data derived from the parsed GSD.
+		This is shared between all views of the GSD.
+		"""
+
+		__slots__ = (
+			"moduleIndex",
+			"memo",
+		)
+
+		def __init__(self):
+			self.moduleIndex = None
+			self.memo = {}
+
 	def __init__(self, text, filename=None, debug=False):
 		super(GsdInterp, self).__init__(text, filename, debug)
+		self.__shared = self._Shared()
 		self.__configMods = []
 		self.__addPresetModules(onlyFixed=False)
 		if not self.isModular():
 			self.__addAllModules()
 
+	def newView(self):
+		"""Create a new GsdInterp with its own module configuration.
+		The parsed GSD data is not copied, but shared with this instance.
+		"""
+		view = self.__class__(self.getFields(),
+				      self.getFileName(),
+				      self.debugEnabled())
+		view.__shared = self.__shared
+		return view
+
 	def __interpErr(self, errorText):
 		raise GsdError("GSD '%s': %s" % (
 			self.getFileName() or "<data>",
@@ -43,49 +68,96 @@ class GsdInterp(GsdParser):
 			self.getFileName() or "<data>",
 			errorText))
 
-	@staticmethod
-	def __findInSequence(sequence, findName, getItemName):
-		if not sequence:
-			return None
-		nameLower = findName.lower().strip()
-
-		# Check if there's only one matching exactly.
-		matches = [ item for item in sequence
-			    if findName == getItemName(item) ]
-		if len(matches) == 1:
-			return matches[0]
-
-		# Check if there's only one matching exactly (case insensitive).
-		matches = [ item for item in sequence
-			    if nameLower == getItemName(item).lower().strip() ]
-		if len(matches) == 1:
-			return matches[0]
-
-		# Check if there's only one matching at the start.
-		matches = [ item for item in sequence
-			    if getItemName(item).lower().strip().startswith(nameLower) ]
-		if len(matches) == 1:
-			return matches[0]
-
-		# Fuzzy match.
-		matches = difflib.get_close_matches(
-				findName,
-				( getItemName(item) for item in sequence ),
-				n = 1)
-		if matches:
-			matches = [ item for item in sequence
-				    if getItemName(item) == matches[0] ]
-			if matches:
+	class _NameIndex(object):
+		"""Name lookup index over a sequence of items.
+		"""
+
+		__slots__ = (
+			"__exact",
+			"__lower",
+			"__prefixKeys",
+			"__prefixItems",
+			"__names",
+			"__fuzzyCache",
+		)
+
+		def __init__(self, sequence, getItemName):
+			self.__exact = {}
+			self.__lower = {}
+			prefix = []
+			for i, item in enumerate(sequence):
+				name = getItemName(item)
+				nameLower = name.lower().strip()
+				self.__exact.setdefault(name, []).append(item)
+				self.__lower.setdefault(nameLower, []).append(item)
+				prefix.append((nameLower, i, item))
+			prefix.sort(key=lambda p: (p[0], p[1]))
+			self.__prefixKeys = [ p[0] for p in prefix ]
+			self.__prefixItems = [ p[2] for p in prefix ]
+			self.__names = [ getItemName(item) for item in sequence ]
+			self.__fuzzyCache = {}
+
+		@staticmethod
+		def __bisectLeft(keys, key):
+			"""Get the index of the first element in
+			the sorted list keys that is not less than key.
+			"""
+			lo, hi = 0, len(keys)
+			while lo < hi:
+				mid = (lo + hi) // 2
+				if keys[mid] < key:
+					lo = mid + 1
+				else:
+					hi = mid
+			return lo
+
+		def find(self, findName):
+			"""Find an item by name.
+			Returns None, if not found.
+			"""
+			nameLower = findName.lower().strip()
+
+			# Check if there's only one matching exactly.
+			matches = self.__exact.get(findName)
+			if matches and len(matches) == 1:
 				return matches[0]
-		return None
+
+			# Check if there's only one matching exactly (case insensitive).
+			matches = self.__lower.get(nameLower)
+			if matches and len(matches) == 1:
+				return matches[0]
+
+			# Check if there's only one matching at the start.
+			keys = self.__prefixKeys
+			i = self.__bisectLeft(keys, nameLower)
+			if i < len(keys) and keys[i].startswith(nameLower) and\
+			   (i + 1 >= len(keys) or not keys[i + 1].startswith(nameLower)):
+				return self.__prefixItems[i]
+
+			# Fuzzy match.
+			try:
+				return self.__fuzzyCache[findName]
+			except KeyError:
+				pass
+			item = None
+			matches = difflib.get_close_matches(findName, self.__names, n = 1)
+			if matches:
+				matches = self.__exact.get(matches[0])
+				if matches:
+					item = matches[0]
+			self.__fuzzyCache[findName] = item
+			return item
 
 	def findModule(self, name):
 		"""Find a module by name.
 		Returns a _Module instance, if found. None otherwise.
 		"""
-		return self.__findInSequence(self.getField("Module"),
-					     name,
-					     lambda module: module.name)
+		shared = self.__shared
+		if shared.moduleIndex is None:
+			shared.moduleIndex = self._NameIndex(
+				self.getField("Module", []),
+				lambda module: module.name)
+		return shared.moduleIndex.find(name)
 
 	def __addPresetModules(self, onlyFixed=False):
 		if not self.getField("FixPresetModules", False) and\
@@ -146,10 +218,30 @@ class GsdInterp(GsdParser):
 		"""
 		return self.getField("DPV1_Slave", False)
 
+	def __memoized(self, name, calc, *args):
+		"""Call calc(*args) and memoise the result for the
+		current module configuration and the arguments.
+		"""
+		key = (name,
+		       tuple(id(mod) for mod in self.__configMods),
+		       tuple(None if a is None else bytes(a) for a in args))
+		memo = self.__shared.memo
+		try:
+			return memo[key]
+		except KeyError:
+			result = memo[key] = calc(*args)
+			return result
+
 	def getCfgDataElements(self):
-		"""Get a tuple of config data elements (DpCfgDataElement)
+		"""Get a list of config data elements (DpCfgDataElement)
 		for this station with the configured modules.
+		The returned elements are copies and may be modified.
 		"""
+		return [ DpCfgDataElement(e.identifier, bytes(e.lengthBytes))
+			 for e in self.__memoized("CfgDataElements",
+						  self.__calcCfgDataElements) ]
+
+	def __calcCfgDataElements(self):
 		elems = []
 		for mod in self.__configMods:
 			elems.append(DpCfgDataElement(
@@ -162,6 +254,11 @@ class GsdInterp(GsdParser):
 		for this station with the configured modules.
 		dp1PrmMask/Set: Optional mask/set override for the DPV1 prm.
 		"""
+		return bytearray(self.__memoized("UserPrmData",
+						 self.__calcUserPrmData,
+						 dp1PrmMask, dp1PrmSet))
+
+	def __calcUserPrmData(self, dp1PrmMask, dp1PrmSet):
 		def merge(baseData, extData, offset):
 			if extData is not None:
 				baseData[offset : len(extData) + offset] = extData
@@ -214,27 +311,36 @@ class GsdInterp(GsdParser):
 			self.__interpErr("No Ident_Number in GSD.")
 		return ident
 
+	# Baud rate to GSD field name suffix.
+	_baud2fieldname = {
+		9600		: "9.6",
+		19200		: "19.2",
+		45450		: "45.45",
+		93750		: "93.75",
+		187500		: "187.5",
+		500000		: "500",
+		1500000		: "1.5M",
+		3000000		: "3M",
+		6000000		: "6M",
+		12000000	: "12M",
+	}
+
 	def getMaxTSDR(self, baudrate):
 		"""Get the max-tSDR.
 		Might return None.
 		"""
-		baud2fieldname = {
-			9600		: "MaxTsdr_9.6",
-			19200		: "MaxTsdr_19.2",
-			45450		: "MaxTsdr_45.45",
-			93750		: "MaxTsdr_93.75",
-			187500		: "MaxTsdr_187.5",
-			500000		: "MaxTsdr_500",
-			1500000		: "MaxTsdr_1.5M",
-			3000000		: "MaxTsdr_3M",
-			6000000		: "MaxTsdr_6M",
-			12000000	: "MaxTsdr_12M",
-		}
-		if baudrate not in baud2fieldname:
+		if baudrate not in self._baud2fieldname:
 			self.__interpErr("getMaxTSDR: Invalid baud rate.")
-		fieldname = baud2fieldname[baudrate]
+		fieldname = "MaxTsdr_" + self._baud2fieldname[baudrate]
 		return self.getField(fieldname, None)
 
+	def getSupportedBaudrates(self):
+		"""Get a sorted list of the supported baud rates.
+		"""
+		return sorted(baudrate
+			      for baudrate, name in self._baud2fieldname.items()
+			      if self.getField(name + "_supp", False))
+
 	def __str__(self):
 		text = []
 
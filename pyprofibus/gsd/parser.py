@@ -11,11 +11,11 @@
 from __future__ import division, absolute_import, print_function, unicode_literals
 from pyprofibus.compat import *
 
-import gc
 import re
 
 from pyprofibus.util import ProfibusError
 from pyprofibus.gsd.fields import *
+from pyprofibus.gsd.cache import GsdCache
 
 __all__ = [
 	"GsdError",
@@ -47,7 +47,11 @@ class GsdParser(object):
 				self.lineNr, self.text)
 
 	@classmethod
-	def fromFile(cls, filepath, debug=False):
+	def fromFile(cls, filepath, debug=False, useCache=True):
+		"""Parse a GSD file.
+		If useCache is True, the parsed result is stored in
+		and loaded from the on-disk GsdCache.
+		"""
 		def readfile():
 			try:
 				with open(filepath, "rb") as fd:
@@ -59,7 +63,22 @@ class GsdParser(object):
 			except (IOError, UnicodeError) as e:
 				raise GsdError("Failed to read GSD file '%s':\n%s" % (
 					filepath, str(e)))
-		return cls(readfile(), filepath, debug)
+
+		cacheDir = GsdCache.getDefaultDir() if useCache else None
+		if not cacheDir or not GsdCache.available():
+			return cls(readfile(), filepath, debug)
+		try:
+			cache = GsdCache(cacheDir)
+			key = cache.makeFileKey(filepath)
+		except IOError as e:
+			raise GsdError("Failed to read GSD file '%s':\n%s" % (
+				filepath, str(e)))
+		fields = cache.load(key)
+		if fields is not None:
+			return cls(fields, filepath, debug)
+		self = cls(readfile(), filepath, debug)
+		cache.store(key, self.getFields())
+		return self
 
 	@classmethod
 	def fromBytes(cls, data, filename=None, debug=False):
@@ -139,84 +158,83 @@ class GsdParser(object):
 	def getFileName(self):
 		return self.__filename
 
+	def getFields(self):
+		"""Get the parsed field tree.
+		"""
+		return self.__fields
+
 	def debugEnabled(self):
 		return self.__debug
 
 	def __reset(self):
 		self.__fields = {}
 
-	def __preprocess(self, lines):
-		lines = [ self._Line(i + 1, l)
-			  for i, l in enumerate(lines) ]
-
-		# Find the GSD section and discard the rest.
-		newLines, inGsd = [], False
-		for line in lines:
-			if inGsd:
-				if line.text.startswith("#"):
-					break
-				newLines.append(line)
-			else:
-				if line.text == "#Profibus_DP":
-					inGsd = True
-		lines = newLines
-		gc.collect()
-
-		# Remove comments
-		newLines = []
-		for line in lines:
-			newLineText, inQuote = [], False
-			for c in line.text:
-				if inQuote:
-					inQuote = (c == '"')
-				else:
-					if c == ";":
-						line.text = "".join(newLineText)
-						line.text = line.text.rstrip()
+	@classmethod
+	def _tokenize(cls, lines):
+		"""Tokenize raw GSD lines in a single pass.
+		Extracts the #Profibus_DP section, removes comments,
+		joins continuation lines and strips whitespace.
+		This is a generator yielding one _Line per logical line.
+		"""
+		inGsd, cont = False, None
+		for lineNr, text in enumerate(lines, 1):
+			# Only the #Profibus_DP section is of interest.
+			if not inGsd:
+				inGsd = (text == "#Profibus_DP")
+				continue
+			if text.startswith("#"):
+				break
+
+			# Remove the comment, if any.
+			if ";" in text:
+				inQuote = False
+				for i, c in enumerate(text):
+					if c == '"':
+						inQuote = not inQuote
+					elif c == ";" and not inQuote:
+						text = text[:i]
 						break
-					inQuote = (c == '"')
-				newLineText.append(c)
-			newLines.append(line)
-		lines = newLines
-		gc.collect()
-
-		# Expand line continuations.
-		newLines, inCont = [], False
-		for line in lines:
-			if inCont:
-				if line.text.endswith("\\"):
-					line.text = line.text[:-1]
-				else:
-					inCont = False
-				newLines[-1].text += line.text
+			text = text.rstrip()
+
+			# Join continuation lines.
+			isCont = text.endswith("\\")
+			if isCont:
+				text = text[:-1]
+			if cont is None:
+				cont = cls._Line(lineNr, text)
 			else:
-				if line.text.endswith("\\"):
-					line.text = line.text[:-1]
-					inCont = True
-				newLines.append(line)
-		lines = newLines
-		gc.collect()
-
-		# Strip all lines and remove empty lines.
-		newLines = []
-		for line in lines:
-			line.text = line.text.strip()
-			if line.text:
-				newLines.append(line)
-		lines = newLines
-		gc.collect()
-
-		return lines
+				cont.text += text
+			if isCont:
+				continue
+
+			cont.text = cont.text.strip()
+			if cont.text:
+				yield cont
+			cont = None
+		if cont is not None:
+			cont.text = cont.text.strip()
+			if cont.text:
+				yield cont
 
 	_reNum = r'(?:0x[0-9a-fA-F]+)|(?:[0-9]+)'
 	_reStr = r'[ a-zA-Z0-9\._\-\+\*\/\<\>\(\)\[\]\{\}\!\$\%\&\?\^\|\=\#\;\,\:\`]+'
-
-	_reExtUserPrmData = re.compile(r'^ExtUserPrmData\s*=\s*(' +\
-				       _reNum + r')\s+' +\
-				       r'"(' + _reStr + r')"$')
-	_reModule = re.compile(r'^Module\s*=\s*' +\
-			       r'"(' + _reStr + r')"\s+' +\
-			       r'(.+)$')
+	_reOffset = r'\s*\(\s*(' + _reNum + r')\s*\)'
+
+	# Value patterns. These match the line text following the keyword.
+	_reValNum = re.compile(r'^\s*=\s*(' + _reNum + r')$')
+	_reValNumOffset = re.compile(r'^' + _reOffset +\
+				     r'\s*=\s*(' + _reNum + r')$')
+	_reValStr = re.compile(r'^\s*=\s*"(' + _reStr + r')"$')
+	_reValStrOffset = re.compile(r'^' + _reOffset +\
+				     r'\s*=\s*"(' + _reStr + r')"$')
+	_reValAny = re.compile(r'^\s*=\s*(.*)$')
+	_reValAnyOffset = re.compile(r'^' + _reOffset +\
+				     r'\s*=\s*(.*)$')
+	_reValExtUserPrmData = re.compile(r'^\s*=\s*(' + _reNum + r')\s+' +\
+					  r'"(' + _reStr + r')"$')
+	_reValModule = re.compile(r'^\s*=\s*' +\
+				  r'"(' + _reStr + r')"\s+' +\
+				  r'(.+)$')
 
 	_STATE_GLOBAL		= 0
 	_STATE_PRMTEXT		= 1
@@ -250,253 +268,235 @@ class GsdParser(object):
 		data = [ cls.__parseNum(d) for d in data ]
 		return bytes(data)
 
-	def __trySimpleNum(self, line, name, hasOffset = False):
-		m = re.match(r'^' + name +\
-			     ((r'\s*\(\s*(' + self._reNum + r')\s*\)\s*')\
-			      if hasOffset else r'\s*') +\
-			     r'=\s*(' + self._reNum + r')$',
-			     line.text)
-		offset, value = None, None
-		if m:
-			try:
-				if hasOffset:
-					offset = self.__parseNum(m.group(1))
-					value = m.group(2)
-				else:
-					value = m.group(1)
-				value = self.__parseNum(value)
-			except ValueError as e:
-				self.__parseErr(line, "%s invalid" % name)
-		return (offset, value) if hasOffset else value
-
-	def __trySimpleBool(self, line, name):
-		value = self.__trySimpleNum(line, name)
-		if value is not None:
-			return bool(value)
-		return None
-
-	def __trySimpleStr(self, line, name, hasOffset = False):
-		m = re.match(r'^' + name +\
-			     ((r'\s*\(\s*(' + self._reNum + r')\s*\)\s*')\
-			      if hasOffset else r'\s*') +\
-			     r'=\s*"(' + self._reStr + r')"$',
-			     line.text)
-		offset, value = None, None
-		if m:
-			if hasOffset:
-				offset = m.group(1)
-				try:
-					if offset.strip().startswith("0x"):
-						offset = int(offset, 16)
-					else:
-						offset = int(offset, 10)
-				except ValueError as e:
-					self.__parseErr(line, "%s invalid" % name)
-				value = m.group(2)
-			else:
-				value = m.group(1)
-		return (offset, value) if hasOffset else value
-
-	def __tryStrNoQuotes(self, line, name):
-		m = re.match(r'^' + name + r'\s*=\s*(.*)$',
-			     line.text)
-		if m:
-			return m.group(1)
-		return None
-
-	def __tryByteArray(self, line, name, hasOffset = False):
-		m = re.match(r'^' + name +\
-			     ((r'\s*\(\s*(' + self._reNum + r')\s*\)\s*')\
-			      if hasOffset else r'\s*') +\
-			     r'=\s*(.*)$',
-			     line.text)
-		offset, data = None, None
-		if m:
-			try:
-				if hasOffset:
-					offset = self.__parseNum(m.group(1))
-					data = self.__parseByteArray(m.group(2))
-				else:
-					data = self.__parseByteArray(m.group(1))
-			except ValueError as e:
-				self.__parseErr(line, "%s invalid" % name)
-		return (offset, data) if hasOffset else data
+	@staticmethod
+	def __splitKeyword(text):
+		"""Split a line into the keyword and the rest of the line.
+		The keyword ends at the first '=' or '('.
+		"""
+		i = text.find("=")
+		j = text.find("(")
+		if j >= 0 and (i < 0 or j < i):
+			i = j
+		if i < 0:
+			return text, ""
+		return text[:i].rstrip(), text[i:]
+
+	# Keyword handlers.
+	# Each handler is called with the line, the keyword, the rest
+	# of the line after the keyword and the target fields dict.
+	# A handler returns False, if the line could not be parsed.
+
+	def __kwNum(self, line, name, rest, target):
+		m = self._reValNum.match(rest)
+		if not m:
+			return False
+		try:
+			target[name] = self.__parseNum(m.group(1))
+		except ValueError as e:
+			self.__parseErr(line, "%s invalid" % name)
+		return True
+
+	def __kwBool(self, line, name, rest, target):
+		if not self.__kwNum(line, name, rest, target):
+			return False
+		target[name] = bool(target[name])
+		return True
+
+	def __kwStr(self, line, name, rest, target):
+		m = self._reValStr.match(rest)
+		if not m:
+			return False
+		target[name] = m.group(1)
+		return True
+
+	def __kwByteArray(self, line, name, rest, target):
+		m = self._reValAny.match(rest)
+		if not m:
+			return False
+		try:
+			target[name] = self.__parseByteArray(m.group(1))
+		except ValueError as e:
+			self.__parseErr(line, "%s invalid" % name)
+		return True
+
+	def __kwSlaveFamily(self, line, name, rest, target):
+		m = self._reValAny.match(rest)
+		if not m:
+			return False
+		target[name] = m.group(1).split("@")
+		return True
+
+	def __kwExtUserPrmDataConst(self, line, name, rest, target):
+		m = self._reValAnyOffset.match(rest)
+		if not m:
+			return False
+		try:
+			offset = self.__parseNum(m.group(1))
+			data = self.__parseByteArray(m.group(2))
+		except ValueError as e:
+			self.__parseErr(line, "%s invalid" % name)
+		target.setdefault(name, []).append(
+			ExtUserPrmDataConst(offset, data))
+		return True
+
+	def __kwExtUserPrmDataRef(self, line, name, rest, target):
+		m = self._reValNumOffset.match(rest)
+		if not m:
+			return False
+		try:
+			offset = self.__parseNum(m.group(1))
+			value = self.__parseNum(m.group(2))
+		except ValueError as e:
+			self.__parseErr(line, "%s invalid" % name)
+		target.setdefault(name, []).append(
+			ExtUserPrmDataRef(offset, value))
+		return True
+
+	def __kwPrmText(self, line, name, rest, target):
+		m = self._reValNum.match(rest)
+		if not m:
+			return False
+		try:
+			refNr = self.__parseNum(m.group(1))
+		except ValueError as e:
+			self.__parseErr(line, "%s invalid" % name)
+		target.setdefault(name, []).append(PrmText(refNr))
+		self.__state = self._STATE_PRMTEXT
+		return True
+
+	def __kwExtUserPrmData(self, line, name, rest, target):
+		m = self._reValExtUserPrmData.match(rest)
+		if not m:
+			return False
+		try:
+			refNr = self.__parseNum(m.group(1))
+		except ValueError as e:
+			self.__parseErr(line, "ExtUserPrmData invalid")
+		target.setdefault(name, []).append(
+			ExtUserPrmData(refNr, m.group(2)))
+		self.__state = self._STATE_EXTUSERPRMDATA
+		return True
+
+	def __kwModule(self, line, name, rest, target):
+		m = self._reValModule.match(rest)
+		if not m:
+			return False
+		try:
+			configBytes = self.__parseByteArray(m.group(2))
+		except ValueError as e:
+			self.__parseErr(line, "Module invalid")
+		target.setdefault(name, []).append(
+			Module(m.group(1), configBytes))
+		self.__state = self._STATE_MODULE
+		return True
+
+	def __kwText(self, line, name, rest, target):
+		m = self._reValStrOffset.match(rest)
+		if not m:
+			return False
+		try:
+			offset = self.__parseNum(m.group(1))
+		except ValueError as e:
+			self.__parseErr(line, "%s invalid" % name)
+		self.__fields["PrmText"][-1].texts.append(
+			PrmTextValue(offset, m.group(2)))
+		return True
+
+	# Keyword dispatch tables for the parser states.
+	_globalKeywords = {}
+	_globalKeywords.update(dict.fromkeys((
+		"GSD_Revision", "Ident_Number",
+		"Protocol_Ident", "Station_Type",
+		"Repeater_Ctrl_Sig", "24V_Pins",
+		"S7HeaderCnf", "OffsetFirstMPDBlock",
+		"ETERDelay", "MaxResponseDelay",
+		"Min_Slave_Intervall", "Max_Diag_Data_Len",
+		"Modul_Offset", "Max_Module",
+		"Max_Input_Len", "Max_Output_Len",
+		"Max_Data_Len", "MaxTsdr_9.6", "MaxTsdr_19.2",
+		"MaxTsdr_45.45", "MaxTsdr_93.75", "MaxTsdr_187.5",
+		"MaxTsdr_500", "MaxTsdr_1.5M", "MaxTsdr_3M",
+		"MaxTsdr_6M", "MaxTsdr_12M", "User_Prm_Data_Len",
+		"Max_User_Prm_Data_Len"), __kwNum))
+	_globalKeywords.update(dict.fromkeys((
+		"Freeze_Mode_supp", "Sync_Mode_supp",
+		"Set_Slave_Add_supp", "Redundancy",
+		"IsActive", "OnlyNormalModules",
+		"DiagBufferable", "Fail_Safe",
+		"Modular_Station", "Auto_Baud_supp",
+		"9.6_supp", "19.2_supp", "45.45_supp",
+		"93.75_supp", "187.5_supp", "500_supp",
+		"1.5M_supp", "3M_supp", "6M_supp",
+		"12M_supp", "FixPresetModules",
+		"DPV1_Slave"), __kwBool))
+	_globalKeywords.update(dict.fromkeys((
+		"Vendor_Name", "Model_Name",
+		"Revision", "Hardware_Release",
+		"Software_Release", "Implementation_Type",
+		"Bitmap_Device", "Bitmap_SF",
+		"OrderNumber", "Periphery"), __kwStr))
+	_globalKeywords.update({
+		"PrmText"			: __kwPrmText,
+		"Slave_Family"			: __kwSlaveFamily,
+		"User_Prm_Data"			: __kwByteArray,
+		"ExtUserPrmData"		: __kwExtUserPrmData,
+		"Ext_User_Prm_Data_Const"	: __kwExtUserPrmDataConst,
+		"Ext_User_Prm_Data_Ref"		: __kwExtUserPrmDataRef,
+		"Module"			: __kwModule,
+	})
+
+	_prmTextKeywords = {
+		"Text"				: __kwText,
+	}
+
+	_extUserPrmDataKeywords = {
+		"Prm_Text_Ref"			: __kwNum,
+	}
+
+	_moduleKeywords = {
+		"Ext_Module_Prm_Data_Len"	: __kwNum,
+		"Preset"			: __kwBool,
+		"Ext_User_Prm_Data_Const"	: __kwExtUserPrmDataConst,
+		"Ext_User_Prm_Data_Ref"		: __kwExtUserPrmDataRef,
+	}
+
+	def __parseLine(self, line, keywords, target):
+		name, rest = self.__splitKeyword(line.text)
+		handler = keywords.get(name)
+		if handler is None or not handler(self, line, name, rest, target):
+			self.__parseWarn(line, "Ignored unknown line")
 
 	def __parseLine_global(self, line):
-		# Parse simple numbers.
-		for name in ("GSD_Revision", "Ident_Number",
-			     "Protocol_Ident", "Station_Type",
-			     "Repeater_Ctrl_Sig", "24V_Pins",
-			     "S7HeaderCnf", "OffsetFirstMPDBlock",
-			     "ETERDelay", "MaxResponseDelay",
-			     "Min_Slave_Intervall", "Max_Diag_Data_Len",
-			     "Modul_Offset", "Max_Module",
-			     "Max_Input_Len", "Max_Output_Len",
-			     "Max_Data_Len", "MaxTsdr_9.6", "MaxTsdr_19.2",
-			     "MaxTsdr_45.45", "MaxTsdr_93.75", "MaxTsdr_187.5",
-			     "MaxTsdr_500", "MaxTsdr_1.5M", "MaxTsdr_3M",
-			     "MaxTsdr_6M", "MaxTsdr_12M", "User_Prm_Data_Len",
-			     "Max_User_Prm_Data_Len"):
-			value = self.__trySimpleNum(line, name)
-			if value is not None:
-				self.__fields[name] = value
-				return
-
-		# Parse simple booleans.
-		for name in ("Freeze_Mode_supp", "Sync_Mode_supp",
-			     "Set_Slave_Add_supp", "Redundancy",
-			     "IsActive", "OnlyNormalModules",
-			     "DiagBufferable", "Fail_Safe",
-			     "Modular_Station", "Auto_Baud_supp",
-			     "9.6_supp", "19.2_supp", "45.45_supp",
-			     "93.75_supp", "187.5_supp", "500_supp",
-			     "1.5M_supp", "3M_supp", "6M_supp",
-			     "12M_supp", "FixPresetModules",
-			     "DPV1_Slave"):
-			value = self.__trySimpleBool(line, name)
-			if value is not None:
-				self.__fields[name] = value
-				return
-
-		# Parse simple strings.
-		for name in ("Vendor_Name", "Model_Name",
-			     "Revision", "Hardware_Release",
-			     "Software_Release", "Implementation_Type",
-			     "Bitmap_Device", "Bitmap_SF",
-			     "OrderNumber", "Periphery"):
-			value = self.__trySimpleStr(line, name)
-			if value is not None:
-				self.__fields[name] = value
-				return
-
-		# Parse specials
-		value = self.__trySimpleNum(line, "PrmText")
-		if value is not None:
-			self.__fields.setdefault("PrmText", []).append(
-				PrmText(value))
-			self.__state = self._STATE_PRMTEXT
-			return
-		value = self.__tryStrNoQuotes(line, "Slave_Family")
-		if value is not None:
-			self.__fields["Slave_Family"] = value.split("@")
-			return
-		value = self.__tryByteArray(line, "User_Prm_Data")
-		if value is not None:
-			self.__fields["User_Prm_Data"] = value
-			return
-		m = self._reExtUserPrmData.match(line.text)
-		if m:
-			try:
-				refNr = self.__parseNum(m.group(1))
-				name = m.group(2)
-				self.__fields.setdefault("ExtUserPrmData", []).append(
-					ExtUserPrmData(refNr, name))
-				self.__state = self._STATE_EXTUSERPRMDATA
-			except ValueError as e:
-				self.__parseErr(line, "ExtUserPrmData invalid")
-			return
-		offset, value = self.__tryByteArray(line, "Ext_User_Prm_Data_Const",
-						    hasOffset = True)
-		if value is not None:
-			self.__fields.setdefault("Ext_User_Prm_Data_Const", []).append(
-				ExtUserPrmDataConst(offset, value))
-			return
-		offset, value = self.__trySimpleNum(line, "Ext_User_Prm_Data_Ref",
-						    hasOffset = True)
-		if value is not None:
-			self.__fields.setdefault("Ext_User_Prm_Data_Ref", []).append(
-				ExtUserPrmDataRef(offset, value))
-			return
-		m = self._reModule.match(line.text)
-		if m:
-			try:
-				name = m.group(1)
-				config = m.group(2)
-				configBytes = self.__parseByteArray(config)
-				self.__fields.setdefault("Module", []).append(
-					Module(name, configBytes))
-				self.__state = self._STATE_MODULE
-			except ValueError as e:
-				self.__parseErr(line, "Module invalid")
-			return
-
-		self.__parseWarn(line, "Ignored unknown line")
+		self.__parseLine(line, self._globalKeywords, self.__fields)
 
 	def __parseLine_prmText(self, line):
 		if line.text == "EndPrmText":
 			self.__state = self._STATE_GLOBAL
 			return
-
 		prmText = self.__fields["PrmText"][-1]
-
-		# Parse specials
-		offset, value = self.__trySimpleStr(line, "Text",
-						    hasOffset = True)
-		if value is not None:
-			prmText.texts.append(PrmTextValue(offset, value))
-			return
-
-		self.__parseWarn(line, "Ignored unknown line")
+		self.__parseLine(line, self._prmTextKeywords, prmText.fields)
 
 	def __parseLine_extUserPrmData(self, line):
 		if line.text == "EndExtUserPrmData":
 			self.__state = self._STATE_GLOBAL
 			return
-
 		extUserPrmData = self.__fields["ExtUserPrmData"][-1]
-
-		# Parse simple numbers.
-		for name in ("Prm_Text_Ref", ):
-			value = self.__trySimpleNum(line, name)
-			if value is not None:
-				extUserPrmData.fields[name] = value
-				return
-
-		self.__parseWarn(line, "Ignored unknown line")
+		self.__parseLine(line, self._extUserPrmDataKeywords,
+				 extUserPrmData.fields)
 
 	def __parseLine_module(self, line):
 		if line.text == "EndModule":
 			self.__state = self._STATE_GLOBAL
 			return
-
 		module = self.__fields["Module"][-1]
-
-		# Parse simple numbers.
-		for name in ("Ext_Module_Prm_Data_Len", ):
-			value = self.__trySimpleNum(line, name)
-			if value is not None:
-				module.fields[name] = value
-				return
-
-		# Parse simple booleans.
-		for name in ("Preset", ):
-			value = self.__trySimpleBool(line, name)
-			if value is not None:
-				module.fields[name] = value
-				return
-
-		# Parse specials
-		offset, value = self.__tryByteArray(line, "Ext_User_Prm_Data_Const",
-						    hasOffset = True)
-		if value is not None:
-			module.fields.setdefault("Ext_User_Prm_Data_Const", []).append(
-				ExtUserPrmDataConst(offset, value))
-			return
-		offset, value = self.__trySimpleNum(line, "Ext_User_Prm_Data_Ref",
-						    hasOffset = True)
-		if value is not None:
-			module.fields.setdefault("Ext_User_Prm_Data_Ref", []).append(
-				ExtUserPrmDataRef(offset, value))
-			return
-
-		self.__parseWarn(line, "Ignored unknown line")
+		self.__parseLine(line, self._moduleKeywords, module.fields)
 
 	def __parse(self, lines):
 		if isinstance(lines, dict):
 			self.__fields = lines
 			return
 
-		lines = self.__preprocess(lines)
+		lines = self._tokenize(lines)
 
 		self.__state = self._STATE_GLOBAL
 
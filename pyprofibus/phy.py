@@ -15,6 +15,7 @@ import time
 import sys
 from collections import deque
 
+from pyprofibus.fdl import FdlTelegram
 from pyprofibus.util import *
 
 
@@ -46,16 +47,40 @@ class CpPhy(object):
 	BAUD_6000000	= 6000000
 	BAUD_12000000	= 12000000
 
+	# Default slot time (T_SL), in bit times, per baud rate.
+	SLOT_TIME_BITS = {
+		BAUD_9600	: 100,
+		BAUD_19200	: 100,
+		BAUD_45450	: 640,
+		BAUD_93750	: 100,
+		BAUD_187500	: 100,
+		BAUD_500000	: 200,
+		BAUD_1500000	: 300,
+		BAUD_3000000	: 400,
+		BAUD_6000000	: 600,
+		BAUD_12000000	: 1000,
+	}
+
 	__slots__ = (
 		"debug",
+		"clock",
 		"__txQueueDAs",
 		"__txQueueTelegrams",
 		"__allocUntil",
+		"__busOwner",
+		"__busSrd",
+		"__slotTime",
 		"__secPerFrame",
+		"__baudrate",
 	)
 
-	def __init__(self, debug=False, *args, **kwargs):
+	def __init__(self, debug=False, clock=None, *args, **kwargs):
+		"""debug => enable/disable debugging.
+		clock => The MonotonicClock instance to use for all timing.
+		         None = use the real time.
+		"""
 		self.debug = debug
+		self.clock = clock if clock is not None else defaultClock
 		self.__close()
 
 	def _debugMsg(self, msg):
@@ -71,8 +96,12 @@ class CpPhy(object):
 	def __close(self):
 		self.__txQueueDAs = deque()
 		self.__txQueueTelegrams = [None] * (0x7F + 1)
-		self.__allocUntil = monotonic_time()
+		self.__allocUntil = self.clock.now()
+		self.__busOwner = None
+		self.__busSrd = False
+		self.__slotTime = 0.0
 		self.__secPerFrame = 0.0
+		self.__baudrate = None
 
 	def sendData(self, telegramData, srd):
 		"""Send data to the physical line.
@@ -89,6 +118,12 @@ class CpPhy(object):
 		"""
 		raise NotImplementedError
 
+	def isExhausted(self):
+		"""Returns True, if no more data will ever be received.
+		This method may be reimplemented in the PHY driver.
+		"""
+		return False
+
 	def poll(self, timeout=0.0):
 		"""timeout => timeout in seconds.
 			      0.0 = no timeout, return immediately.
@@ -96,28 +131,75 @@ class CpPhy(object):
 		"""
 		if self.__txQueueDAs:
 			self.__send()
-		return self.pollData(timeout)
+		data = self.pollData(timeout)
+		if data and self.__busSrd:
+			self.__checkReply(data)
+		return data
+
+	def __checkReply(self, data):
+		"""Free the bus, if the received frame completes the
+		request/reply transaction that allocates the bus.
+		That is a response from the requested station or a short ACK.
+		"""
+		sd = data[0]
+		if sd == FdlTelegram.SD1 or sd == FdlTelegram.SD3:
+			if len(data) < 4:
+				return
+			sa, fc = data[2], data[3]
+		elif sd == FdlTelegram.SD2:
+			if len(data) < 7:
+				return
+			sa, fc = data[5], data[6]
+		elif sd == FdlTelegram.SC:
+			# The short ACK has no address.
+			# Only the requested station may send it.
+			self.releaseBus()
+			return
+		else:
+			# Token frames are never replies.
+			return
+		if (sa & FdlTelegram.ADDRESS_MASK) != self.__busOwner or\
+		   (fc & FdlTelegram.FC_REQ):
+			return
+		self.releaseBus()
 
 	def __send(self):
-		now = monotonic_time()
+		now = self.clock.now()
 		if self.__canAllocateBus(now):
 			da = self.__txQueueDAs.popleft()
-			telegram, srd, maxReplyLen = self.__txQueueTelegrams[da]
+			telegramData, srd, replyTime = self.__txQueueTelegrams[da]
 			self.__txQueueTelegrams[da] = None
-			telegramData = telegram.getRawData()
-			self.__allocateBus(now, len(telegramData), maxReplyLen)
+			self.__allocateBus(now, len(telegramData),
+					   replyTime if srd else 0.0)
+			self.__busOwner = da
+			self.__busSrd = srd
 			self.sendData(telegramData, srd)
 
-	def send(self, telegram, srd, maxReplyLen=-1):
-		if maxReplyLen < 0 or maxReplyLen > 255:
-			maxReplyLen = 255
+	def send(self, telegram, srd, maxReplyLen=-1, replyTimeout=None):
+		"""Send a telegram, as soon as the bus is free.
+		The telegram is encoded immediately. If the bus is busy,
+		the encoded frame waits in the TX queue and is transmitted
+		by the releaseBus() that frees the bus.
+		maxReplyLen => The maximum length of the reply, in octets.
+		replyTimeout => The time the bus is allocated for the reply
+		                after the transmission of the telegram, in seconds.
+		                None = the slot time plus maxReplyLen octets.
+		Returns the size of the encoded telegram, in octets.
+		"""
+		if replyTimeout is None:
+			if maxReplyLen < 0 or maxReplyLen > 255:
+				maxReplyLen = 255
+			replyTimeout = self.__slotTime +\
+				       self.__secPerFrame * maxReplyLen
 
 		da = telegram.da
 		if self.__txQueueTelegrams[da] is None:
 			self.__txQueueDAs.append(da)
-		self.__txQueueTelegrams[da] = (telegram, srd, maxReplyLen)
+		telegramData = telegram.getRawData()
+		self.__txQueueTelegrams[da] = (telegramData, srd, replyTimeout)
 
 		self.__send()
+		return len(telegramData)
 
 	def setConfig(self, baudrate=BAUD_9600, *args, **kwargs):
 		"""Set the PHY configuration.
@@ -125,24 +207,59 @@ class CpPhy(object):
 		"""
 		symLen = 1.0 / baudrate
 		self.__secPerFrame = symLen * float(1 + 8 + 1 + 1)
+		self.__slotTime = symLen * self.SLOT_TIME_BITS.get(baudrate, 100)
+		self.__baudrate = baudrate
+
+	def getBaudrate(self):
+		"""Get the configured baud rate.
+		Returns None, if setConfig() has not been called, yet.
+		"""
+		return self.__baudrate
+
+	def getSlotTime(self):
+		"""Get the slot time (T_SL), in seconds.
+		That is the maximum time to wait for the start of a reply.
+		"""
+		if self.__baudrate is None:
+			return self.SLOT_TIME_BITS[self.BAUD_9600] / self.BAUD_9600
+		return self.__slotTime
+
+	def getTransferTime(self, nrOctets):
+		"""Get the on-wire time, in seconds, of nrOctets UART characters.
+		"""
+		return self.__secPerFrame * nrOctets
 
 	def __canAllocateBus(self, now):
 		return now >= self.__allocUntil
 
-	def __allocateBus(self, now, nrSendOctets, nrReplyOctets):
-		secPerFrame = self.__secPerFrame
-		seconds = secPerFrame * nrSendOctets
-		if nrReplyOctets:
-			pass#TODO IFS
-			seconds += secPerFrame * nrReplyOctets
-		pass#TODO
-		self.__allocUntil = now + seconds
-
-	def releaseBus(self):
-		self.__allocUntil = monotonic_time()
+	def __allocateBus(self, now, nrSendOctets, replyTime):
+		"""Allocate the bus for the worst case duration of a transaction.
+		This timing estimate only frees the bus, if no reply is received.
+		"""
+		self.__allocUntil = now + self.__secPerFrame * nrSendOctets +\
+				    replyTime
+
+	def releaseBus(self, da=None):
+		"""Free the bus and transmit the next queued frame.
+		da => The destination address of the transaction that
+		      has completed. If the bus is allocated by the transaction
+		      with another station, the bus is not freed.
+		      None = free the bus unconditionally.
+		"""
+		if da is not None and da != self.__busOwner:
+			return
+		self.__allocUntil = self.clock.now()
+		self.__busOwner = None
+		self.__busSrd = False
 		if self.__txQueueDAs:
 			self.__send()
 
+	def isTxQueued(self, da):
+		"""Returns True, if a frame for the destination address
+		is waiting in the TX queue.
+		"""
+		return self.__txQueueTelegrams[da] is not None
+
 	def clearTxQueueAddr(self, da):
 		"""Remove all TX queue entries for the given destination address.
 		"""
@@ -22,15 +22,26 @@ __all__ = [
 
 class CpPhyDummySlave(CpPhy):
 	"""Dummy slave PROFIBUS CP PHYsical layer
+
+	If a VirtualClock is used, the virtual time is advanced
+	by the on-wire time of all telegrams and by idle polls.
 	"""
 
 	__slots__ = (
+		"__diagPending",
+		"__extDiag",
+		"__identNumbers",
+		"__mutedAddrs",
 		"__pollQueue",
 	)
 
 	def __init__(self, *args, **kwargs):
 		super(CpPhyDummySlave, self).__init__(*args, **kwargs)
 		self.__pollQueue = []
+		self.__mutedAddrs = set()
+		self.__extDiag = {}
+		self.__diagPending = set()
+		self.__identNumbers = {}
 
 	def __msg(self, message):
 		if self.debug:
@@ -42,12 +53,42 @@ class CpPhyDummySlave(CpPhy):
 		self.__pollQueue = []
 		super(CpPhyDummySlave, self).close()
 
+	def muteSlave(self, slaveAddr, mute=True):
+		"""Simulate a slave that is disconnected from the bus.
+		A muted slave does not reply to any telegram.
+		"""
+		if mute:
+			self.__mutedAddrs.add(slaveAddr)
+		else:
+			self.__mutedAddrs.discard(slaveAddr)
+
+	def setIdentNumber(self, slaveAddr, identNumber):
+		"""Set the ident number that a slave reports in its diagnosis.
+		"""
+		self.__identNumbers[slaveAddr] = identNumber
+
+	def setExtDiag(self, slaveAddr, extDiag):
+		"""Simulate new extended diagnosis data of a slave.
+		The slave announces the new diagnosis with high priority
+		Data_Exchange replies until the master fetched it.
+		"""
+		if extDiag:
+			self.__extDiag[slaveAddr] = bytearray(extDiag)
+		else:
+			self.__extDiag.pop(slaveAddr, None)
+		self.__diagPending.add(slaveAddr)
+
+	def __advanceClock(self, nrOctets):
+		if self.clock.isVirtual:
+			self.clock.advance(self.getTransferTime(nrOctets))
+
 	def sendData(self, telegramData, srd):
 		"""Send data to the physical line.
 		"""
 		telegramData = bytearray(telegramData)
 		self.__msg("Sending %s  %s" % ("SRD" if srd else "SDN",
 					       bytesToHex(telegramData)))
+		self.__advanceClock(len(telegramData))
 		self.__mockSend(telegramData, srd = srd)
 
 	def pollData(self, timeout=0.0):
@@ -59,7 +100,11 @@ class CpPhyDummySlave(CpPhy):
 		try:
 			telegramData = self.__pollQueue.pop(0)
 		except IndexError as e:
+			if self.clock.isVirtual:
+				# The line is idle. Let the time pass.
+				self.clock.advance(max(timeout, self.getTransferTime(1)))
 			return None
+		self.__advanceClock(len(telegramData))
 		self.__msg("Receiving    %s" % bytesToHex(telegramData))
 		return telegramData
 
@@ -73,6 +118,8 @@ class CpPhyDummySlave(CpPhy):
 			return
 		try:
 			fdl = FdlTelegram.fromRawData(telegramData)
+			if fdl.da in self.__mutedAddrs:
+				return
 
 			if (fdl.fc & FdlTelegram.FC_REQFUNC_MASK) == FdlTelegram.FC_FDL_STAT:
 				telegram = FdlTelegram_FdlStat_Con(da = fdl.sa,
@@ -85,6 +132,12 @@ class CpPhyDummySlave(CpPhy):
 			if DpTelegram_SlaveDiag_Req.checkType(dp):
 				telegram = DpTelegram_SlaveDiag_Con(da = fdl.sa,
 								    sa = fdl.da)
+				telegram.identNumber = self.__identNumbers.get(fdl.da, 0)
+				extDiag = self.__extDiag.get(fdl.da)
+				if extDiag:
+					telegram.b0 |= DpTelegram_SlaveDiag_Con.B0_EXTDIAG
+					telegram.extDiag = extDiag
+				self.__diagPending.discard(fdl.da)
 				self.__pollQueue.append(telegram.toFdlTelegram().getRawData())
 				return
 			if DpTelegram_SetPrm_Req.checkType(dp):
@@ -100,6 +153,8 @@ class CpPhyDummySlave(CpPhy):
 				telegram = DpTelegram_DataExchange_Con(da = fdl.sa,
 								       sa = fdl.da,
 								       du = du)
+				if fdl.da in self.__diagPending:
+					telegram.fc = FdlTelegram.FC_DH
 				self.__pollQueue.append(telegram.toFdlTelegram().getRawData())
 				return
 
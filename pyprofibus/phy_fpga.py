@@ -87,7 +87,7 @@ class CpPhyFPGA(CpPhy):
 			if self.__rxDeque:
 				telegramData = self.__rxDeque.popleft()
 			else:
-				timeoutStamp = monotonic_time() + timeout#TODO
+				timeoutStamp = self.clock.now() + timeout#TODO
 				telegramDataList = self.__driver.telegramReceive()
 				count = len(telegramDataList)
 				if count >= 1:
@@ -108,7 +108,8 @@ class CpPhyFPGA(CpPhy):
 		try:
 			self.__driver = FpgaPhyDriver(spiDev=self.__spiBus,
 						      spiChipSelect=self.__spiCS,
-						      spiSpeedHz=self.__spiSpeedHz)
+						      spiSpeedHz=self.__spiSpeedHz,
+						      clock=self.clock)
 			self.__driver.setBaudRate(baudrate)
 		except FpgaPhyError as e:
 			raise PhyError(self.PFX + ("Failed to setup driver:\n%s" % str(e)))
@@ -16,7 +16,7 @@ import time
 from pyprofibus.phy_fpga_driver.exceptions import *
 from pyprofibus.phy_fpga_driver.messages import *
 from pyprofibus.phy_fpga_driver.io import *
-from pyprofibus.util import monotonic_time, FaultDebouncer
+from pyprofibus.util import defaultClock, FaultDebouncer
 
 
 __all__ = [
@@ -32,10 +32,11 @@ class FpgaPhyDriver(object):
 	PING_INTERVAL		= 0.1
 	DEB_INTERVAL		= 1.0
 
-	def __init__(self, spiDev=0, spiChipSelect=0, spiSpeedHz=1000000):
+	def __init__(self, spiDev=0, spiChipSelect=0, spiSpeedHz=1000000, clock=None):
+		self.__clock = clock if clock is not None else defaultClock
 		self.__baudrate = 9600
 		self.__ioProc = None
-		self.__nextPing = monotonic_time()
+		self.__nextPing = self.__clock.now()
 		self.__receivedPong = False
 		self.__spiDev = spiDev
 		self.__spiChipSelect = spiChipSelect
@@ -59,7 +60,7 @@ class FpgaPhyDriver(object):
 		self.__faultMagic = FaultDebouncer()
 		self.__faultLen = FaultDebouncer()
 		self.__faultPBLen = FaultDebouncer()
-		self.__nextFaultDebounce = monotonic_time() + self.DEB_INTERVAL
+		self.__nextFaultDebounce = self.__clock.now() + self.DEB_INTERVAL
 
 		# Start the communication process.
 		self.__ioProc = FpgaPhyProc(self.__spiDev, self.__spiChipSelect, self.__spiSpeedHz)
@@ -80,7 +81,7 @@ class FpgaPhyDriver(object):
 		# Clear all event counters in I/O proc.
 		self.__ioProc.getEventStatus()
 
-		self.__nextPing = monotonic_time() + self.PING_INTERVAL
+		self.__nextPing = self.__clock.now() + self.PING_INTERVAL
 		self.__receivedPong = True
 
 	def __ping(self, tries=3):
@@ -250,7 +251,7 @@ class FpgaPhyDriver(object):
 		if ioProc is None:
 			raise FpgaPhyError("telegramSend: No I/O process")
 
-		now = monotonic_time()
+		now = self.__clock.now()
 
 		# Handle keep-alive-ping.
 		if now >= self.__nextPing:
@@ -276,7 +277,7 @@ class FpgaPhyDriver(object):
 			raise FpgaPhyError("telegramReceive: No I/O process")
 
 		rxTelegrams = []
-		now = monotonic_time()
+		now = self.__clock.now()
 
 		# Handle I/O process events.
 		events = ioProc.getEventStatus()
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+#
+# PROFIBUS DP - Communication Processor PHY access library
+#
+# Licensed under the terms of the GNU General Public License version 2,
+# or (at your option) any later version.
+#
+
+from __future__ import division, absolute_import, print_function, unicode_literals
+from pyprofibus.compat import *
+
+from pyprofibus.phy import *
+from pyprofibus.fdl import *
+from pyprofibus.dp import *
+from pyprofibus.capture import *
+from pyprofibus.util import *
+
+__all__ = [
+	"CpPhyReplay",
+]
+
+class CpPhyReplay(CpPhy):
+	"""Capture file replay PROFIBUS CP PHYsical layer
+
+	MODE_RECEIVE:
+	  The frames of a capture file are received
+	  with the recorded inter-frame timing.
+	  Sent frames are discarded.
+
+	MODE_ANSWER:
+	  The recorded slave replies answer the sent requests.
+	  A request is answered by the next recorded reply to a request
+	  with the same destination address, function code and DSAP.
+	  The replies to one request type are repeated cyclically.
+	  The reply is delayed by the recorded reply latency.
+	  Requests without a recorded reply are not answered.
+
+	If a VirtualClock is used, the virtual time is advanced
+	by the on-wire time of all telegrams and while waiting
+	for the next frame.
+	"""
+
+	PFX = "PHY-replay: "
+
+	MODE_RECEIVE	= "receive"
+	MODE_ANSWER	= "answer"
+
+	__slots__ = (
+		"__filename",
+		"__timeScale",
+		"__mode",
+		"__reader",
+		"__records",
+		"__next",
+		"__startTime",
+		"__firstTimestamp",
+		"__replies",
+		"__replyIndex",
+	)
+
+	def __init__(self, port, timeScale=1.0, replayMode=MODE_RECEIVE,
+		     *args, **kwargs):
+		"""port => The capture file name.
+		timeScale => Factor for the recorded time.
+		             2.0 = replay at half speed.
+		             0.0 = replay as fast as possible.
+		replayMode => MODE_RECEIVE or MODE_ANSWER.
+		"""
+		super(CpPhyReplay, self).__init__(*args, **kwargs)
+		if replayMode not in (self.MODE_RECEIVE, self.MODE_ANSWER):
+			raise PhyError(self.PFX + "Invalid replay mode '%s'" % (
+				replayMode))
+		self.__filename = port
+		self.__timeScale = timeScale
+		self.__mode = replayMode
+		self.__reader = None
+		self.__records = None
+		self.__next = None
+		self.__startTime = None
+		self.__firstTimestamp = None
+		self.__replies = {}
+		self.__replyIndex = {}
+
+	def close(self):
+		"""Close the PHY device.
+		"""
+		if self.__reader is not None:
+			self.__reader.close()
+			self.__reader = None
+		self.__records = None
+		self.__next = None
+		super(CpPhyReplay, self).close()
+
+	def setConfig(self, baudrate=CpPhy.BAUD_9600, *args, **kwargs):
+		self.close()
+		try:
+			self.__reader = CaptureReader(self.__filename)
+		except CaptureError as e:
+			raise PhyError(self.PFX + str(e))
+		if self.__reader.baudrate:
+			baudrate = self.__reader.baudrate
+		super(CpPhyReplay, self).setConfig(baudrate=baudrate, *args, **kwargs)
+		self.__records = iter(self.__reader)
+		self.__next = None
+		self.__startTime = None
+		self.__firstTimestamp = None
+		self.__replies = {}
+		self.__replyIndex = {}
+		if self.__mode == self.MODE_ANSWER:
+			self.__loadReplies()
+
+	@staticmethod
+	def __requestKey(telegram):
+		return (telegram.da,
+			telegram.fc & FdlTelegram.FC_REQFUNC_MASK,
+			DpTelegram.extractSAP(telegram.dae))
+
+	def __loadReplies(self):
+		"""Read all request/reply pairs from the capture file.
+		"""
+		replies = {}
+		pending = None
+		try:
+			for record in self.__records:
+				request, pending = pending, None
+				if record.flags & CaptureRecord.FLAG_ERR_PHY:
+					continue
+				try:
+					telegram = FdlTelegram.fromRawData(record.data)
+				except FdlError:
+					continue
+				if telegram.sd == FdlTelegram.SD4:
+					continue
+				if telegram.sd == FdlTelegram.SC or\
+				   not (telegram.fc & FdlTelegram.FC_REQ):
+					# Reply
+					key, requestEnd = request or (None, None)
+					if key is None or\
+					   (telegram.sd != FdlTelegram.SC and
+					    telegram.sa != key[0]):
+						continue
+					latency = (record.timestamp - requestEnd) / 1e9 -\
+						  self.getTransferTime(len(record.data))
+					replies.setdefault(key, []).append(
+						(max(0.0, latency), bytes(record.data)))
+				elif FdlTelegram.fcExpectsReply(telegram.fc):
+					pending = (self.__requestKey(telegram),
+						   record.timestamp)
+		except CaptureError as e:
+			raise PhyError(self.PFX + str(e))
+		self.__replies = replies
+		self.__records = None
+		self.__reader.close()
+		self.__reader = None
+
+	def sendData(self, telegramData, srd):
+		"""Send data to the physical line.
+		"""
+		if self.__mode != self.MODE_ANSWER or not srd:
+			if self.debug:
+				self._debugMsg("TX (discarded)   %s" % bytesToHex(telegramData))
+			return
+		if self.debug:
+			self._debugMsg("TX   %s" % bytesToHex(telegramData))
+		try:
+			key = self.__requestKey(FdlTelegram.fromRawData(telegramData))
+		except FdlError:
+			return
+		replies = self.__replies.get(key)
+		if not replies:
+			self._debugMsg("No recorded reply to %s" % str(key))
+			return
+		index = self.__replyIndex.get(key, 0)
+		self.__replyIndex[key] = (index + 1) % len(replies)
+		latency, data = replies[index]
+		sendTime = self.getTransferTime(len(telegramData))
+		if self.clock.isVirtual:
+			self.clock.advance(sendTime)
+			sendTime = 0.0
+		start = self.clock.now() + sendTime + latency * self.__timeScale
+		self.__next = (start, CaptureRecord(0, 0, data))
+
+	def isExhausted(self):
+		"""Returns True, if all recorded frames have been received.
+		The answering replay is never exhausted.
+		"""
+		if self.__mode == self.MODE_ANSWER:
+			return False
+		return self.__nextFrame() is None
+
+	def __nextFrame(self):
+		"""Get the next (startTime, CaptureRecord) to be received.
+		startTime is the clock time at which the frame starts on the line.
+		"""
+		if self.__next is None and self.__records is not None:
+			try:
+				record = next(self.__records)
+			except StopIteration:
+				self.__records = None
+				return None
+			except CaptureError as e:
+				raise PhyError(self.PFX + str(e))
+			if self.__startTime is None:
+				self.__startTime = self.clock.now()
+				self.__firstTimestamp = record.timestamp
+			# The time stamp is taken at the end of the frame.
+			start = self.__startTime +\
+				((record.timestamp - self.__firstTimestamp) /
+				 1e9 * self.__timeScale) -\
+				self.getTransferTime(len(record.data))
+			self.__next = (start, record)
+		return self.__next
+
+	def pollData(self, timeout=0.0):
+		"""Poll received data from the physical line.
+		timeout => timeout in seconds.
+			   0.0 = no timeout, return immediately.
+			   negative = unlimited.
+		"""
+		clock = self.clock
+		frame = self.__nextFrame()
+		if frame is None:
+			# Nothing to receive.
+			if timeout > 0.0:
+				clock.sleep(timeout)
+			elif clock.isVirtual:
+				# The line is idle. Let the time pass.
+				clock.advance(self.getTransferTime(1))
+			return None
+		start, record = frame
+		if clock.isVirtual:
+			# Receive the frame, once it started.
+			# Then let the on-wire time pass.
+			due = start
+		else:
+			# Receive the frame, once it ended.
+			due = start + self.getTransferTime(len(record.data))
+		now = clock.now()
+		if now < due:
+			if timeout >= 0.0 and now + timeout < due:
+				if timeout > 0.0:
+					clock.sleep(timeout)
+				elif clock.isVirtual:
+					clock.advance(min(due - now,
+							  self.getTransferTime(1)))
+				return None
+			clock.sleep(due - now)
+		if clock.isVirtual:
+			clock.advance(self.getTransferTime(len(record.data)))
+		self.__next = None
+		if record.flags & CaptureRecord.FLAG_ERR_PHY:
+			raise PhyError(self.PFX + "Recorded receive error")
+		if self.debug:
+			self._debugMsg("RX   %s" % bytesToHex(record.data))
+		return bytearray(record.data)
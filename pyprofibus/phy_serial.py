@@ -100,17 +100,18 @@ class CpPhySerial(CpPhy):
 		if s:
 			s.flushInput()
 			s.flushOutput()
-		if monotonic_time() >= self.__discardTimeout:
+		if self.clock.now() >= self.__discardTimeout:
 			self.__discardTimeout = None
 
 	def __startDiscard(self):
-		self.__discardTimeout = monotonic_time() + 0.01
+		self.__discardTimeout = self.clock.now() + 0.01
 
 	# Poll for received packet.
 	# timeout => In seconds. 0.0 = none, Negative = unlimited.
 	def pollData(self, timeout=0.0):
+		now = self.clock.now
 		if timeout > 0.0:
-			timeoutStamp = monotonic_time() + timeout
+			timeoutStamp = now() + timeout
 		ret = None
 		rxBuf = self.__rxBuf
 		ser = self.__serial
@@ -119,7 +120,7 @@ class CpPhySerial(CpPhy):
 
 		while self.__discardTimeout is not None:
 			self.__discard()
-			if timeout > 0.0 and monotonic_time() >= timeoutStamp:
+			if timeout > 0.0 and now() >= timeoutStamp:
 				return None
 
 		try:
@@ -153,7 +154,7 @@ class CpPhySerial(CpPhy):
 					break
 
 				if (timeout == 0.0 or
-				    (timeout > 0.0 and monotonic_time() >= timeoutStamp)):
+				    (timeout > 0.0 and now() >= timeoutStamp)):
 					break
 		except serial.SerialException as e:
 			rxBuf = bytearray()
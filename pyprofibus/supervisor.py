@@ -0,0 +1,410 @@
+# -*- coding: utf-8 -*-
+#
+# PROFIBUS - Supervisor of multiple PROFIBUS lines
+#
+# Licensed under the terms of the GNU General Public License version 2,
+# or (at your option) any later version.
+#
+
+from __future__ import division, absolute_import, print_function, unicode_literals
+from pyprofibus.compat import *
+
+from pyprofibus.util import *
+
+import os
+import sys
+
+try:
+	import ctypes
+	import multiprocessing
+except ImportError:
+	ctypes = None
+	multiprocessing = None
+
+__all__ = [
+	"SupervisorError",
+	"ProcessImage",
+	"LineWorker",
+	"Supervisor",
+]
+
+class SupervisorError(ProfibusError):
+	pass
+
+class ProcessImage(object):
+	"""Shared memory process image of the slaves of one PROFIBUS line.
+
+	The input data of a slave is only written by the line worker.
+	The output data of a slave is only written by the supervisor process.
+	Each data area is protected by a sequence counter. The writer makes
+	the counter odd while it writes. The reader retries, if the counter
+	was odd or changed while it read. Neither side ever blocks the other.
+	"""
+
+	# Number of read attempts before a torn read is given up.
+	READ_RETRIES = 1000
+
+	def __init__(self, slaveSizes):
+		"""slaveSizes: List of (slaveAddr, inputSize, outputSize).
+		"""
+		if multiprocessing is None:
+			raise SupervisorError("ProcessImage: multiprocessing "
+				"is not supported.")
+		self.__layout = {}
+		offset = 0
+		for index, (addr, inputSize, outputSize) in enumerate(slaveSizes):
+			if addr in self.__layout:
+				raise SupervisorError("ProcessImage: Duplicate "
+					"slave address %d." % addr)
+			# (index, input offset, input size,
+			#  output offset, output size)
+			self.__layout[addr] = (index, offset, inputSize,
+					       offset + inputSize, outputSize)
+			offset += inputSize + outputSize
+		count = len(self.__layout)
+		self.__buf = multiprocessing.RawArray(ctypes.c_ubyte, max(1, offset))
+		# Per slave: Sequence counter and valid data length.
+		self.__inSeq = multiprocessing.RawArray(ctypes.c_uint32, count)
+		self.__inLen = multiprocessing.RawArray(ctypes.c_uint32, count)
+		self.__outSeq = multiprocessing.RawArray(ctypes.c_uint32, count)
+		self.__outLen = multiprocessing.RawArray(ctypes.c_int32, count)
+		for i in range(count):
+			self.__outLen[i] = -1
+
+	def getAddrs(self):
+		"""Get the slave addresses.
+		"""
+		return sorted(self.__layout)
+
+	def __getLayout(self, slaveAddr):
+		try:
+			return self.__layout[slaveAddr]
+		except KeyError:
+			raise SupervisorError("ProcessImage: Unknown "
+				"slave address %d." % slaveAddr)
+
+	def __write(self, seqs, lens, index, offset, data):
+		seqs[index] += 1
+		self.__buf[offset : offset + len(data)] = data
+		lens[index] = len(data)
+		seqs[index] += 1
+
+	def __read(self, seqs, lens, index, offset):
+		buf = self.__buf
+		for i in range(self.READ_RETRIES):
+			seq = seqs[index]
+			if seq & 1:
+				continue
+			length = lens[index]
+			data = bytearray(buf[offset : offset + max(0, length)])
+			if seqs[index] == seq:
+				return seq >> 1, length, data
+		return None, None, None
+
+	def setInData(self, slaveAddr, inData):
+		"""Store the input data of a slave. Called by the line worker.
+		Data beyond the configured input size is dropped.
+		"""
+		index, inOffset, inSize, outOffset, outSize =\
+			self.__getLayout(slaveAddr)
+		self.__write(self.__inSeq, self.__inLen, index,
+			     inOffset, inData[:inSize])
+
+	def getInData(self, slaveAddr):
+		"""Get the most recent input data of a slave.
+		Returns (updateCount, inData). updateCount is the number
+		of input data updates of the slave. inData is None,
+		if no input data has been received, yet.
+		"""
+		index, inOffset, inSize, outOffset, outSize =\
+			self.__getLayout(slaveAddr)
+		count, length, data = self.__read(self.__inSeq, self.__inLen,
+						  index, inOffset)
+		if not count:
+			return 0, None
+		return count, data
+
+	def setOutData(self, slaveAddr, outData):
+		"""Set the output data of a slave.
+		Must only be called by one process and thread.
+		"""
+		index, inOffset, inSize, outOffset, outSize =\
+			self.__getLayout(slaveAddr)
+		if len(outData) > outSize:
+			raise SupervisorError("ProcessImage: Output data of "
+				"slave %d exceeds %d bytes." % (slaveAddr, outSize))
+		self.__write(self.__outSeq, self.__outLen, index,
+			     outOffset, outData)
+
+	def getOutCount(self, slaveAddr):
+		"""Get the number of output data updates of a slave.
+		This is much cheaper than getOutData() and can be used to
+		check for new output data.
+		"""
+		index, inOffset, inSize, outOffset, outSize =\
+			self.__getLayout(slaveAddr)
+		return self.__outSeq[index] >> 1
+
+	def getOutData(self, slaveAddr):
+		"""Get the output data of a slave. Called by the line worker.
+		Returns None, if no output data has been set.
+		"""
+		index, inOffset, inSize, outOffset, outSize =\
+			self.__getLayout(slaveAddr)
+		count, length, data = self.__read(self.__outSeq, self.__outLen,
+						  index, outOffset)
+		if length is None or length < 0:
+			return None
+		return data
+
+	def resetInSeq(self):
+		"""Make all input areas readable again after
+		the line worker died while it was writing.
+		"""
+		seqs = self.__inSeq
+		for i in range(len(seqs)):
+			if seqs[i] & 1:
+				seqs[i] += 1
+
+def _lineWorkerMain(confFilename, line, image, stopEvent, cpu):
+	"""Run the DP master of one line.
+	This is executed in the line worker process.
+	"""
+	from pyprofibus.conf import PbConf
+	if cpu is not None and hasattr(os, "sched_setaffinity"):
+		try:
+			os.sched_setaffinity(0, (cpu, ))
+		except OSError:
+			pass
+	master = None
+	try:
+		conf = PbConf.fromFile(confFilename, line=line)
+		master = conf.makeDPM()
+		for slaveConf in conf.slaveConfs:
+			master.addSlave(slaveConf.makeDpSlaveDesc())
+		master.initialize()
+		slaveDescs = master.getSlaveList()
+		outCounts = {}
+
+		def updateOutData():
+			for slaveDesc in slaveDescs:
+				addr = slaveDesc.slaveAddr
+				count = image.getOutCount(addr)
+				if outCounts.get(addr) == count:
+					continue
+				outCounts[addr] = count
+				outData = image.getOutData(addr)
+				if outData is not None:
+					slaveDesc.setOutData(outData)
+
+		updateOutData()
+		while not stopEvent.is_set():
+			# Run slave state machines.
+			handledSlaveDesc = master.run()
+
+			# Publish the in-data.
+			if handledSlaveDesc:
+				inData = handledSlaveDesc.getInData()
+				if inData is not None:
+					image.setInData(handledSlaveDesc.slaveAddr,
+							inData)
+
+				# Fetch the changed output data once per bus cycle.
+				if handledSlaveDesc is slaveDescs[-1]:
+					updateOutData()
+	except ProfibusError as e:
+		print("Line '%s' worker terminating: %s" % (line, str(e)),
+		      file=sys.stderr)
+		sys.exit(1)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		if master:
+			master.destroy()
+
+class LineWorker(object):
+	"""The worker process of one PROFIBUS line.
+	"""
+
+	__slots__ = (
+		"line",
+		"image",
+		"cpu",
+		"restarts",
+		"process",
+		"restartTime",
+		"startTime",
+		"__confFilename",
+		"__stopEvent",
+	)
+
+	def __init__(self, confFilename, line, image, cpu=None):
+		self.line = line
+		self.image = image
+		self.cpu = cpu
+		self.restarts = 0
+		self.process = None
+		self.restartTime = None
+		self.startTime = None
+		self.__confFilename = confFilename
+		self.__stopEvent = multiprocessing.Event()
+
+	def start(self):
+		self.__stopEvent.clear()
+		self.image.resetInSeq()
+		self.process = multiprocessing.Process(
+			target=_lineWorkerMain,
+			args=(self.__confFilename, self.line, self.image,
+			      self.__stopEvent, self.cpu),
+			name="pyprofibus-line-%s" % self.line)
+		self.process.daemon = True
+		self.process.start()
+		self.restartTime = None
+
+	def stop(self, timeout=1.0):
+		if self.process is None:
+			return
+		self.__stopEvent.set()
+		self.process.join(timeout)
+		if self.process.is_alive():
+			self.process.terminate()
+			self.process.join()
+		self.process = None
+
+	def isAlive(self):
+		return self.process is not None and self.process.is_alive()
+
+class Supervisor(object):
+	"""Run the DP masters of several PROFIBUS lines
+	in one worker process per line.
+
+	The lines are defined in a multi-line PbConf configuration file.
+	The input and output data of all slaves is exchanged with
+	the workers through a shared memory ProcessImage per line.
+	Crashed workers are restarted.
+	"""
+
+	# Delay before the first restart of a crashed worker, in seconds.
+	# The delay is doubled on each restart up to RESTART_DELAY_MAX.
+	RESTART_DELAY		= 0.5
+	RESTART_DELAY_MAX	= 30.0
+	# A worker that stays up for this many seconds after a restart
+	# is considered stable. Its restart delay is reset.
+	RESTART_RESET_TIME	= 60.0
+
+	def __init__(self, confFilename, lines=None, pinCpus=False,
+		     clock=None):
+		"""confFilename: The multi-line configuration file.
+		lines: The names of the lines to run. None = all lines.
+		pinCpus: Pin each worker to its own CPU core, if possible.
+		"""
+		from pyprofibus.conf import PbConf
+		if multiprocessing is None:
+			raise SupervisorError("Supervisor: multiprocessing "
+				"is not supported.")
+		self.clock = clock if clock is not None else defaultClock
+		if lines is None:
+			lines = PbConf.getLineNames(confFilename)
+		if not lines:
+			raise SupervisorError("Supervisor: No lines are defined "
+				"in '%s'." % confFilename)
+		nrCpus = multiprocessing.cpu_count() if pinCpus else 0
+		self.__workers = {}
+		self.__lines = []
+		for i, line in enumerate(lines):
+			conf = PbConf.fromFile(confFilename, line=line)
+			image = ProcessImage([ (s.addr, s.inputSize, s.outputSize)
+					       for s in conf.slaveConfs ])
+			self.__workers[line] = LineWorker(
+				confFilename, line, image,
+				cpu=(i % nrCpus) if nrCpus else None)
+			self.__lines.append(line)
+
+	def getLines(self):
+		"""Get the line names.
+		"""
+		return list(self.__lines)
+
+	def getWorker(self, line):
+		try:
+			return self.__workers[line]
+		except KeyError:
+			raise SupervisorError("Supervisor: Unknown line '%s'." % line)
+
+	def getImage(self, line):
+		"""Get the ProcessImage of a line.
+		"""
+		return self.getWorker(line).image
+
+	def getInData(self, line, slaveAddr):
+		"""Get (updateCount, inData) of a slave.
+		See ProcessImage.getInData().
+		"""
+		return self.getImage(line).getInData(slaveAddr)
+
+	def setOutData(self, line, slaveAddr, outData):
+		"""Set the output data of a slave.
+		"""
+		self.getImage(line).setOutData(slaveAddr, outData)
+
+	def start(self):
+		"""Start all line workers.
+		"""
+		now = self.clock.now()
+		for line in self.__lines:
+			worker = self.__workers[line]
+			worker.start()
+			worker.startTime = now
+
+	def stop(self):
+		"""Stop all line workers.
+		"""
+		for line in self.__lines:
+			self.__workers[line].stop()
+
+	def poll(self):
+		"""Check the line workers and restart the crashed workers.
+		Returns the list of the lines that have been restarted.
+		"""
+		now = self.clock.now()
+		restarted = []
+		for line in self.__lines:
+			worker = self.__workers[line]
+			if worker.process is None:
+				continue
+			if worker.isAlive():
+				if worker.restarts and\
+				   now >= worker.startTime + self.RESTART_RESET_TIME:
+					worker.restarts = 0
+				continue
+			if worker.restartTime is None:
+				delay = min(self.RESTART_DELAY * (2 ** worker.restarts),
+					    self.RESTART_DELAY_MAX)
+				worker.restartTime = now + delay
+				print("Line '%s' worker died (exit code %s). "
+				      "Restarting in %.1f s." % (
+				      line, worker.process.exitcode, delay),
+				      file=sys.stderr)
+			elif now >= worker.restartTime:
+				worker.restarts += 1
+				worker.start()
+				worker.startTime = now
+				restarted.append(line)
+		return restarted
+
+	def run(self, interval=0.1, callback=None):
+		"""Supervise the line workers until KeyboardInterrupt.
+		callback is called after each poll, if it is not None.
+		A callback return value of False stops the supervision.
+		"""
+		self.start()
+		try:
+			while True:
+				self.poll()
+				if callback is not None and callback(self) is False:
+					break
+				self.clock.sleep(interval)
+		except KeyboardInterrupt:
+			pass
+		finally:
+			self.stop()
@@ -22,6 +22,9 @@ __all__ = [
 	"boolToStr",
 	"fileExists",
 	"monotonic_time",
+	"MonotonicClock",
+	"VirtualClock",
+	"defaultClock",
 	"TimeLimit",
 	"FaultDebouncer",
 ]
@@ -75,6 +78,57 @@ if isMicropython:
 else:
 	monotonic_time = getattr(time, "monotonic", time.time)
 
+class MonotonicClock(object):
+	"""Real time source.
+	Time stamps are float second counts from monotonic_time().
+	"""
+
+	isVirtual = False
+
+	__slots__ = (
+	)
+
+	def now(self):
+		"""Get the current time stamp.
+		"""
+		return monotonic_time()
+
+	def sleep(self, seconds):
+		"""Wait for the specified number of seconds.
+		"""
+		if seconds > 0.0:
+			time.sleep(seconds)
+
+class VirtualClock(MonotonicClock):
+	"""Simulated time source.
+	Time does not pass by itself. It only advances on advance() or sleep().
+	This can be used to run timing dependent code faster than real time.
+	"""
+
+	isVirtual = True
+
+	__slots__ = (
+		"__now",
+	)
+
+	def __init__(self, start=0.0):
+		self.__now = start
+
+	def now(self):
+		return self.__now
+
+	def advance(self, seconds):
+		"""Advance the virtual time by the specified number of seconds.
+		"""
+		if seconds > 0.0:
+			self.__now += seconds
+
+	def sleep(self, seconds):
+		self.advance(seconds)
+
+# The clock that is used, if no clock is explicitly specified.
+defaultClock = MonotonicClock()
+
 class TimeLimit(object):
 	"""Generic timeout helper.
 	"""
@@ -83,14 +137,18 @@ class TimeLimit(object):
 
 	__slots__ = (
 		"__limit",
+		"__now",
 		"__startTime",
 		"__endTime",
 	)
 
 	# limit => The time limit, in seconds.
 	#          Negative value = unlimited.
-	def __init__(self, limit = 0):
+	# clock => The MonotonicClock instance to use.
+	#          None = use the real monotonic time.
+	def __init__(self, limit = 0, clock = None):
 		self.__limit = limit
+		self.__now = clock.now if clock is not None else monotonic_time
 		self.start()
 
 	# (Re-)start the time.
@@ -99,7 +157,7 @@ class TimeLimit(object):
 			limit = self.__limit
 		self.__limit = limit
 		if limit >= 0:
-			self.__startTime = monotonic_time()
+			self.__startTime = self.__now()
 			self.__endTime = self.__startTime + limit
 		else:
 			self.__startTime = self.__endTime = -1
@@ -114,7 +172,7 @@ class TimeLimit(object):
 	def exceed(self):
 		if self.__limit < 0:
 			return False	# Unlimited
-		return monotonic_time() >= self.__endTime
+		return self.__now() >= self.__endTime
 
 class FaultDebouncer(object):
 	"""Fault counter/debouncer.
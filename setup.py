@@ -75,6 +75,7 @@ setup(	name		= "pyprofibus",
 	url		= "https://bues.ch/a/profibus",
 	scripts		= [ "gsdparser",
 			    "profisniff",
+			    "pyprofibus-compile-conf",
 			    "pyprofibus-linuxcnc-hal", ],
 	packages	= [ "pyprofibus", "pyprofibus.gsd", "pyprofibus.phy_fpga_driver" ],
 	cmdclass	= cmdclass,
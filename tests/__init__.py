@@ -1,2 +1,8 @@
+from test_busstats import *
+from test_capture import *
+from test_conf import *
+from test_dp import *
 from test_dummy import *
+from test_fdl import *
 from test_gsd import *
+from test_supervisor import *
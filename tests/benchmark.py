@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+#
+# PROFIBUS - Performance benchmark
+#
+# Licensed under the terms of the GNU General Public License version 2,
+# or (at your option) any later version.
+#
+"""
+
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+import sys
+import os
+basedir = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(basedir, ".."))
+
+import pyprofibus
+import pyprofibus.dp
+import pyprofibus.gsd
+import pyprofibus.phy_dummy
+from pyprofibus.phy import *
+from pyprofibus.fdl import *
+from pyprofibus.dp import *
+from pyprofibus.util import *
+from pyprofibus.version import VERSION_STRING
+
+import getopt
+import json
+import platform
+import time
+
+
+perf_counter = getattr(time, "perf_counter", monotonic_time)
+
+class BenchPhy(pyprofibus.phy_dummy.CpPhyDummySlave):
+	"""Dummy slave PHY that counts the telegrams on the line.
+	"""
+
+	def __init__(self, *args, **kwargs):
+		super(BenchPhy, self).__init__(*args, **kwargs)
+		self.nrTelegrams = 0
+
+	def sendData(self, telegramData, srd):
+		self.nrTelegrams += 1
+		super(BenchPhy, self).sendData(telegramData, srd)
+
+	def pollData(self, timeout=0.0):
+		telegramData = super(BenchPhy, self).pollData(timeout)
+		if telegramData is not None:
+			self.nrTelegrams += 1
+		return telegramData
+
+class Benchmark(object):
+	"""Benchmark runner.
+	"""
+
+	def __init__(self, minTime=0.5, repeat=3, verbose=True):
+		self.minTime = minTime
+		self.repeat = repeat
+		self.verbose = verbose
+		self.results = {}
+
+	def __store(self, name, result):
+		self.results[name] = result
+		if self.verbose:
+			text = "%-48s %12.3f us/op" % (name, result["us_per_op"])
+			if "telegrams_per_s" in result:
+				text += " %12.0f telegrams/s" % result["telegrams_per_s"]
+			print(text)
+
+	def run(self, name, func, nrOps=1):
+		"""Benchmark func().
+		nrOps is the number of operations that one func() call performs.
+		The best of 'repeat' runs is stored.
+		"""
+		best = None
+		for i in range(self.repeat):
+			count = 0
+			begin = perf_counter()
+			while True:
+				func()
+				count += 1
+				elapsed = perf_counter() - begin
+				if elapsed >= self.minTime:
+					break
+			perOp = elapsed / (count * nrOps)
+			if best is None or perOp < best:
+				best = perOp
+		self.__store(name, {
+			"us_per_op"	: best * 1e6,
+			"ops_per_s"	: 1.0 / best,
+		})
+
+	def runMaster(self, name, nrSlaves, baudrate=CpPhy.BAUD_1500000):
+		"""Benchmark DpMaster.run() cycles against the dummy PHY.
+		One cycle is one run() call for each slave.
+		"""
+		clock = VirtualClock()
+		phy = BenchPhy(clock=clock)
+		phy.setConfig(baudrate=baudrate)
+		masterAddr = 2
+		master = pyprofibus.DPM1(phy=phy, masterAddr=masterAddr)
+		slaveAddrs = [ addr for addr in range(FdlTelegram.ADDRESS_MCAST)
+			       if addr != masterAddr ][:nrSlaves]
+		for addr in slaveAddrs:
+			slaveDesc = pyprofibus.DpSlaveDesc(gsd=None, slaveAddr=addr)
+			slaveDesc.setCfgDataElements([
+				DpCfgDataElement(DpCfgDataElement.ID_TYPE_OUT),
+				DpCfgDataElement(DpCfgDataElement.ID_TYPE_IN),
+			])
+			master.addSlave(slaveDesc)
+		master.initialize()
+		slaveDescs = master.getSlaveList()
+		outData = bytearray((0x42, ))
+
+		def cycle():
+			nrInData = 0
+			for slaveDesc in slaveDescs:
+				slaveDesc.setOutData(outData)
+			for i in range(len(slaveDescs)):
+				handledSlaveDesc = master.run()
+				if handledSlaveDesc and\
+				   handledSlaveDesc.getInData() is not None:
+					nrInData += 1
+			return nrInData
+
+		# Bring all slaves into Data_Exchange.
+		for i in range(10000):
+			if cycle() >= nrSlaves:
+				break
+		else:
+			raise ProfibusError("%s: Slaves did not enter "
+					    "Data_Exchange." % name)
+
+		best = None
+		for i in range(self.repeat):
+			count = 0
+			phy.nrTelegrams = 0
+			begin = perf_counter()
+			while True:
+				cycle()
+				count += 1
+				elapsed = perf_counter() - begin
+				if elapsed >= self.minTime:
+					break
+			if best is None or elapsed / count < best[0]:
+				best = (elapsed / count, phy.nrTelegrams / elapsed)
+		self.__store(name, {
+			"us_per_op"		: best[0] * 1e6,
+			"ops_per_s"		: 1.0 / best[0],
+			"telegrams_per_s"	: best[1],
+		})
+
+def benchFdl(bench):
+	telegrams = (
+		("SD1", FdlTelegram_FdlStat_Req(da=8, sa=2)),
+		("SD2", DpTelegram_DataExchange_Req(da=8, sa=2,
+			du=bytearray(range(32))).toFdlTelegram()),
+		("SD3", DpTelegram_DataExchange_Req(da=8, sa=2,
+			du=bytearray(range(8))).toFdlTelegram()),
+		("SD4", FdlTelegram_token(da=8, sa=2)),
+		("SC", FdlTelegram_ack()),
+	)
+	for sdName, telegram in telegrams:
+		rawData = telegram.getRawData()
+		bench.run("FdlTelegram.getRawData %s" % sdName,
+			  telegram.getRawData)
+		bench.run("FdlTelegram.fromRawData %s" % sdName,
+			  lambda: FdlTelegram.fromRawData(rawData))
+
+def benchDp(bench):
+	replies = (
+		("DataExchange_Con", DpTelegram_DataExchange_Con(da=2, sa=8,
+			du=bytearray(range(32)))),
+		("SlaveDiag_Con", DpTelegram_SlaveDiag_Con(da=2, sa=8)),
+	)
+	for name, telegram in replies:
+		fdl = FdlTelegram.fromRawData(telegram.toFdlTelegram().getRawData())
+		bench.run("DpTelegram.fromFdlTelegram %s" % name,
+			  lambda: DpTelegram.fromFdlTelegram(fdl, thisIsMaster=True))
+
+def benchGsd(bench):
+	miscDir = os.path.join(basedir, "..", "misc")
+	for name in sorted(os.listdir(miscDir)):
+		if not name.lower().endswith(".gsd"):
+			continue
+		with open(os.path.join(miscDir, name), "rb") as fd:
+			data = fd.read()
+		bench.run("GsdInterp.fromBytes %s (%d bytes)" % (name, len(data)),
+			  lambda: pyprofibus.gsd.GsdInterp.fromBytes(data))
+
+def benchSlaveDesc(bench):
+	gsd = pyprofibus.gsd.GsdInterp.fromFile(
+		os.path.join(basedir, "..", "misc", "dummy_modular.gsd"))
+	gsd.setConfiguredModule("dummy input module")
+	gsd.setConfiguredModule("dummy output module")
+	def setup():
+		slaveDesc = pyprofibus.DpSlaveDesc(gsd=gsd, slaveAddr=8)
+		slaveDesc.setCfgDataElements(gsd.getCfgDataElements())
+		slaveDesc.setUserPrmData(gsd.getUserPrmData())
+		slaveDesc.setSyncMode(True)
+		slaveDesc.setFreezeMode(True)
+		slaveDesc.setGroupMask(1)
+		slaveDesc.setWatchdog(300)
+		slaveDesc.setPrmTelegram.toFdlTelegram().getRawData()
+		slaveDesc.chkCfgTelegram.toFdlTelegram().getRawData()
+	bench.run("DpSlaveDesc setup", setup)
+
+def benchMaster(bench):
+	for nrSlaves in (1, 8, 32, 125):
+		bench.runMaster("DpMaster.run cycle %d slaves" % nrSlaves,
+				nrSlaves)
+
+benchGroups = {
+	"fdl"		: benchFdl,
+	"dp"		: benchDp,
+	"gsd"		: benchGsd,
+	"slavedesc"	: benchSlaveDesc,
+	"master"	: benchMaster,
+}
+
+def compareResults(results, oldResults):
+	print("")
+	print("Comparison (negative = faster):")
+	for name, result in sorted(results.items()):
+		old = oldResults.get(name)
+		if not old:
+			continue
+		change = (result["us_per_op"] / old["us_per_op"] - 1.0) * 100.0
+		print("%-48s %+8.1f %%" % (name, change))
+
+def usage():
+	print("pyprofibus benchmark")
+	print("")
+	print("Usage: benchmark.py [OPTIONS] [GROUP ...]")
+	print("")
+	print("GROUP is one of: %s" % ", ".join(sorted(benchGroups.keys())))
+	print("All groups are run, if none is specified.")
+	print("")
+	print("Options:")
+	print(" -o|--output FILE    Save the results as JSON to FILE.")
+	print(" -c|--compare FILE   Compare the results to a previously saved FILE.")
+	print(" -t|--time SECONDS   Minimum run time per benchmark. Default: 0.5")
+	print(" -h|--help           Show this help.")
+
+def main():
+	opt_output = None
+	opt_compare = None
+	opt_time = 0.5
+
+	try:
+		(opts, args) = getopt.getopt(sys.argv[1:],
+			"ho:c:t:",
+			[ "help", "output=", "compare=", "time=", ])
+	except getopt.GetoptError as e:
+		sys.stderr.write(str(e) + "\n")
+		usage()
+		return 1
+	for (o, v) in opts:
+		if o in ("-h", "--help"):
+			usage()
+			return 0
+		if o in ("-o", "--output"):
+			opt_output = v
+		if o in ("-c", "--compare"):
+			opt_compare = v
+		if o in ("-t", "--time"):
+			try:
+				opt_time = float(v)
+			except ValueError:
+				sys.stderr.write("Invalid --time value.\n")
+				return 1
+	for group in args:
+		if group not in benchGroups:
+			sys.stderr.write("Unknown benchmark group '%s'.\n" % group)
+			return 1
+	groups = args or sorted(benchGroups.keys())
+
+	bench = Benchmark(minTime=opt_time)
+	try:
+		for group in groups:
+			benchGroups[group](bench)
+	except ProfibusError as e:
+		sys.stderr.write("ERROR: %s\n" % str(e))
+		return 1
+
+	try:
+		if opt_output:
+			with open(opt_output, "w") as fd:
+				json.dump({
+					"version"	: VERSION_STRING,
+					"python"	: platform.python_implementation() +\
+							  " " + platform.python_version(),
+					"time"		: time.time(),
+					"results"	: bench.results,
+				}, fd, indent=1, sort_keys=True)
+		if opt_compare:
+			with open(opt_compare, "r") as fd:
+				compareResults(bench.results, json.load(fd)["results"])
+	except (IOError, ValueError, KeyError) as e:
+		sys.stderr.write("ERROR: %s\n" % str(e))
+		return 1
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -1,6 +1,9 @@
 from __future__ import division, absolute_import, print_function, unicode_literals
 
-from unittest import TestCase
+import os
+import shutil
+import tempfile
+import unittest
 
 __all__ = [
 	"TestCase",
@@ -8,6 +11,31 @@ __all__ = [
 ]
 
 
+class TestCase(unittest.TestCase):
+	"""Test case base class.
+	The GSD cache of each test is redirected to a temporary directory,
+	so that the tests never touch the cache of the user.
+	"""
+
+	__cacheEnv = ("PYPROFIBUS_GSD_CACHE", "PYPROFIBUS_GSD_CACHE_DIR")
+
+	def setUp(self):
+		super(TestCase, self).setUp()
+		self.__savedEnv = { name : os.environ.get(name)
+				    for name in self.__cacheEnv }
+		self.gsdCacheDir = tempfile.mkdtemp()
+		os.environ["PYPROFIBUS_GSD_CACHE"] = "1"
+		os.environ["PYPROFIBUS_GSD_CACHE_DIR"] = self.gsdCacheDir
+
+	def tearDown(self):
+		for name, value in self.__savedEnv.items():
+			if value is None:
+				os.environ.pop(name, None)
+			else:
+				os.environ[name] = value
+		shutil.rmtree(self.gsdCacheDir, ignore_errors=True)
+		super(TestCase, self).tearDown()
+
 def initTest(testCaseFile):
 	from os.path import basename
 	print("(test case file: %s)" % basename(testCaseFile))
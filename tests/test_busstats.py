@@ -0,0 +1,52 @@
+from __future__ import division, absolute_import, print_function, unicode_literals
+from pyprofibus_tstlib import *
+initTest(__file__)
+
+import pyprofibus
+from pyprofibus.busstats import *
+from pyprofibus.fdl import *
+
+
+class Test_BusStats(TestCase):
+	def test_busStats(self):
+		stats = BusStats(baudrate=19200)
+		octet = 11.0 / 19200
+		req = FdlTelegram_FdlStat_Req(da=8, sa=2).getRawData()
+		con = FdlTelegram_FdlStat_Con(da=2, sa=8).getRawData()
+		token = FdlTelegram_token(da=2, sa=2).getRawData()
+
+		t = 1.0
+		for i in range(3):
+			# Request and reply with a latency of 1 ms.
+			stats.handleFrame(req, t)
+			t += 0.001 + len(con) * octet
+			stats.handleFrame(con, t)
+			t += 0.01
+			stats.handleFrame(token, t)
+			t += 0.01
+		# Timeout and retry.
+		stats.handleFrame(req, t)
+		stats.handleFrame(req, t + 0.1)
+		# Broken frames.
+		badFcs = bytearray(con)
+		badFcs[4] ^= 0xFF
+		stats.handleFrame(badFcs, t + 0.2)
+		stats.handleFrame(b"\x10\x00", t + 0.3)
+		stats.handleFrame(b"", t + 0.4, phyError=True)
+
+		slave = stats.stations[8]
+		self.assertEqual(slave.requests, 5)
+		self.assertEqual(slave.replies, 3)
+		self.assertEqual(slave.timeouts, 1)
+		self.assertEqual(slave.retries, 1)
+		self.assertAlmostEqual(slave.tsdr.percentile(50), 0.001)
+		master = stats.stations[2]
+		self.assertEqual(master.requestsSent, 5)
+		self.assertEqual(master.tokens, 3)
+		self.assertAlmostEqual(master.tokenRotation.max,
+				       0.021 + len(con) * octet)
+		self.assertEqual((stats.crcErrors, stats.framingErrors,
+				  stats.phyErrors), (1, 1, 1))
+		self.assertTrue(0.0 < stats.getBusLoad() < 100.0)
+		self.assertEqual(stats.toDict()["stations"][1]["retries"], 1)
+		self.assertIn("Bus load", str(stats))
@@ -0,0 +1,156 @@
+from __future__ import division, absolute_import, print_function, unicode_literals
+from pyprofibus_tstlib import *
+initTest(__file__)
+
+import pyprofibus
+from pyprofibus.capture import *
+from pyprofibus.fdl import *
+from pyprofibus.dp import *
+from pyprofibus.phy import PhyError
+from pyprofibus.util import VirtualClock
+import os
+import shutil
+import struct
+import tempfile
+
+
+class Test_Capture(TestCase):
+	def setUp(self):
+		super(Test_Capture, self).setUp()
+		self.tmpDir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpDir)
+		super(Test_Capture, self).tearDown()
+
+	def test_capture(self):
+		filename = os.path.join(self.tmpDir, "test.pbcap")
+		frames = [
+			FdlTelegram_FdlStat_Req(da=8, sa=2).getRawData(),
+			FdlTelegram_FdlStat_Con(da=2, sa=8).getRawData(),
+			FdlTelegram_ack().getRawData(),
+		]
+		writer = CaptureWriter(filename, baudrate=19200)
+		for i, frame in enumerate(frames):
+			writer.write(frame, 1000 * i)
+		writer.write(b"", 5000, CaptureRecord.FLAG_ERR_PHY)
+		writer.close()
+
+		# Appending does not write a second header.
+		writer = CaptureWriter(filename, baudrate=19200)
+		writer.write(frames[0], 6000)
+		writer.close()
+
+		reader = CaptureReader(filename)
+		self.assertEqual(reader.baudrate, 19200)
+		records = list(reader)
+		reader.close()
+		self.assertEqual([ bytes(r.data) for r in records ],
+				 [ bytes(f) for f in frames ] + [ b"", bytes(frames[0]) ])
+		self.assertEqual([ r.timestamp for r in records ],
+				 [ 0, 1000, 2000, 5000, 6000 ])
+		self.assertEqual(records[3].flags, CaptureRecord.FLAG_ERR_PHY)
+		self.assertEqual(FdlTelegram.fromRawData(records[1].data).sa, 8)
+
+	def test_pcap(self):
+		filename = os.path.join(self.tmpDir, "test.pcap")
+		frame = FdlTelegram_FdlStat_Req(da=8, sa=2).getRawData()
+		writer = openCaptureWriter(filename)
+		writer.write(frame, 3 * 1000000000 + 42)
+		writer.close()
+		with open(filename, "rb") as fd:
+			data = fd.read()
+		magic, major, minor, _, _, snaplen, linktype =\
+			struct.unpack("<IHHiIII", data[:24])
+		self.assertEqual(magic, 0xA1B23C4D)
+		self.assertEqual(linktype, 257)
+		sec, nsec, inclLen, origLen = struct.unpack("<IIII", data[24:40])
+		self.assertEqual((sec, nsec, inclLen), (3, 42, len(frame)))
+		self.assertEqual(data[40:], bytes(frame))
+
+	def test_captureFile(self):
+		filename = os.path.join(self.tmpDir, "test.pbcap")
+		frames = []
+		for i in range(100):
+			addr = 8 + (i % 4)
+			frames.append(DpTelegram_SlaveDiag_Req(da=addr, sa=2
+				).toFdlTelegram().getRawData())
+			frames.append(FdlTelegram_FdlStat_Con(da=2, sa=addr
+				).getRawData())
+		writer = CaptureWriter(filename, baudrate=19200)
+		for i, frame in enumerate(frames):
+			writer.write(frame, 1000 * i)
+		writer.write(b"\x10\x00", 1000 * len(frames))
+		writer.close()
+
+		cap = CaptureFile(filename)
+		self.assertEqual(len(cap), 201)
+		self.assertEqual(cap.baudrate, 19200)
+		self.assertEqual(bytes(cap.getRecord(3).data), bytes(frames[3]))
+		self.assertEqual(cap.findTime(50500), 51)
+		self.assertEqual(cap.findTime(10 ** 9), 201)
+
+		entries = list(cap.iterEntries(addrs={ 9 }))
+		self.assertEqual(len(entries), 50)
+		self.assertTrue(all(9 in (e.sa, e.da) for e in entries))
+		entries = list(cap.iterEntries(saps={ DpTelegram.SSAP_MS0 }))
+		self.assertEqual(len(entries), 100)
+		entries = list(cap.iterEntries(errors=True))
+		self.assertEqual([ e.timestamp for e in entries ], [ 200000 ])
+
+		telegrams = list(cap.iterTelegrams(startTime=100000,
+						   endTime=104000,
+						   addrs={ 10 }))
+		self.assertEqual(len(telegrams), 2)
+		self.assertIsInstance(telegrams[0][1], DpTelegram_SlaveDiag_Req)
+		self.assertEqual(telegrams[0][1].da, 10)
+		self.assertEqual(telegrams[1][1].sa, 10)
+		cap.close()
+
+		# The index is extended incrementally.
+		writer = CaptureWriter(filename, baudrate=19200)
+		writer.write(frames[0], 10 ** 6)
+		writer.close()
+		cap = CaptureFile(filename)
+		self.assertEqual(len(cap), 202)
+		self.assertEqual(cap.getIndexEntry(201).da, 8)
+		cap.close()
+
+	def test_ring(self):
+		ring = CaptureRing(size=64)
+		frame = FdlTelegram_FdlStat_Req(da=8, sa=2).getRawData()
+		for i in range(20):
+			self.assertTrue(ring.push(i, 0, frame))
+			record = ring.pop()
+			self.assertEqual((record.timestamp, bytes(record.data)),
+					 (i, bytes(frame)))
+			self.assertIsNone(ring.pop())
+		# A full ring drops frames.
+		while ring.push(0, 0, frame):
+			pass
+		self.assertEqual(ring.getDropped(), 1)
+		self.assertIsNotNone(ring.pop())
+		self.assertTrue(ring.push(1, CaptureRecord.FLAG_ERR_PHY, b""))
+
+	def test_replayPhy(self):
+		from pyprofibus.phy_replay import CpPhyReplay
+		filename = os.path.join(self.tmpDir, "test.pbcap")
+		frame = FdlTelegram_FdlStat_Req(da=8, sa=2).getRawData()
+		writer = CaptureWriter(filename, baudrate=19200)
+		writer.write(frame, 10 ** 9)
+		writer.write(frame, 3 * 10 ** 9)
+		writer.write(b"", 4 * 10 ** 9, CaptureRecord.FLAG_ERR_PHY)
+		writer.close()
+
+		clock = VirtualClock()
+		phy = CpPhyReplay(filename, timeScale=0.5, clock=clock)
+		phy.setConfig()
+		self.assertEqual(phy.getBaudrate(), 19200)
+		self.assertEqual(bytes(phy.poll()), bytes(frame))
+		self.assertIsNone(phy.poll(0.5))
+		self.assertEqual(bytes(phy.poll(-1.0)), bytes(frame))
+		self.assertAlmostEqual(clock.now(), 1.0)
+		self.assertRaises(PhyError, phy.poll, -1.0)
+		self.assertTrue(phy.isExhausted())
+		self.assertIsNone(phy.poll())
+		phy.close()
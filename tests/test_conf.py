@@ -0,0 +1,102 @@
+from __future__ import division, absolute_import, print_function, unicode_literals
+from pyprofibus_tstlib import *
+initTest(__file__)
+
+import pyprofibus
+import os
+import shutil
+import tempfile
+from io import StringIO
+
+
+class Test_Conf(TestCase):
+	def test_snapshot(self):
+		tmpDir = tempfile.mkdtemp()
+		try:
+			confFile = os.path.join(tmpDir, "test.conf")
+			snapFile = os.path.join(tmpDir, "test.snap")
+			shutil.copyfile("example_dummy.conf", confFile)
+
+			conf = pyprofibus.PbConf.fromFile(confFile)
+			conf.toSnapshot(snapFile)
+			snap = pyprofibus.PbConf.fromSnapshot(snapFile)
+
+			self.assertEqual(snap.phyType, conf.phyType)
+			self.assertEqual(snap.phyBaud, conf.phyBaud)
+			self.assertEqual(snap.dpMasterAddr, conf.dpMasterAddr)
+			self.assertEqual(len(snap.slaveConfs), len(conf.slaveConfs))
+			for s0, s1 in zip(conf.slaveConfs, snap.slaveConfs):
+				self.assertEqual(s1.name, s0.name)
+				self.assertEqual(s1.addr, s0.addr)
+				self.assertEqual(s1.watchdogMs, s0.watchdogMs)
+				self.assertEqual(s1.gsd.getUserPrmData(),
+						 s0.gsd.getUserPrmData())
+				d0, d1 = s0.makeDpSlaveDesc(), s1.makeDpSlaveDesc()
+				self.assertEqual(d1.chkCfgTelegram.getDU(),
+						 d0.chkCfgTelegram.getDU())
+				self.assertEqual(d1.setPrmTelegram.getDU(),
+						 d0.setPrmTelegram.getDU())
+
+			# The DpSlaveDesc does not need the full GSD.
+			for s0, s1 in zip(conf.slaveConfs, snap.slaveConfs):
+				d1 = s1.makeDpSlaveDesc()
+				self.assertEqual(d1.identNumber, s0.gsd.getIdentNumber())
+				self.assertEqual(d1.gsd.getMaxTSDR(19200),
+						 s0.gsd.getMaxTSDR(19200))
+				self.assertIsNone(d1.gsd.getField("Module"))
+
+			# The sources are found from any working directory.
+			cwd = os.getcwd()
+			os.chdir(tmpDir)
+			try:
+				pyprofibus.PbConf.fromSnapshot(snapFile)
+			finally:
+				os.chdir(cwd)
+
+			# Modified sources invalidate the snapshot.
+			with open(confFile, "a") as fd:
+				fd.write("\n")
+			with self.assertRaises(pyprofibus.PbConfError) as cm:
+				pyprofibus.PbConf.fromSnapshot(snapFile)
+			self.assertIn("outdated", str(cm.exception))
+			pyprofibus.PbConf.fromSnapshot(snapFile, validate=False)
+
+			# Missing sources invalidate the snapshot.
+			os.unlink(confFile)
+			with self.assertRaises(pyprofibus.PbConfError) as cm:
+				pyprofibus.PbConf.fromSnapshot(snapFile)
+			self.assertIn("outdated", str(cm.exception))
+		finally:
+			shutil.rmtree(tmpDir)
+
+	def test_parallel(self):
+		text = (
+			"[SLAVE_0]\n"
+			"addr=8\n"
+			"gsd=misc/dummy_modular.gsd\n"
+			"input_size=1\n"
+			"output_size=1\n"
+			"module_0=dummy input module\n"
+			"[SLAVE_1]\n"
+			"addr=9\n"
+			"gsd=misc/dummy_compact.gsd\n"
+			"input_size=1\n"
+			"output_size=1\n"
+			"[SLAVE_2]\n"
+			"addr=10\n"
+			"gsd=misc/dummy_modular.gsd\n"
+			"input_size=1\n"
+			"output_size=1\n"
+		)
+		conf = pyprofibus.PbConf(StringIO(text))
+		confPar = pyprofibus.PbConf(StringIO(text), parallel=True)
+		self.assertEqual(sorted(confPar.sourceFiles),
+				 [ "misc/dummy_compact.gsd", "misc/dummy_modular.gsd" ])
+		self.assertIs(confPar.slaveConfs[0].gsd.getFields(),
+			      confPar.slaveConfs[2].gsd.getFields())
+		for s0, s1 in zip(conf.slaveConfs, confPar.slaveConfs):
+			self.assertEqual(s1.gsd.dumpPy(), s0.gsd.dumpPy())
+			self.assertEqual(s1.gsd.getUserPrmData(),
+					 s0.gsd.getUserPrmData())
+			self.assertEqual([ e.getDU() for e in s1.gsd.getCfgDataElements() ],
+					 [ e.getDU() for e in s0.gsd.getCfgDataElements() ])
@@ -0,0 +1,46 @@
+from __future__ import division, absolute_import, print_function, unicode_literals
+from pyprofibus_tstlib import *
+initTest(__file__)
+
+import pyprofibus
+from pyprofibus.fdl import *
+from pyprofibus.dp import *
+
+
+class Test_DP(TestCase):
+	def test_slave_diag(self):
+		con = DpTelegram_SlaveDiag_Con(da=2, sa=8)
+		con.b0 = DpTelegram_SlaveDiag_Con.B0_EXTDIAG
+		con.b1 = DpTelegram_SlaveDiag_Con.B1_ONE
+		con.masterAddr = 2
+		con.identNumber = 0x806A
+		con.extDiag = bytearray((
+			0x43, 0x05, 0x00,	# Identifier related: modules 0 and 2
+			0x81, 0x42, 0x26,	# Channel related: module 1, input channel 2
+			0x03, 0xAA, 0x55,	# Device related
+		))
+		fdl = FdlTelegram.fromRawData(con.toFdlTelegram().getRawData())
+		telegram = DpTelegram.fromFdlTelegram(fdl, thisIsMaster=True)
+		self.assertTrue(DpTelegram_SlaveDiag_Con.checkType(telegram))
+
+		diag = telegram.getDiag()
+		self.assertTrue(diag.hasExtDiag())
+		self.assertTrue(diag.hasOnebit())
+		self.assertTrue(diag.isReadyDataEx())
+		self.assertFalse(diag.needsNewPrmCfg())
+		self.assertEqual(diag.masterAddr, 2)
+		self.assertEqual(diag.identNumber, 0x806A)
+		self.assertEqual(diag.identDiag, (0, 2))
+		self.assertEqual(diag.channelDiag, (DpChannelDiag(
+			identIndex=1, channel=2,
+			ioType=DpChannelDiag.IO_INPUT,
+			dataType=1,
+			errorType=DpChannelDiag.ERR_LINEBREAK), ))
+		self.assertEqual(diag.deviceDiag, (b"\xAA\x55", ))
+		self.assertEqual(diag, con.getDiag())
+
+		con.b0 |= DpTelegram_SlaveDiag_Con.B0_PRMFLT
+		self.assertNotEqual(diag, con.getDiag())
+		self.assertTrue(con.getDiag().needsNewPrmCfg())
+		self.assertFalse(con.getDiag().isReadyDataEx())
+
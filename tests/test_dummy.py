@@ -4,8 +4,13 @@ initTest(__file__)
 
 import pyprofibus
 import pyprofibus.dp
+import pyprofibus.fdl
 import pyprofibus.phy_dummy
 import pyprofibus.phy_serial
+import pyprofibus.util
+import os
+import shutil
+import tempfile
 
 
 class Test_DummyPhy(TestCase):
@@ -52,3 +57,398 @@ class Test_DummyPhy(TestCase):
 				if j >= 5 and ret is not None:
 					break
 			self.assertEqual(bytearray(ret), bytearray([i ^ 0xFF, ]))
+
+	def test_dummy_phy_virtual_time(self):
+		clock = pyprofibus.util.VirtualClock()
+		phy = pyprofibus.phy_dummy.CpPhyDummySlave(clock=clock)
+		phy.setConfig(baudrate=9600)
+
+		master = pyprofibus.DPM1(phy=phy,
+					 masterAddr=42)
+		self.assertIs(master.clock, clock)
+
+		slaveDesc = pyprofibus.DpSlaveDesc(gsd=None,
+						   slaveAddr=84)
+		slaveDesc.setCfgDataElements([
+			pyprofibus.dp.DpCfgDataElement(pyprofibus.dp.DpCfgDataElement.ID_TYPE_OUT),
+			pyprofibus.dp.DpCfgDataElement(pyprofibus.dp.DpCfgDataElement.ID_TYPE_IN),
+		])
+		slaveDesc.setWatchdog(300)
+		master.addSlave(slaveDesc)
+		master.initialize()
+
+		def runFor(seconds):
+			endTime = clock.now() + seconds
+			count = 0
+			while clock.now() < endTime:
+				slaveDesc.setOutData(bytearray([0x5A, ]))
+				master.run()
+				if slaveDesc.getInData() is not None:
+					count += 1
+			return count
+
+		# Ten minutes of virtual bus time.
+		self.assertTrue(runFor(120.0) > 0)
+		phy.muteSlave(84)
+		runFor(1.0)
+		self.assertEqual(runFor(240.0), 0)
+		phy.muteSlave(84, False)
+		self.assertTrue(runFor(240.0) > 0)
+		self.assertTrue(clock.now() >= 600.0)
+
+	def test_dummy_phy_diag(self):
+		clock = pyprofibus.util.VirtualClock()
+		phy = pyprofibus.phy_dummy.CpPhyDummySlave(clock=clock)
+		phy.setConfig(baudrate=19200)
+
+		master = pyprofibus.DPM1(phy=phy,
+					 masterAddr=42)
+		slaveDesc = pyprofibus.DpSlaveDesc(gsd=None,
+						   slaveAddr=84)
+		master.addSlave(slaveDesc)
+		master.initialize()
+
+		def run(count):
+			nrInData = 0
+			for i in range(count):
+				slaveDesc.setOutData(bytearray([1, ]))
+				master.run()
+				if slaveDesc.getInData() is not None:
+					nrInData += 1
+			return nrInData
+
+		self.assertTrue(run(100) > 0)
+		self.assertEqual(slaveDesc.getDiag().extDiag, b"")
+		master.getDiagEvents()
+
+		# The slave raises an extended diagnosis.
+		# Data_Exchange must continue while the diagnosis is fetched.
+		phy.setExtDiag(84, b"\x03\x01\x02")
+		self.assertTrue(run(100) > 40)
+		diag = slaveDesc.getDiag()
+		self.assertTrue(diag.hasExtDiag())
+		self.assertEqual(diag.deviceDiag, (b"\x01\x02", ))
+		events = master.getDiagEvents()
+		self.assertEqual(len(events), 1)
+		self.assertIs(events[0].slaveDesc, slaveDesc)
+		self.assertEqual(events[0].diag, diag)
+
+	def test_dummy_phy_scan(self):
+		clock = pyprofibus.util.VirtualClock()
+		phy = pyprofibus.phy_dummy.CpPhyDummySlave(clock=clock)
+		phy.setConfig(baudrate=9600)
+		for addr in range(127):
+			if addr not in (8, 42):
+				phy.muteSlave(addr)
+		phy.setIdentNumber(8, 0x4224)
+		phy.setIdentNumber(42, 0x806A)
+
+		master = pyprofibus.DPM1(phy=phy,
+					 masterAddr=2)
+		stations = master.scan()
+		self.assertEqual([ s.addr for s in stations ], [ 8, 42 ])
+		self.assertTrue(all(s.isSlave() for s in stations))
+		self.assertEqual([ s.getIdentNumber() for s in stations ],
+				 [ 0x4224, 0x806A ])
+		# 124 silent addresses with one retry each at 9600 baud.
+		self.assertTrue(clock.now() < 10.0)
+
+		stations = master.scan(addrs=(8, 9), retries=0)
+		self.assertEqual([ s.addr for s in stations ], [ 8 ])
+
+	def test_replay_phy_answer(self):
+		from pyprofibus.capture import CaptureWriter
+		from pyprofibus.phy_replay import CpPhyReplay
+
+		tmpDir = tempfile.mkdtemp()
+		try:
+			filename = os.path.join(tmpDir, "session.pbcap")
+
+			# Record a session with the dummy slave.
+			class RecordingPhy(pyprofibus.phy_dummy.CpPhyDummySlave):
+				def sendData(self, telegramData, srd):
+					super(RecordingPhy, self).sendData(telegramData, srd)
+					writer.write(telegramData, int(self.clock.now() * 1e9))
+				def pollData(self, timeout=0.0):
+					data = super(RecordingPhy, self).pollData(timeout)
+					if data is not None:
+						writer.write(data, int(self.clock.now() * 1e9))
+					return data
+
+			def runSession(phy, clock):
+				master = pyprofibus.DPM1(phy=phy, masterAddr=42)
+				slaveDesc = pyprofibus.DpSlaveDesc(gsd=None,
+								   slaveAddr=84)
+				slaveDesc.setCfgDataElements([
+					pyprofibus.dp.DpCfgDataElement(pyprofibus.dp.DpCfgDataElement.ID_TYPE_OUT),
+					pyprofibus.dp.DpCfgDataElement(pyprofibus.dp.DpCfgDataElement.ID_TYPE_IN),
+				])
+				master.addSlave(slaveDesc)
+				master.initialize()
+				inData = []
+				for i in range(50):
+					slaveDesc.setOutData(bytearray([0x5A, ]))
+					master.run()
+					ret = slaveDesc.getInData()
+					if ret is not None:
+						inData.append(bytes(ret))
+				return inData
+
+			clock = pyprofibus.util.VirtualClock()
+			writer = CaptureWriter(filename, baudrate=19200, clock=clock)
+			phy = RecordingPhy(clock=clock)
+			phy.setConfig(baudrate=19200)
+			recorded = runSession(phy, clock)
+			writer.close()
+			self.assertTrue(recorded)
+
+			# Replay the slave replies.
+			clock = pyprofibus.util.VirtualClock()
+			phy = CpPhyReplay(filename,
+					  replayMode=CpPhyReplay.MODE_ANSWER,
+					  clock=clock)
+			phy.setConfig()
+			self.assertEqual(phy.getBaudrate(), 19200)
+			replayed = runSession(phy, clock)
+			self.assertTrue(replayed)
+			self.assertEqual(set(replayed), { b"\xA5" })
+		finally:
+			shutil.rmtree(tmpDir)
+
+	def __addSlaves(self, master, addrs):
+		slaveDescs = []
+		for addr in addrs:
+			slaveDesc = pyprofibus.DpSlaveDesc(gsd=None, slaveAddr=addr)
+			slaveDesc.setCfgDataElements([
+				pyprofibus.dp.DpCfgDataElement(pyprofibus.dp.DpCfgDataElement.ID_TYPE_OUT),
+				pyprofibus.dp.DpCfgDataElement(pyprofibus.dp.DpCfgDataElement.ID_TYPE_IN),
+			])
+			master.addSlave(slaveDesc)
+			slaveDescs.append(slaveDesc)
+		master.initialize()
+		return slaveDescs
+
+	def test_dummy_phy_pipeline(self):
+		clock = pyprofibus.util.VirtualClock()
+		events = []
+
+		class LogPhy(pyprofibus.phy_dummy.CpPhyDummySlave):
+			def sendData(self, telegramData, srd):
+				fdl = pyprofibus.fdl.FdlTelegram.fromRawData(telegramData)
+				events.append(("tx", fdl.da, clock.now()))
+				super(LogPhy, self).sendData(telegramData, srd)
+			def pollData(self, timeout=0.0):
+				data = super(LogPhy, self).pollData(timeout)
+				if data is not None:
+					fdl = pyprofibus.fdl.FdlTelegram.fromRawData(data)
+					events.append(("rx", fdl.sa, clock.now()))
+				return data
+
+		phy = LogPhy(clock=clock)
+		phy.setConfig(baudrate=19200)
+
+		# A queued frame is transmitted by the release of
+		# the transaction that allocates the bus.
+		phy.send(pyprofibus.fdl.FdlTelegram_FdlStat_Req(da=8, sa=2), srd=True)
+		phy.send(pyprofibus.fdl.FdlTelegram_FdlStat_Req(da=42, sa=2), srd=True)
+		self.assertEqual([ e[:2] for e in events ], [ ("tx", 8) ])
+		self.assertTrue(phy.isTxQueued(42))
+		phy.releaseBus(42)
+		self.assertTrue(phy.isTxQueued(42))
+		phy.releaseBus(8)
+		self.assertFalse(phy.isTxQueued(42))
+		self.assertEqual([ e[:2] for e in events ], [ ("tx", 8), ("tx", 42) ])
+
+		phy.setConfig(baudrate=19200)
+		master = pyprofibus.DPM1(phy=phy, masterAddr=2)
+		outData = { 8 : 0x5A, 42 : 0x3C }
+		slaveDescs = self.__addSlaves(master, sorted(outData))
+		inData = { 8 : [], 42 : [] }
+		for i in range(200):
+			for slaveDesc in slaveDescs:
+				slaveDesc.setOutData(bytearray([outData[slaveDesc.slaveAddr], ]))
+			handled = master.run()
+			if handled:
+				ret = handled.getInData()
+				if ret is not None:
+					inData[handled.slaveAddr].append(bytes(ret))
+		self.assertTrue(inData[8])
+		self.assertTrue(inData[42])
+		self.assertEqual(set(inData[8]), { b"\xA5" })
+		self.assertEqual(set(inData[42]), { b"\xC3" })
+
+		# The next request is transmitted at the end of
+		# the preceding reply without idle time in between.
+		pipelined = 0
+		for prev, cur in zip(events, events[1:]):
+			if prev[0] == "rx" and cur[0] == "tx" and\
+			   prev[1] != cur[1] and cur[2] == prev[2]:
+				pipelined += 1
+		self.assertTrue(pipelined > 20)
+
+	def test_dummy_phy_pipeline_timeout(self):
+		clock = pyprofibus.util.VirtualClock()
+		requests = []
+
+		class LogPhy(pyprofibus.phy_dummy.CpPhyDummySlave):
+			def sendData(self, telegramData, srd):
+				fdl = pyprofibus.fdl.FdlTelegram.fromRawData(telegramData)
+				dp = pyprofibus.dp.DpTelegram.fromFdlTelegram(
+					fdl, thisIsMaster=False)
+				requests.append((fdl.da & 0x7F, type(dp)))
+				super(LogPhy, self).sendData(telegramData, srd)
+
+		phy = LogPhy(clock=clock)
+		phy.setConfig(baudrate=19200)
+		master = pyprofibus.DPM1(phy=phy, masterAddr=2)
+		slaveDescs = self.__addSlaves(master, (8, 9, 10))
+
+		def runMaster(seconds):
+			inData = { 8 : [], 9 : [], 10 : [] }
+			end = clock.now() + seconds
+			while clock.now() < end:
+				for slaveDesc in slaveDescs:
+					slaveDesc.setOutData(bytearray([0x5A, ]))
+				handled = master.run()
+				if handled:
+					ret = handled.getInData()
+					if ret is not None:
+						inData[handled.slaveAddr].append(bytes(ret))
+			return inData
+
+		inData = runMaster(1.0)
+		self.assertTrue(all(inData.values()))
+
+		# Slave 9 times out while the request to slave 10 is prepared.
+		# The prepared request is transmitted after the timeout and
+		# its reply timeout starts then. Slave 10 is not affected.
+		phy.muteSlave(9)
+		del requests[:]
+		inData = runMaster(1.0)
+		self.assertEqual(set(inData[8]), { b"\xA5" })
+		self.assertEqual(set(inData[10]), { b"\xA5" })
+		DataExchange_Req = pyprofibus.dp.DpTelegram_DataExchange_Req
+		self.assertTrue(all(t is DataExchange_Req
+				    for addr, t in requests if addr != 9))
+		self.assertTrue(any(t is not DataExchange_Req
+				    for addr, t in requests if addr == 9))
+
+	def test_dummy_phy_muted_slave(self):
+		def runMaster(mutedAddr):
+			clock = pyprofibus.util.VirtualClock()
+			phy = pyprofibus.phy_dummy.CpPhyDummySlave(clock=clock)
+			phy.setConfig(baudrate=19200)
+			if mutedAddr is not None:
+				phy.muteSlave(mutedAddr)
+			master = pyprofibus.DPM1(phy=phy, masterAddr=2)
+			slaveDescs = self.__addSlaves(master, (8, 9, 10))
+			inData = { 8 : 0, 9 : 0, 10 : 0 }
+			while clock.now() < 5.0:
+				for slaveDesc in slaveDescs:
+					slaveDesc.setOutData(bytearray([0x5A, ]))
+				handled = master.run()
+				if handled and handled.getInData() is not None:
+					inData[handled.slaveAddr] += 1
+			return inData
+
+		# A muted slave does not hold the bus for the longest
+		# possible reply. Its neighbours keep their throughput.
+		healthy = runMaster(None)
+		muted = runMaster(8)
+		self.assertEqual(muted[8], 0)
+		for addr in (9, 10):
+			self.assertTrue(healthy[addr] > 50)
+			self.assertTrue(muted[addr] >= healthy[addr] * 0.8)
+
+	def test_dummy_phy_release_bus(self):
+		clock = pyprofibus.util.VirtualClock()
+		phy = pyprofibus.phy_dummy.CpPhyDummySlave(clock=clock)
+		phy.setConfig(baudrate=19200)
+		FdlStat_Req = pyprofibus.fdl.FdlTelegram_FdlStat_Req
+
+		# The reply of the requested station frees the bus.
+		phy.send(FdlStat_Req(da=8, sa=2), srd=True)
+		phy.send(FdlStat_Req(da=42, sa=2), srd=True)
+		self.assertTrue(phy.isTxQueued(42))
+		self.assertIsNotNone(phy.poll())
+		self.assertFalse(phy.isTxQueued(42))
+		self.assertIsNotNone(phy.poll())
+
+		# Without reply, the bus is freed by the timing estimate.
+		phy.muteSlave(8)
+		phy.send(FdlStat_Req(da=8, sa=2), srd=True)
+		phy.send(FdlStat_Req(da=42, sa=2), srd=True)
+		self.assertIsNone(phy.poll())
+		self.assertTrue(phy.isTxQueued(42))
+		clock.advance(phy.getSlotTime() + phy.getTransferTime(255))
+		reply = phy.poll()
+		self.assertFalse(phy.isTxQueued(42))
+		self.assertEqual(pyprofibus.fdl.FdlTelegram.fromRawData(reply).sa, 42)
+
+	def test_dummy_phy_reply_match(self):
+		clock = pyprofibus.util.VirtualClock()
+		inject = []
+
+		class InjectPhy(pyprofibus.phy_dummy.CpPhyDummySlave):
+			def pollData(self, timeout=0.0):
+				if inject:
+					return inject.pop(0)
+				return super(InjectPhy, self).pollData(timeout)
+
+		phy = InjectPhy(clock=clock)
+		phy.setConfig(baudrate=19200)
+		phy.muteSlave(8)
+		fdl = pyprofibus.fdl
+		phy.send(fdl.FdlTelegram_FdlStat_Req(da=8, sa=2), srd=True)
+		phy.send(fdl.FdlTelegram_FdlStat_Req(da=42, sa=2), srd=True)
+
+		# Token frames, requests and replies of other
+		# stations do not free the bus.
+		for telegram in (fdl.FdlTelegram_token(da=3, sa=1),
+				 fdl.FdlTelegram_FdlStat_Req(da=3, sa=8),
+				 fdl.FdlTelegram_FdlStat_Con(da=2, sa=9)):
+			inject.append(telegram.getRawData())
+			self.assertIsNotNone(phy.poll())
+			self.assertTrue(phy.isTxQueued(42))
+
+		# The short ACK of the requested station does.
+		inject.append(fdl.FdlTelegram_ack().getRawData())
+		self.assertIsNotNone(phy.poll())
+		self.assertFalse(phy.isTxQueued(42))
+
+	def test_reply_timeout(self):
+		from pyprofibus.dp_master import DpReplyTimeout
+		from pyprofibus.gsd.interp import GsdInterp
+
+		phy = pyprofibus.phy_dummy.CpPhyDummySlave()
+		phy.setConfig(baudrate=1500000)
+		gsd = GsdInterp.fromFile("misc/dummy_compact.gsd")
+		timeout = DpReplyTimeout(phy, gsd)
+
+		# Worst case until replies have been observed.
+		static = timeout.get(10, 0.1)
+		self.assertAlmostEqual(static, phy.getTransferTime(10 + 255) +
+				       max(phy.getSlotTime(), 150 / 1500000.0))
+		self.assertEqual(timeout.get(10, 0.001), 0.001)
+
+		# Adapt to the observed latency.
+		for i in range(DpReplyTimeout.MIN_SAMPLES):
+			timeout.replyReceived(phy.getTransferTime(10 + 12) + 20e-6,
+					      10, 12)
+		adapted = timeout.get(10, 0.1)
+		self.assertAlmostEqual(adapted, phy.getTransferTime(10 + 12 + 1) +
+				       20e-6 * DpReplyTimeout.SAFETY_FACTOR)
+		self.assertTrue(adapted < static / 4)
+
+		# Missing replies back off exponentially.
+		timeout.replyMissing()
+		timeout.replyMissing()
+		self.assertAlmostEqual(timeout.get(10, 0.1),
+				       phy.getTransferTime(10) +
+				       (adapted - phy.getTransferTime(10)) * 4)
+		self.assertAlmostEqual(timeout.get(10, 0.1),
+				       phy.getTransferTime(10) +
+				       timeout.getReplyTime(0.1))
+		self.assertEqual(timeout.get(10, adapted * 2), adapted * 2)
+		timeout.replyReceived(phy.getTransferTime(10 + 12) + 20e-6, 10, 12)
+		self.assertAlmostEqual(timeout.get(10, 0.1), adapted)
@@ -0,0 +1,154 @@
+from __future__ import division, absolute_import, print_function, unicode_literals
+from pyprofibus_tstlib import *
+initTest(__file__)
+
+import pyprofibus
+import pyprofibus.dp
+import pyprofibus.phy_dummy
+import pyprofibus.util
+from pyprofibus.fdl import *
+
+
+class SendLogPhy(pyprofibus.phy_dummy.CpPhyDummySlave):
+	def setConfig(self, *args, **kwargs):
+		super(SendLogPhy, self).setConfig(*args, **kwargs)
+		self.sent = []
+
+	def sendData(self, telegramData, srd):
+		self.sent.append(FdlTelegram.fromRawData(telegramData))
+		super(SendLogPhy, self).sendData(telegramData, srd)
+
+class Test_FdlTokenRing(TestCase):
+	def makeRing(self, thisAddr=5, gapFactor=1000):
+		clock = pyprofibus.util.VirtualClock()
+		phy = SendLogPhy(clock=clock)
+		phy.setConfig(baudrate=19200)
+		ring = FdlTokenRing(phy=phy, thisAddr=thisAddr,
+				    ttr=0.05, slotTime=100 / 19200,
+				    gapFactor=gapFactor, clock=clock)
+		return clock, phy, ring
+
+	def test_claimToken(self):
+		clock, phy, ring = self.makeRing()
+		ring.run()
+		self.assertFalse(ring.inRing())
+		clock.advance(ring.getTokenLossTimeout())
+		ring.run()
+		self.assertTrue(ring.haveToken())
+		self.assertEqual(ring.las, [ 5 ])
+		self.assertEqual(ring.tokenCount, 1)
+		# The only master receives its own token.
+		ring.passToken()
+		self.assertTrue(ring.haveToken())
+		self.assertEqual(ring.tokenCount, 2)
+		self.assertEqual(phy.sent, [])
+
+	def test_passToken(self):
+		clock, phy, ring = self.makeRing()
+		# Observe a ring of 3 and 10.
+		ring.handleTelegram(FdlTelegram_token(da=10, sa=3))
+		ring.handleTelegram(FdlTelegram_token(da=3, sa=10))
+		self.assertEqual(ring.las, [ 3, 10 ])
+		self.assertFalse(ring.inRing())
+		# Station 3 passes the token to us.
+		clock.advance(0.01)
+		self.assertTrue(ring.handleTelegram(FdlTelegram_token(da=5, sa=3)))
+		self.assertTrue(ring.haveToken())
+		self.assertEqual(ring.las, [ 3, 5, 10 ])
+		self.assertEqual((ring.ps, ring.ns), (3, 10))
+		# One transaction is allowed without hold time.
+		self.assertTrue(ring.mayStart(1.0))
+		ring.useToken()
+		self.assertFalse(ring.mayStart(0.001))
+
+		ring.passToken()
+		self.assertFalse(ring.haveToken())
+		self.assertEqual(phy.sent[-1].sd, FdlTelegram.SD4)
+		self.assertEqual((phy.sent[-1].da, phy.sent[-1].sa), (10, 5))
+		# NS is active. The pass was successful.
+		ring.handleTelegram(FdlTelegram_FdlStat_Req(da=20, sa=10))
+		phy.releaseBus()
+		clock.advance(0.01)
+		ring.run()
+		self.assertEqual(len(phy.sent), 1)
+
+		# The token returns after about 20 ms.
+		# About 30 ms hold time are left.
+		clock.advance(0.01)
+		ring.handleTelegram(FdlTelegram_token(da=5, sa=3))
+		self.assertTrue(0.02 <= ring.rotationTime < 0.025)
+		ring.useToken()
+		self.assertTrue(ring.mayStart(0.02))
+		self.assertFalse(ring.mayStart(0.04))
+
+	def test_passRetry(self):
+		clock, phy, ring = self.makeRing()
+		ring.handleTelegram(FdlTelegram_token(da=10, sa=3))
+		ring.handleTelegram(FdlTelegram_token(da=5, sa=3))
+		ring.passToken()
+		self.assertEqual(len(phy.sent), 1)
+		# NS is silent. Retry once, then remove it from the LAS.
+		for i in range(2):
+			phy.releaseBus()
+			clock.advance(0.1)
+			ring.run()
+		self.assertEqual(len(phy.sent), 3)
+		self.assertEqual([ t.da for t in phy.sent ], [ 10, 10, 3 ])
+		self.assertEqual(ring.las, [ 3, 5 ])
+		self.assertEqual(ring.ns, 3)
+
+	def test_gapProbe(self):
+		clock, phy, ring = self.makeRing(gapFactor=2)
+		ring.handleTelegram(FdlTelegram_token(da=10, sa=3))
+		ring.handleTelegram(FdlTelegram_token(da=5, sa=3))
+		ring.passToken()
+		self.assertEqual(phy.sent[-1].da, 10)
+		phy.releaseBus()
+		clock.advance(0.01)
+		ring.handleTelegram(FdlTelegram_token(da=5, sa=3))
+		ring.passToken()
+		# The first GAP address is probed.
+		self.assertEqual(phy.sent[-1].da, 6)
+		self.assertEqual(phy.sent[-1].fc & FdlTelegram.FC_REQFUNC_MASK,
+				 FdlTelegram.FC_FDL_STAT)
+		# Station 6 is a master that is ready to enter the ring.
+		ring.handleTelegram(FdlTelegram_FdlStat_Con(da=5, sa=6,
+			fc=FdlTelegram.FC_OK | FdlTelegram.FC_MRDY))
+		self.assertEqual(ring.las, [ 3, 5, 6, 10 ])
+		self.assertEqual(ring.ns, 6)
+		self.assertEqual(phy.sent[-1].sd, FdlTelegram.SD4)
+		self.assertEqual(phy.sent[-1].da, 6)
+
+	def test_answerGapProbe(self):
+		clock, phy, ring = self.makeRing()
+		ring.handleTelegram(FdlTelegram_FdlStat_Req(da=5, sa=3))
+		self.assertEqual(phy.sent[-1].da, 3)
+		self.assertEqual(phy.sent[-1].fc & FdlTelegram.FC_STYPE_MASK,
+				 FdlTelegram.FC_MRDY)
+
+	def test_dpMaster(self):
+		clock = pyprofibus.util.VirtualClock()
+		phy = pyprofibus.phy_dummy.CpPhyDummySlave(clock=clock)
+		phy.setConfig(baudrate=19200)
+		master = pyprofibus.DPM1(phy=phy, masterAddr=2)
+		master.enableTokenRing(ttrBits=5000)
+		slaveDesc = pyprofibus.DpSlaveDesc(gsd=None, slaveAddr=84)
+		slaveDesc.setCfgDataElements([
+			pyprofibus.dp.DpCfgDataElement(pyprofibus.dp.DpCfgDataElement.ID_TYPE_OUT),
+			pyprofibus.dp.DpCfgDataElement(pyprofibus.dp.DpCfgDataElement.ID_TYPE_IN),
+		])
+		master.addSlave(slaveDesc)
+		master.initialize()
+
+		inData = []
+		for i in range(500):
+			slaveDesc.setOutData(bytearray([0x5A, ]))
+			master.run()
+			ret = slaveDesc.getInData()
+			if ret is not None:
+				inData.append(bytes(ret))
+		self.assertTrue(inData)
+		self.assertEqual(set(inData), { b"\xA5" })
+		ring = master.getTokenRing()
+		self.assertEqual(ring.las, [ 2 ])
+		self.assertTrue(ring.tokenCount > 1)
@@ -5,6 +5,8 @@ initTest(__file__)
 import pyprofibus
 import pyprofibus.gsd
 import os
+import shutil
+import tempfile
 
 
 class Test_GSD(TestCase):
@@ -21,6 +23,46 @@ class Test_GSD(TestCase):
 		self.assertEqual(gsd.getIdentNumber(), 0x4224)
 		self.assertEqual(gsd.getUserPrmData(), bytearray([0x00, 0x00, 0x00, 0x42]))
 
+	def test_memo(self):
+		gsd = pyprofibus.gsd.GsdInterp.fromFile(os.path.join("misc", "dummy_modular.gsd"))
+		gsd.setConfiguredModule("dummy input module")
+		prmData = gsd.getUserPrmData()
+		self.assertIsInstance(prmData, bytearray)
+		# The memoised data is not shared with the caller.
+		prmData[0] = 0xFF
+		self.assertNotEqual(gsd.getUserPrmData(), prmData)
+		prmData = gsd.getUserPrmData()
+		elems = gsd.getCfgDataElements()
+		self.assertEqual(len(elems), 2)
+		elems[0].identifier = 0xFF
+		self.assertNotEqual(gsd.getCfgDataElements()[0].identifier, 0xFF)
+		gsd.setConfiguredModule("dummy output module")
+		self.assertEqual(len(gsd.getCfgDataElements()), 3)
+		self.assertEqual(gsd.getUserPrmData(), bytearray([0x00, 0x00, 0x00, 0x42]))
+		gsd.setConfiguredModule(None, 2)
+		self.assertEqual(gsd.getUserPrmData(), prmData)
+		self.assertEqual(len(gsd.getCfgDataElements()), 2)
+
+	def test_view(self):
+		gsd = pyprofibus.gsd.GsdInterp.fromFile(os.path.join("misc", "dummy_modular.gsd"))
+		view0 = gsd.newView()
+		view1 = gsd.newView()
+		self.assertIs(view0.getFields(), gsd.getFields())
+		view0.setConfiguredModule("dummy input module")
+		view1.setConfiguredModule("dummy input module")
+		view1.setConfiguredModule("dummy output module")
+		self.assertEqual(len(gsd.getCfgDataElements()), 1)
+		self.assertEqual(len(view0.getCfgDataElements()), 2)
+		self.assertEqual(len(view1.getCfgDataElements()), 3)
+		view2 = gsd.newView()
+		view2.setConfiguredModule("dummy input module")
+		self.assertEqual(view2.getUserPrmData(), view0.getUserPrmData())
+
+		conf = pyprofibus.PbConf.fromFile("example_dummy.conf")
+		gsd0, gsd1 = (s.gsd for s in conf.slaveConfs)
+		self.assertIsNot(gsd0, gsd1)
+		self.assertIs(gsd0.getFields(), gsd1.getFields())
+
 	def test_compact(self):
 		gsd = pyprofibus.gsd.GsdInterp.fromFile(os.path.join("misc", "dummy_compact.gsd"))
 		self.assertEqual([ e.getDU()
@@ -30,3 +72,109 @@ class Test_GSD(TestCase):
 				   bytearray([0x20, ]), ])
 		self.assertEqual(gsd.getIdentNumber(), 0x4224)
 		self.assertEqual(gsd.getUserPrmData(), bytearray([0x00, 0x00, 0x00, 0x42]))
+
+	def test_find_module(self):
+		gsd = pyprofibus.gsd.GsdInterp.fromFile(os.path.join("misc", "dummy_modular.gsd"))
+		mod = gsd.findModule("dummy input module")
+		self.assertEqual(mod.name, "dummy input module")
+		self.assertIs(gsd.findModule("DUMMY INPUT MODULE "), mod)
+		self.assertIs(gsd.findModule("dummy in"), mod)
+		self.assertIs(gsd.findModule("dummy inptu module"), mod)
+		self.assertIsNone(gsd.findModule("dummy"))
+		self.assertIsNone(gsd.findModule("xyz"))
+
+	def test_tokenize(self):
+		gsd = pyprofibus.gsd.GsdParser([
+			"Vendor_Name = \"ignored\"",
+			"#Profibus_DP",
+			"; comment",
+			"Vendor_Name = \"a;b\" ; comment",
+			"  Ident_Number = \\",
+			"  0x4224",
+			"Module = \"mod\" 0x10, \\ ; comment",
+			"0x20",
+			"EndModule",
+			"#Other_Section",
+			"Model_Name = \"ignored\"",
+		])
+		self.assertEqual(gsd.getField("Vendor_Name"), "a;b")
+		self.assertEqual(gsd.getField("Ident_Number"), 0x4224)
+		self.assertIsNone(gsd.getField("Model_Name"))
+		self.assertEqual([ (m.name, m.configBytes)
+				   for m in gsd.getField("Module") ],
+				 [ ("mod", b"\x10\x20") ])
+
+	def test_cache(self):
+		cacheDir = tempfile.mkdtemp()
+		try:
+			cache = pyprofibus.gsd.GsdCache(cacheDir)
+			filepath = os.path.join("misc", "dummy_modular.gsd")
+			key = cache.makeFileKey(filepath)
+			with open(filepath, "rb") as fd:
+				self.assertEqual(cache.makeKey(fd.read()), key)
+			self.assertIsNone(cache.load(key))
+
+			gsd = pyprofibus.gsd.GsdInterp.fromFile(filepath, useCache=False)
+			self.assertTrue(cache.store(key, gsd.getFields()))
+			gsdCached = pyprofibus.gsd.GsdInterp(cache.load(key), filepath)
+			for g in (gsd, gsdCached):
+				g.setConfiguredModule("dummy input module")
+				g.setConfiguredModule("dummy output module")
+			self.assertEqual([ e.getDU() for e in gsdCached.getCfgDataElements() ],
+					 [ e.getDU() for e in gsd.getCfgDataElements() ])
+			self.assertEqual(gsdCached.getIdentNumber(), gsd.getIdentNumber())
+			self.assertEqual(gsdCached.getUserPrmData(), gsd.getUserPrmData())
+			self.assertEqual(gsdCached.dumpPy(), gsd.dumpPy())
+
+			# A corrupt entry is a cache miss.
+			with open(os.path.join(cacheDir, key + ".gsdc"), "wb") as fd:
+				fd.write(b"garbage")
+			self.assertIsNone(cache.load(key))
+		finally:
+			shutil.rmtree(cacheDir)
+
+	def test_cacheFromFile(self):
+		filepath = os.path.join("misc", "dummy_modular.gsd")
+		self.assertEqual(os.listdir(self.gsdCacheDir), [])
+		gsd = pyprofibus.gsd.GsdInterp.fromFile(filepath)
+		entries = os.listdir(self.gsdCacheDir)
+		self.assertEqual(len(entries), 1)
+		self.assertTrue(entries[0].endswith(".gsdc"))
+		gsdCached = pyprofibus.gsd.GsdInterp.fromFile(filepath)
+		self.assertEqual(os.listdir(self.gsdCacheDir), entries)
+		self.assertEqual(gsdCached.dumpPy(), gsd.dumpPy())
+
+		# The cache can be disabled via the environment.
+		shutil.rmtree(self.gsdCacheDir)
+		os.environ["PYPROFIBUS_GSD_CACHE"] = "0"
+		gsd = pyprofibus.gsd.GsdInterp.fromFile(filepath)
+		self.assertFalse(os.path.exists(self.gsdCacheDir))
+		self.assertEqual(gsd.dumpPy(), gsdCached.dumpPy())
+
+	def test_index(self):
+		libDir = tempfile.mkdtemp()
+		try:
+			os.mkdir(os.path.join(libDir, "sub"))
+			shutil.copyfile(os.path.join("misc", "dummy_modular.gsd"),
+					os.path.join(libDir, "sub", "modular.GSD"))
+			shutil.copyfile(os.path.join("misc", "dummy_compact.gsd"),
+					os.path.join(libDir, "compact.gse"))
+			with open(os.path.join(libDir, "broken.gsd"), "w") as fd:
+				fd.write("broken")
+
+			index = pyprofibus.gsd.GsdIndex.forDirectory(libDir)
+			self.assertEqual(index.update(libDir, parallel=False), (2, 1))
+			index.save()
+			self.assertEqual(index.update(libDir, parallel=False), (0, 1))
+
+			index = pyprofibus.gsd.GsdIndex.forDirectory(libDir)
+			entries = index.find(identNumber=0x4224)
+			self.assertEqual([ os.path.basename(e.filename) for e in entries ],
+					 [ "compact.gse", "modular.GSD" ])
+			self.assertEqual(index.find(identNumber=0x1234), [])
+			entry = index.find(text="DUMMY INPUT")[0]
+			self.assertEqual(entry.vendor, "PYPROFIBUS")
+			self.assertIn(12000000, entry.baudrates)
+			self.assertEqual(entry.maxTSDR[19200], 60)
+		finally:
+			shutil.rmtree(libDir)
@@ -0,0 +1,146 @@
+from __future__ import division, absolute_import, print_function, unicode_literals
+from pyprofibus_tstlib import *
+initTest(__file__)
+
+import pyprofibus
+import pyprofibus.util
+from pyprofibus.supervisor import *
+import os
+import shutil
+import tempfile
+import time
+
+
+CONF = """
+[PROFIBUS]
+debug=0
+
+[PHY@a]
+type=dummy_slave
+baud=19200
+
+[DP@a]
+master_addr=2
+
+[SLAVE_0@a]
+addr=8
+gsd=misc/dummy_modular.gsd
+module_0=dummy output module
+module_1=dummy output module
+module_2=dummy input module
+output_size=2
+input_size=2
+
+[PHY@b]
+type=dummy_slave
+baud=19200
+
+[DP@b]
+master_addr=3
+
+[SLAVE_0@b]
+addr=42
+gsd=misc/dummy_modular.gsd
+module_0=dummy output module
+module_1=dummy output module
+module_2=dummy input module
+output_size=2
+input_size=2
+"""
+
+class Test_Supervisor(TestCase):
+	def setUp(self):
+		super(Test_Supervisor, self).setUp()
+		self.tmpDir = tempfile.mkdtemp()
+		self.confFile = os.path.join(self.tmpDir, "lines.conf")
+		with open(self.confFile, "w") as fd:
+			fd.write(CONF)
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpDir)
+		super(Test_Supervisor, self).tearDown()
+
+	def test_multiLineConf(self):
+		self.assertEqual(pyprofibus.PbConf.getLineNames(self.confFile),
+				 [ "a", "b" ])
+		conf = pyprofibus.PbConf.fromFile(self.confFile, line="b")
+		self.assertEqual(conf.line, "b")
+		self.assertEqual(conf.phyType, "dummy_slave")
+		self.assertEqual(conf.dpMasterAddr, 3)
+		self.assertEqual([ s.addr for s in conf.slaveConfs ], [ 42 ])
+		self.assertRaises(pyprofibus.PbConfError,
+				  pyprofibus.PbConf.fromFile, self.confFile, line="c")
+
+	def test_processImage(self):
+		image = ProcessImage([ (8, 2, 3), (42, 1, 0) ])
+		self.assertEqual(image.getAddrs(), [ 8, 42 ])
+		self.assertEqual(image.getInData(8), (0, None))
+		self.assertIsNone(image.getOutData(8))
+		self.assertEqual(image.getOutCount(8), 0)
+		image.setOutData(8, b"\x01\x02\x03")
+		self.assertEqual(image.getOutCount(8), 1)
+		image.setInData(8, b"\x04\x05\x06")
+		image.setInData(42, b"\x07")
+		image.setInData(42, b"\x08")
+		self.assertEqual(image.getOutData(8), bytearray(b"\x01\x02\x03"))
+		self.assertEqual(image.getOutData(42), None)
+		self.assertEqual(image.getInData(8), (1, bytearray(b"\x04\x05")))
+		self.assertEqual(image.getInData(42), (2, bytearray(b"\x08")))
+		self.assertRaises(SupervisorError, image.setOutData, 42, b"\x00")
+		self.assertRaises(SupervisorError, image.getInData, 9)
+
+	def test_supervisor(self):
+		sup = Supervisor(self.confFile)
+		sup.RESTART_DELAY = 0.01
+		self.assertEqual(sup.getLines(), [ "a", "b" ])
+		sup.setOutData("a", 8, b"\x42\x24")
+		sup.setOutData("b", 42, b"\x11\x22")
+
+		def waitInData(line, addr, expected, minCount=1):
+			timeout = time.time() + 30.0
+			while time.time() < timeout:
+				sup.poll()
+				count, inData = sup.getInData(line, addr)
+				if count >= minCount and inData == expected:
+					return count
+				time.sleep(0.01)
+			self.fail("No in-data from line %s" % line)
+
+		sup.start()
+		try:
+			waitInData("a", 8, bytearray(b"\xBD\xDB"))
+			count = waitInData("b", 42, bytearray(b"\xEE\xDD"))
+
+			# A crashed worker is restarted.
+			sup.getWorker("b").process.terminate()
+			sup.getWorker("b").process.join()
+			waitInData("b", 42, bytearray(b"\xEE\xDD"), count + 1)
+			self.assertEqual(sup.getWorker("b").restarts, 1)
+			self.assertEqual(sup.getWorker("a").restarts, 0)
+		finally:
+			sup.stop()
+		self.assertFalse(sup.getWorker("a").isAlive())
+
+	def test_restartReset(self):
+		clock = pyprofibus.util.VirtualClock()
+		sup = Supervisor(self.confFile, lines=[ "a" ], clock=clock)
+		worker = sup.getWorker("a")
+		sup.start()
+		try:
+			for i in range(2):
+				worker.process.terminate()
+				worker.process.join()
+				self.assertEqual(sup.poll(), [])
+				clock.advance(sup.RESTART_DELAY_MAX)
+				self.assertEqual(sup.poll(), [ "a" ])
+				self.assertEqual(worker.restarts, i + 1)
+
+			# The restart delay is reset after a stable run.
+			clock.advance(sup.RESTART_RESET_TIME - 1.0)
+			sup.poll()
+			self.assertEqual(worker.restarts, 2)
+			clock.advance(1.0)
+			sup.poll()
+			self.assertEqual(worker.restarts, 0)
+		finally:
+			sup.stop()